@@ -1,23 +1,96 @@
+import gc
+import time
+from importlib import import_module
+# Boot timings: importing this package and its dependencies, then create_app()
+IMPORT_STARTED = time.perf_counter()
 from flask import Flask, request, g
 from config import configure_app
-from flask_session import Session
-from application.modules.utils import create_redis_client
+from application.modules.utils import create_redis_client, create_token_cache, create_template_cache
+from application.modules.utils import create_result_cache, create_single_flight, create_batch_executor
+from application.modules.utils import create_result_store, create_metrics, create_query_stats, create_broker_pool
+from application.modules.utils import create_rate_limiter, create_concurrency_limiter, warm_template_cache
+from application.modules.metrics import BOOT_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, WARMUP_TEMPLATES
+from application.modules.metrics import clear_api_labels
+from application.modules.logs import REQUEST_ID_HEADER, configure_logging, set_request_id
+from application.modules.deadlines import TIMEOUT_HEADER, start_deadline
+from application.modules.pagination import CursorCodec
+from application.modules.pinot import PinotClient
+from application.modules.serialization import SerializerJSONProvider, configure_serialization
+from application.modules.registry import Registry
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+# Blueprints (modules of application.views) registered by each APP_PROFILE; only these are imported
+PROFILES = {
+    "full": ("v1", "v1create", "v1delete", "v1get", "v1query", "v1ui", "v1update", "v1execute", "v1metrics"),
+    "execute-only": ("v1", "v1query", "v1execute", "v1metrics"),
+    "admin": ("v1", "v1create", "v1delete", "v1get", "v1ui", "v1update", "v1metrics"),
+}
+# Profiles serving the management API and UI, which keep server-side sessions
+SESSION_PROFILES = ("full", "admin")
 
 def create_app():
     """Application factory function."""
+    started = time.perf_counter()
+
     # Initialize Flask application
     app = Flask(__name__)
 
     # Configure the app
     configure_app(app)
+    profile = app.config.get('APP_PROFILE', 'full')
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown APP_PROFILE '{profile}'; expected one of {', '.join(PROFILES)}")
+
+    # Use the fast JSON serializer (orjson when installed) for jsonify, request bodies and broker responses
+    configure_serialization(app.config.get('JSON_CONFIG'))
+    app.json = SerializerJSONProvider(app)
+
+    # Configure queue-backed, sampled JSON logging
+    configure_logging(app)
 
-    # Initialize Flask-Session
-    Session(app)
+    # Initialize Flask-Session, imported only by the profiles that use it
+    if profile in SESSION_PROFILES:
+        from flask_session import Session
+        Session(app)
+
+    # Initialize the lock-free metrics registry served at /metrics
+    metrics = create_metrics(app.config.get('METRICS_CONFIG'))
+    app.extensions['metrics'] = metrics
 
     # Initialize Redis client and store it in app.extensions
     redis_client = create_redis_client(app.config.get('REDIS_CONFIG'))
     app.extensions['redis_client'] = redis_client
 
+    # Initialize the process-wide token validation cache
+    app.extensions['token_cache'] = create_token_cache(app.config.get('TOKEN_CACHE_CONFIG'), redis_client)
+
+    # Initialize the saved-query registry (atomic, single round-trip Redis operations)
+    registry = Registry(redis_client)
+    app.extensions['registry'] = registry
+
+    # Initialize the compiled query-template cache for saved APIs
+    app.extensions['template_cache'] = create_template_cache(app.config.get('TEMPLATE_CACHE_CONFIG'), registry)
+
+    # Initialize the opt-in Pinot result cache (in-process L1, Redis L2)
+    app.extensions['result_cache'] = create_result_cache(app.config.get('RESULT_CACHE_CONFIG'), redis_client, metrics)
+
+    # Initialize single-flight coalescing of identical in-flight Pinot queries
+    app.extensions['single_flight'] = create_single_flight(app.config.get('SINGLE_FLIGHT_CONFIG'), redis_client, metrics)
+
+    # Initialize per-API query cost rollups and the slow-query log
+    app.extensions['query_stats'] = create_query_stats(app.config.get('QUERY_STATS_CONFIG'), redis_client)
+
+    # Initialize admission control: Redis token-bucket rate limits and the per-worker concurrent query cap
+    app.extensions['rate_limiter'] = create_rate_limiter(app.config.get('ADMISSION_CONFIG'), redis_client)
+    app.extensions['concurrency_limiter'] = create_concurrency_limiter(app.config.get('ADMISSION_CONFIG'))
+
+    # Initialize paging: signed cursors and the short-lived store for full results
+    app.extensions['cursor_codec'] = CursorCodec(app.config.get('SECRET_KEY'))
+    app.extensions['result_store'] = create_result_store(app.config.get('PAGINATION_CONFIG'), redis_client)
+
+    # Initialize the bounded worker pool for batch executions
+    app.extensions['batch_executor'] = create_batch_executor(app.config.get('BATCH_CONFIG'))
+
     # Provide a reusable function for Redis client access
     def get_redis_client():
         """Retrieve the Redis client from the app context."""
@@ -28,6 +101,47 @@ def create_app():
     # Attach get_redis_client function to app for global access
     app.get_redis_client = get_redis_client
 
+    # Initialize the broker load balancer and the pooled Pinot client, and store them in app.extensions
+    broker_pool = create_broker_pool(app.config.get('PINOT_CONFIG'), app.config.get('PINOT_CLIENT_CONFIG'))
+    app.extensions['broker_pool'] = broker_pool
+    pinot_client = PinotClient(app.config.get('PINOT_CONFIG'), app.config.get('PINOT_CLIENT_CONFIG'), metrics,
+                               broker_pool)
+    app.extensions['pinot_client'] = pinot_client
+
+    def get_pinot_client():
+        """Retrieve the Pinot broker client from the app context."""
+        if not hasattr(g, 'pinot_client'):
+            g.pinot_client = app.extensions['pinot_client']
+        return g.pinot_client
+
+    # Attach get_pinot_client function to app for global access
+    app.get_pinot_client = get_pinot_client
+
+    # Request metrics, log correlation and deadlines
+    log_sampler = app.extensions['log_sampler']
+    deadline_config = app.config.get('DEADLINE_CONFIG') or {}
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        # Threads serve many requests; drop the API labels of the previous one
+        clear_api_labels()
+        g.request_id = set_request_id(request.headers.get(REQUEST_ID_HEADER))
+        log_sampler.start(request.url_rule.rule if request.url_rule is not None else "<unmatched>")
+        start_deadline(request.headers.get(TIMEOUT_HEADER), deadline_config.get('default_timeout', 30),
+                       deadline_config.get('max_timeout', 300))
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get('request_started')
+        if started is not None:
+            endpoint = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            metrics.observe(REQUEST_SECONDS, time.perf_counter() - started, (endpoint, request.method))
+            metrics.inc(REQUESTS_TOTAL, (endpoint, request.method, str(response.status_code)))
+        if g.get('request_id') is not None:
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
+
     # Error handlers
     @app.errorhandler(500)
     def internal_server_error(error):
@@ -44,29 +158,29 @@ def create_app():
         app.logger.error(f'Unhandled Exception: {error}, Path: {request.path}')
         return 'Unhandled Exception', 500
 
-    # Register blueprints
-    from application.views import v1
-    app.register_blueprint(v1.mod)
-
-    from application.views import v1create
-    app.register_blueprint(v1create.mod)
-
-    from application.views import v1delete
-    app.register_blueprint(v1delete.mod)
-
-    from application.views import v1get
-    app.register_blueprint(v1get.mod)
-
-    from application.views import v1query
-    app.register_blueprint(v1query.mod)
-
-    from application.views import v1ui
-    app.register_blueprint(v1ui.mod)
-
-    from application.views import v1update
-    app.register_blueprint(v1update.mod)
-
-    from application.views import v1execute
-    app.register_blueprint(v1execute.mod)
+    # Register the blueprints of the app profile, importing only those
+    for name in PROFILES[profile]:
+        app.register_blueprint(import_module(f'application.views.{name}').mod)
+
+    # Warm the template cache before serving executions. Under uWSGI without lazy-apps this runs once
+    # in the master, and the forked workers share the compiled templates copy-on-write
+    warmup_config = app.config.get('WARMUP_CONFIG') or {}
+    if 'v1execute' not in app.blueprints:
+        warmup_config = dict(warmup_config, enabled=False)
+    warmup_started = time.perf_counter()
+    try:
+        loaded = warm_template_cache(warmup_config, registry, app.extensions['template_cache'],
+                                     app.extensions['query_stats'])
+        app.logger.info(f'Preloaded {loaded} saved API templates in {time.perf_counter() - warmup_started:.3f}s')
+    except Exception as e:
+        loaded = 0
+        app.logger.warning(f'Template cache warmup failed: {e}')
+    metrics.set_gauge(WARMUP_TEMPLATES, loaded)
+    metrics.set_gauge(BOOT_SECONDS, time.perf_counter() - warmup_started, ("warmup",))
+    metrics.set_gauge(BOOT_SECONDS, IMPORT_SECONDS, ("import",))
+    metrics.set_gauge(BOOT_SECONDS, time.perf_counter() - started, ("create_app",))
+    if warmup_config.get('gc_freeze'):
+        # Keep everything allocated at boot out of garbage collections, which would write to (and copy) its pages
+        gc.freeze()
     return app
 
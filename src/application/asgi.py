@@ -0,0 +1,644 @@
+import asyncio
+import contextvars
+import logging
+import re
+import time
+from urllib.parse import parse_qs
+import httpx
+import redis.asyncio as aioredis
+from asgiref.wsgi import WsgiToAsgi
+from application import create_app
+from application.modules.aio import AsyncPinotClient, AsyncRegistry, AsyncTokenValidator, AsyncSingleFlight
+from application.modules.aio import AsyncConcurrencyLimiter, AsyncRateLimiter
+from application.modules.admission import CONCURRENCY
+from application.modules.pinot import PinotQueryError
+from application.modules.resultcache import HIT, STALE, MISS
+from application.modules.singleflight import SingleFlight
+from application.modules.tokens import TokenCache
+from application.modules.utils import ADMISSION_ERRORS, batch_apis, parse_batch_items
+from application.modules.streaming import CHUNK_SIZE, aiter_stream, mimetype_for
+from application.modules.formats import FormatUnavailable, render_result, requested_output
+from application.modules.splitting import merge_cache_status, merge_responses, split_plan
+from application.modules.metrics import (ADMISSION_REJECTED_TOTAL, REQUEST_SECONDS, REQUESTS_TOTAL, REGISTRY_LOOKUP, SERIALIZATION,
+                                         TEMPLATE_BINDING, TOKEN_VALIDATION, clear_api_labels, set_api_labels)
+from application.modules.logs import REQUEST_ID_HEADER, set_request_id
+from application.modules.serialization import dumps, has_exceptions, loads
+from application.modules.deadlines import (DeadlineExceeded, apply_api_timeout, limit_deadline, remaining,
+                                           start_deadline)
+
+logger = logging.getLogger(__name__)
+
+EXECUTE_BY_NAME = re.compile(r"^/v1/execute/api/([^/]+)$")
+EXECUTE_BY_VERSION = re.compile(r"^/v1/execute/version/([^/]+)$")
+QUERY_PATH = "/v1/query/"
+BATCH_PATH = "/v1/execute/batch"
+
+# Handler -> the Flask rule of the same route, so both serving modes report the same endpoint label
+HANDLER_ENDPOINTS = {
+    "passthrough_query": QUERY_PATH,
+    "execute_by_name": "/v1/execute/api/<name>",
+    "execute_by_version": "/v1/execute/version/<uuid>",
+    "execute_batch": BATCH_PATH,
+}
+
+class HTTPError(Exception):
+    """Abort the current request with a JSON error body."""
+
+    def __init__(self, status, body, headers=None):
+        super(HTTPError, self).__init__(status)
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was sent."""
+
+# Status recorded for requests whose client disconnected (no response is sent)
+CLIENT_CLOSED_REQUEST = 499
+
+class StreamedBody(object):
+    """A broker response to stream back to the client in the given format."""
+
+    def __init__(self, response, fmt):
+        self.response = response
+        self.fmt = fmt
+
+class RenderedBody(object):
+    """A query result already encoded in a non-JSON output format."""
+
+    def __init__(self, payload, mimetype):
+        self.payload = payload
+        self.mimetype = mimetype
+
+class AsyncGateway(object):
+    """
+    ASGI application for asyncio-native serving.
+    - POST /v1/query/, /v1/execute/api/<name> and /v1/execute/version/<uuid>,
+      including token validation, run as coroutines on an httpx connection
+      pool and redis.asyncio.
+    - Every other route is served by the Flask app through WsgiToAsgi.
+    Queries are only run as coroutines when the app profile serves them; an
+    "admin" worker answers them with the Flask app's 404.
+    When a client disconnects, its handler is cancelled, and with it the
+    request to the broker.
+    The in-process caches (tokens, templates, results) are shared with the
+    Flask app, so both paths see the same state.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.serves_queries = 'v1execute' in flask_app.blueprints
+
+        config = flask_app.config
+        redis_config = config.get('REDIS_CONFIG')
+        self.redis_client = aioredis.StrictRedis(
+            host=redis_config['host'],
+            port=redis_config['port'],
+            db=redis_config['db'],
+            decode_responses=True
+        )
+        self.metrics = flask_app.extensions['metrics']
+        self.pinot_client = AsyncPinotClient(config.get('PINOT_CONFIG'), config.get('PINOT_CLIENT_CONFIG'),
+                                             self.metrics, flask_app.extensions['broker_pool'])
+        self.registry = AsyncRegistry(self.redis_client)
+        self.tokens = AsyncTokenValidator(flask_app.extensions['token_cache'], self.pinot_client, self.redis_client)
+        self.single_flight = AsyncSingleFlight(self.metrics) if flask_app.extensions.get('single_flight') is not None else None
+        self.template_cache = flask_app.extensions['template_cache']
+        self.result_cache = flask_app.extensions['result_cache']
+        self.log_sampler = flask_app.extensions['log_sampler']
+        self.query_stats = flask_app.extensions.get('query_stats')
+        self.batch_config = config.get('BATCH_CONFIG') or {}
+        self.batch_slots = asyncio.Semaphore(int(self.batch_config.get('max_workers', 16)))
+        self.in_list_config = config.get('IN_LIST_CONFIG') or {}
+        self.deadline_config = config.get('DEADLINE_CONFIG') or {}
+        rate_limiter = flask_app.extensions.get('rate_limiter')
+        self.rate_limiter = AsyncRateLimiter(rate_limiter, self.redis_client) if rate_limiter is not None else None
+        concurrency_limiter = flask_app.extensions.get('concurrency_limiter')
+        self.concurrency_limiter = AsyncConcurrencyLimiter(
+            concurrency_limiter.max_concurrent, concurrency_limiter.max_queue, concurrency_limiter.queue_timeout
+        ) if concurrency_limiter is not None else None
+        self._background = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'POST' and self.serves_queries:
+            path = scope['path']
+            if path == BATCH_PATH:
+                return await self.respond(scope, receive, send, self.execute_batch)
+            if self.is_paged(scope):
+                # Paged execution is served by the Flask views
+                return await self.serve_wsgi(scope, receive, send)
+            output = self.requested_output(scope)
+            if path == QUERY_PATH:
+                return await self.respond(scope, receive, send, self.passthrough_query, output=output)
+            match = EXECUTE_BY_NAME.match(path)
+            if match:
+                name = match.group(1).lower().replace(" ", "_")  # Normalize the name
+                return await self.respond(scope, receive, send, self.execute_by_name, name, output=output)
+            match = EXECUTE_BY_VERSION.match(path)
+            if match:
+                return await self.respond(scope, receive, send, self.execute_by_version, match.group(1),
+                                          output=output)
+        return await self.serve_wsgi(scope, receive, send)
+
+    async def serve_wsgi(self, scope, receive, send):
+        """
+        Serve a request with the Flask app, in a fresh context: uvicorn may
+        start a keep-alive connection's next request in the context of the
+        previous response's send, which still holds asgiref's finished
+        thread executor and fails with "CurrentThreadExecutor already quit".
+        """
+        # Tasks copy the context they are created in
+        await contextvars.Context().run(asyncio.ensure_future, self.wsgi(scope, receive, send))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.pinot_client.aclose()
+                await self.redis_client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Plumbing
+
+    @staticmethod
+    async def read_body(receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    @staticmethod
+    async def send_json(send, status, body, headers=None, mimetype='application/json'):
+        payload = body if isinstance(body, bytes) else dumps(body)
+        raw_headers = [(b'content-type', mimetype.encode('latin-1')),
+                       (b'content-length', str(len(payload)).encode('latin-1'))]
+        for key, value in (headers or {}).items():
+            raw_headers.append((key.lower().encode('latin-1'), value.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    @staticmethod
+    def is_paged(scope):
+        """Whether a request asks for a page of results (page_size or cursor)."""
+        params = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        return 'page_size' in params or 'cursor' in params
+
+    @staticmethod
+    def header(scope, name):
+        """Return the value of a request header (lower-case bytes name), or None."""
+        for key, value in scope.get('headers', []):
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    @classmethod
+    def requested_output(cls, scope):
+        """Return the raw (stream parameter, format parameter, Accept header) of a request."""
+        params = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        return params.get('stream', [None])[0], params.get('format', [None])[0], cls.header(scope, b'accept')
+
+    @staticmethod
+    async def send_stream(send, body, headers=None):
+        """Stream a broker response back as chunked JSON or NDJSON."""
+        raw_headers = [(b'content-type', mimetype_for(body.fmt).encode('latin-1'))]
+        for key, value in (headers or {}).items():
+            raw_headers.append((key.lower().encode('latin-1'), value.encode('latin-1')))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': raw_headers})
+            async for chunk in aiter_stream(body.response.aiter_bytes(CHUNK_SIZE), body.fmt):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await body.response.aclose()
+
+    def record_request(self, handler, status, started):
+        endpoint = HANDLER_ENDPOINTS.get(handler.__name__, "<unmatched>")
+        self.metrics.observe(REQUEST_SECONDS, time.perf_counter() - started, (endpoint, "POST"))
+        self.metrics.inc(REQUESTS_TOTAL, (endpoint, "POST", str(status)))
+
+    async def respond(self, scope, receive, send, handler, *args, **kwargs):
+        started = time.perf_counter()
+        # The API labels set while handling the request stay in this task's context until it is answered
+        clear_api_labels()
+        request_id = set_request_id(self.header(scope, b'x-request-id'))
+        self.log_sampler.start(HANDLER_ENDPOINTS.get(handler.__name__, "<unmatched>"))
+        start_deadline(self.header(scope, b'x-request-timeout'), self.deadline_config.get('default_timeout', 30),
+                       self.deadline_config.get('max_timeout', 300))
+        # Concurrency slots held until the response, streamed or not, has been sent
+        slots = 0
+        try:
+            try:
+                with self.metrics.stage(TOKEN_VALIDATION):
+                    token = await self.verify_bearer_token(scope)
+                body = await self.read_body(receive)
+                try:
+                    data = loads(body) if body else None
+                except ValueError:
+                    raise HTTPError(400, {"success": False, "error": "Request body must be valid JSON"})
+                slots = await self.admit(token, handler, data, args)
+                status, response_body, headers = await self.until_disconnect(
+                    receive, handler(token, data, *args, **kwargs))
+            except HTTPError as e:
+                status, response_body, headers = e.status, e.body, e.headers
+            except ClientDisconnected:
+                self.record_request(handler, CLIENT_CLOSED_REQUEST, started)
+                return
+            except Exception as e:
+                self.flask_app.logger.error(f'Unhandled Exception: {e}, Path: {scope["path"]}')
+                self.record_request(handler, 500, started)
+                await send({'type': 'http.response.start', 'status': 500,
+                            'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                        (b'x-request-id', request_id.encode('latin-1'))]})
+                await send({'type': 'http.response.body', 'body': b'Unhandled Exception'})
+                return
+            self.record_request(handler, status, started)
+            headers = dict(headers or {}, **{REQUEST_ID_HEADER: request_id})
+            if isinstance(response_body, StreamedBody):
+                return await self.send_stream(send, response_body, headers)
+            if isinstance(response_body, RenderedBody):
+                return await self.send_json(send, status, response_body.payload, headers, response_body.mimetype)
+            with self.metrics.stage(SERIALIZATION):
+                payload = dumps(response_body)
+            await self.send_json(send, status, payload, headers)
+        finally:
+            if slots:
+                self.concurrency_limiter.release(slots)
+
+    @staticmethod
+    async def until_disconnect(receive, awaitable):
+        """
+        Await a handler in the current task, cancelling it if the client
+        disconnects first. Raises ClientDisconnected.
+        """
+        task = asyncio.current_task()
+
+        async def watch():
+            # The body has been read: the next message can only be a disconnect
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            task.cancel()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            return await awaitable
+        except asyncio.CancelledError:
+            if watcher.done() and not watcher.cancelled():
+                raise ClientDisconnected()
+            raise
+        finally:
+            watcher.cancel()
+
+    async def requested_apis(self, handler, data, args):
+        """asyncio equivalent of requested_apis and batch_queries: the saved API of each query of a request."""
+        if handler.__name__ == "execute_by_name":
+            return [args[0].lower().replace(" ", "_")]
+        if handler.__name__ == "execute_by_version":
+            refs = [("version", args[0])]
+        elif handler.__name__ == "execute_batch":
+            try:
+                _, refs, _ = parse_batch_items(data, int(self.batch_config.get('max_items', 50)))
+            except ValueError:
+                return [None]
+        else:
+            return [None]
+        # Versions missing from the template cache are resolved now, and stay cached for the handler
+        versions = [ref for ref in refs if ref[0] == "version"]
+        return batch_apis(refs, await self.resolve_templates(versions) if versions else [])
+
+    async def admit(self, token, handler, data, args):
+        """
+        asyncio equivalent of the admission_control decorator: raises HTTPError
+        429 for a request over its rate limits or without concurrency slots.
+        Returns the number of slots taken, to be released once it is answered.
+        """
+        if self.rate_limiter is None and self.concurrency_limiter is None:
+            return 0
+        apis = await self.requested_apis(handler, data, args)
+        if self.rate_limiter is not None:
+            rejection = await self.rate_limiter.check(token, apis)
+            if rejection is not None:
+                self.reject(*rejection)
+        if self.concurrency_limiter is None:
+            return 0
+        slots = max(len(apis), 1)
+        if not await self.concurrency_limiter.acquire(slots):
+            self.reject(CONCURRENCY, 1)
+        return slots
+
+    def reject(self, reason, retry_after):
+        self.metrics.inc(ADMISSION_REJECTED_TOTAL, (reason,))
+        raise HTTPError(429, {"success": False, "error": ADMISSION_ERRORS[reason], "retry_after": retry_after},
+                        {"Retry-After": str(retry_after)})
+
+    async def verify_bearer_token(self, scope):
+        """asyncio equivalent of the verify_bearer_token decorator."""
+        auth_header = self.header(scope, b'authorization')
+        if not auth_header:
+            raise HTTPError(401, {"error": "Authorization header missing"})
+        if not auth_header.startswith("Bearer "):
+            raise HTTPError(401, {"error": "Invalid Authorization header format"})
+        bearer_token = auth_header.split(" ", 1)[1]
+        if not await self.tokens.validate(bearer_token):
+            raise HTTPError(401, {"error": "Invalid or expired token"})
+        return bearer_token
+
+    async def fetch_coalesced(self, sql, token, fingerprint=None, template=None):
+        """asyncio equivalent of utils.fetch_coalesced; queries of a saved version are recorded in query_stats."""
+        async def fetch():
+            pinot_response, payload = await self.pinot_client.fetch(sql, token)
+            if template is not None and self.query_stats is not None:
+                self.query_stats.record(template.name, template.version, pinot_response, sql, fingerprint)
+            return pinot_response, None if has_exceptions(pinot_response) else payload
+
+        if self.single_flight is None:
+            return await fetch()
+        return await self.single_flight.do(SingleFlight.make_key(fingerprint or sql, TokenCache.token_key(token)), fetch)
+
+    async def run_query(self, sql, token, template=None, output=None, fingerprint=None):
+        """
+        Send SQL to Pinot, through the result cache when the saved version enables it.
+        A streaming request returns a StreamedBody and a request for another
+        output format a RenderedBody instead of the JSON response.
+        """
+        if not self.pinot_client.broker_url:
+            return 500, {"success": False, "error": "Pinot broker URL is not configured"}, None
+        try:
+            streamed, fmt = requested_output(*output) if output else (None, None)
+        except ValueError as e:
+            return 400, {"success": False, "error": str(e)}, None
+        if not streamed:
+            return self.render_output(*await self.query_pinot(sql, token, template, fingerprint), fmt)
+        try:
+            return 200, StreamedBody(await self.pinot_client.stream(sql, token), streamed), None
+        except PinotQueryError as e:
+            return 500, {"success": False, "error": "Failed to query Pinot", "details": e.details}, None
+        except DeadlineExceeded as e:
+            return 504, {"success": False, "error": str(e)}, None
+        except httpx.HTTPError as e:
+            return 500, {"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}, None
+
+    @staticmethod
+    def render_output(status, body, headers, fmt):
+        """Convert a successful query response to the requested output format, if any."""
+        if fmt and status == 200:
+            try:
+                rendered = render_result(body["data"], fmt)
+            except FormatUnavailable as e:
+                return 406, {"success": False, "error": str(e)}, None
+            if rendered is not None:
+                headers = dict(headers or {})
+                if body["data"].get("exceptions"):
+                    headers["X-Pinot-Exceptions"] = str(len(body["data"]["exceptions"]))
+                body = RenderedBody(*rendered)
+        return status, body, headers
+
+    async def run_split(self, bounds, token, template, output=None):
+        """run_query for a list parameter split over several queries; they cannot be streamed."""
+        if not self.pinot_client.broker_url:
+            return 500, {"success": False, "error": "Pinot broker URL is not configured"}, None
+        try:
+            streamed, fmt = requested_output(*output) if output else (None, None)
+            if streamed:
+                raise ValueError(f"The list parameter needs {len(bounds)} queries, which cannot be streamed or paged")
+        except ValueError as e:
+            return 400, {"success": False, "error": str(e)}, None
+        return self.render_output(*await self.query_split(bounds, token, template), fmt)
+
+    async def query_split(self, bounds, token, template):
+        """asyncio equivalent of v1execute.query_split; the queries run concurrently."""
+        try:
+            plan = split_plan(bounds[0].sql)
+        except ValueError as e:
+            return 400, {"success": False, "error": f"The list parameter needs {len(bounds)} queries, but {e}"}, None
+
+        results = await asyncio.gather(*(self.query_pinot(bound.sql, token, template, bound.fingerprint)
+                                         for bound in bounds))
+        for status, body, _ in results:
+            if status != 200:
+                return status, body, None
+        try:
+            merged = merge_responses([body["data"] for _, body, _ in results], plan)
+        except ValueError as e:
+            return 400, {"success": False, "error": str(e)}, None
+        headers = {"X-Split-Queries": str(len(bounds))}
+        cache_status = merge_cache_status([(query_headers or {}).get("X-Cache") for _, _, query_headers in results])
+        if cache_status is not None:
+            headers["X-Cache"] = cache_status
+        return 200, {"success": True, "data": merged}, headers
+
+    def bind_template(self, template, user_params):
+        """Bind request parameters like v1execute.bind_template. Raises ValueError."""
+        return template.bind_chunks(user_params, int(self.in_list_config.get('chunk_size', 1000)),
+                                    int(self.in_list_config.get('max_values', 100000)))
+
+    async def query_pinot(self, sql, token, template=None, fingerprint=None):
+        if template is not None:
+            # Batch and split queries run in their own tasks; label their metrics too
+            set_api_labels(template.name, template.version)
+        cache_config = template.options.get('cache') if template is not None else None
+        try:
+            if not cache_config:
+                pinot_response, _ = await self.fetch_coalesced(sql, token, fingerprint, template)
+                return 200, {"success": True, "data": pinot_response}, None
+
+            pinot_response, status = await self.cached_query(sql, token, template, cache_config, fingerprint)
+            return 200, {"success": True, "data": pinot_response}, {"X-Cache": status}
+
+        except PinotQueryError as e:
+            return 500, {"success": False, "error": "Failed to query Pinot", "details": e.details}, None
+        except DeadlineExceeded as e:
+            return 504, {"success": False, "error": str(e)}, None
+        except httpx.HTTPError as e:
+            return 500, {"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}, None
+
+    async def cached_query(self, sql, token, template, cache_config, fingerprint=None):
+        """asyncio equivalent of ResultCache.get_or_load, reading and writing Redis asynchronously."""
+        result_cache = self.result_cache
+        scope = "" if cache_config.get('scope') == 'global' else TokenCache.token_key(token)
+        key = result_cache.make_key(template.version, fingerprint or sql, scope)
+        ttl, stale_ttl = cache_config['ttl'], cache_config.get('stale_ttl', 0)
+
+        data, status = result_cache.get_local(key)
+        if status == MISS and result_cache.redis_client is not None:
+            try:
+                shared = await self.redis_client.get(result_cache.key_prefix + key)
+            except Exception as e:
+                # Like ResultCache: without Redis, the query runs as a cache miss
+                logger.warning(f"Result cache Redis lookup failed: {str(e)}")
+                shared = None
+            data, status = result_cache.accept_shared(key, shared)
+        result_cache.record(status)
+        if status == HIT:
+            return data, HIT
+
+        async def load():
+            pinot_response, payload = await self.fetch_coalesced(sql, token, fingerprint, template)
+            if payload is not None:
+                payload, fresh_until, stale_until = result_cache.set(key, pinot_response, ttl, stale_ttl,
+                                                                     payload, shared=False)
+                if result_cache.redis_client is not None:
+                    value, ttl_ms = result_cache.encode_shared(payload, fresh_until, stale_until)
+                    try:
+                        await self.redis_client.set(result_cache.key_prefix + key, value, px=ttl_ms)
+                    except Exception as e:
+                        logger.warning(f"Result cache Redis write failed: {str(e)}")
+            return pinot_response
+
+        if status == STALE:
+            # Serve the stale result and refresh it in the background
+            task = asyncio.ensure_future(load())
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            return data, STALE
+        return await load(), MISS
+
+    # Handlers
+
+    async def passthrough_query(self, token, data, output=None):
+        if not data or "sql" not in data:
+            return 400, {"success": False, "error": "Query must include an 'sql' field"}, None
+        return await self.run_query(data["sql"], token, output=output)
+
+    async def execute_by_name(self, token, data, name, output=None):
+        with self.metrics.stage(REGISTRY_LOOKUP):
+            template = self.template_cache.lookup_by_name(name)
+            if template is None:
+                generation = self.template_cache.generation
+                try:
+                    latest_uuid, record_data = await self.registry.resolve_latest(name)
+                except ValueError as e:
+                    return 404, {"success": False, "error": str(e)}, None
+                template = self.template_cache.add(latest_uuid, record_data, name=name, generation=generation)
+        return await self.execute_template(token, data, template, output)
+
+    async def execute_by_version(self, token, data, uuid, output=None):
+        with self.metrics.stage(REGISTRY_LOOKUP):
+            template = self.template_cache.lookup_by_version(uuid)
+            if template is None:
+                try:
+                    record_data = await self.registry.get_version(uuid)
+                except ValueError as e:
+                    return 404, {"success": False, "error": str(e)}, None
+                template = self.template_cache.add(uuid, record_data)
+        return await self.execute_template(token, data, template, output)
+
+    async def resolve_templates(self, refs):
+        """asyncio equivalent of TemplateCache.get_many."""
+        templates = [self.template_cache.lookup_by_name(value) if kind == "name"
+                     else self.template_cache.lookup_by_version(value) for kind, value in refs]
+        missing = [index for index, template in enumerate(templates) if template is None]
+        if not missing:
+            return templates
+        generation = self.template_cache.generation
+        resolved = await self.registry.resolve_many([refs[index] for index in missing])
+        for index, result in zip(missing, resolved):
+            if isinstance(result, Exception):
+                templates[index] = result
+                continue
+            kind, value = refs[index]
+            templates[index] = self.template_cache.add(result[0], result[1], generation=generation,
+                                                       name=value if kind == "name" else None)
+        return templates
+
+    async def execute_batch(self, token, data):
+        """asyncio equivalent of the /v1/execute/batch view; concurrency is bounded per process."""
+        if not self.pinot_client.broker_url:
+            return 500, {"success": False, "error": "Pinot broker URL is not configured"}, None
+        try:
+            ids, refs, parameters = parse_batch_items(data, int(self.batch_config.get('max_items', 50)))
+            deadline = float(self.batch_config.get('deadline', 30))
+            if data.get('deadline') is not None:
+                deadline = min(deadline, float(data['deadline']))
+            if deadline <= 0:
+                raise ValueError("'deadline' must be positive")
+        except (TypeError, ValueError) as e:
+            return 400, {"success": False, "error": str(e)}, None
+        # Nor may it outlast the request's own deadline. Queries inherit it, so Pinot
+        # and the HTTP client give up on a query when the batch stops waiting for it
+        limit_deadline(deadline)
+        deadline = max(remaining(), 0)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        with self.metrics.stage(REGISTRY_LOOKUP):
+            templates = await self.resolve_templates(refs)
+
+        async def run(template, bounds):
+            # Each task runs in its own copy of the request's context; its API's timeout may end it sooner
+            limit_deadline(template.options.get('timeout'))
+            async with self.batch_slots:
+                if len(bounds) > 1:
+                    return await self.query_split(bounds, token, template)
+                return await self.query_pinot(bounds[0].sql, token, template, bounds[0].fingerprint)
+
+        results = {}
+        tasks = {}
+        for item_id, template, item_parameters in zip(ids, templates, parameters):
+            if isinstance(template, Exception):
+                results[item_id] = {"success": False, "status": 404, "error": str(template)}
+                continue
+            set_api_labels(template.name, template.version)
+            try:
+                with self.metrics.stage(TEMPLATE_BINDING):
+                    bounds = self.bind_template(template, item_parameters)
+            except ValueError as e:
+                results[item_id] = {"success": False, "status": 400, "error": str(e)}
+                continue
+            tasks[asyncio.ensure_future(run(template, bounds))] = item_id
+
+        # The batch response itself belongs to no single API
+        clear_api_labels()
+        done, pending = set(), set()
+        if tasks:
+            try:
+                done, pending = await asyncio.wait(tasks, timeout=max(deadline - (loop.time() - started), 0))
+            except asyncio.CancelledError:
+                # The client went away: nobody waits for the queries any more
+                for task in tasks:
+                    task.cancel()
+                raise
+        for task in done:
+            try:
+                status_code, body, headers = task.result()
+            except Exception as e:
+                status_code, body, headers = 500, {"success": False, "error": str(e)}, None
+            body["status"] = status_code
+            if headers and headers.get("X-Cache"):
+                body["cache"] = headers["X-Cache"]
+            results[tasks[task]] = body
+        for task in pending:
+            task.cancel()
+            results[tasks[task]] = {"success": False, "status": 504, "error": "Batch deadline exceeded"}
+
+        return 200, {"success": True, "results": {item_id: results[item_id] for item_id in ids}}, None
+
+    async def execute_template(self, token, data, template, output=None):
+        # Merge request parameters with defaults
+        user_params = (data or {}).get('parameters', {})
+        set_api_labels(template.name, template.version)
+        apply_api_timeout(template.options.get('timeout'), self.deadline_config.get('max_timeout'))
+        try:
+            with self.metrics.stage(TEMPLATE_BINDING):
+                bounds = self.bind_template(template, user_params)
+        except ValueError as e:
+            return 400, {"success": False, "error": str(e)}, None
+        self.log_sampler.log_query(logger, "Executing saved API", bounds[0].sql, api=template.name,
+                                   version=template.version, queries=len(bounds))
+        if len(bounds) > 1:
+            return await self.run_split(bounds, token, template, output)
+        return await self.run_query(bounds[0].sql, token, template, output, bounds[0].fingerprint)
+
+def create_asgi_app():
+    """ASGI application factory: the Flask app wrapped by the asyncio gateway."""
+    return AsyncGateway(create_app())
@@ -0,0 +1,156 @@
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from application.modules.tokens import TokenCache
+
+logger = logging.getLogger(__name__)
+
+# Reasons a request is turned away, reported in metrics and responses
+TOKEN_RATE = "token_rate"
+API_RATE = "api_rate"
+CONCURRENCY = "concurrency"
+
+# Take its cost from every bucket in KEYS, or take nothing.
+# ARGV: now (ms), then rate (tokens/s), burst and cost for each key.
+# Returns {0, 0} when admitted, else {1-based index of the first empty bucket, ms until it has enough tokens}.
+TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[3 * i - 1])
+    local burst = tonumber(ARGV[3 * i])
+    local cost = tonumber(ARGV[3 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+    if tokens < cost then
+        return {i, math.ceil((cost - tokens) * 1000 / rate)}
+    end
+    levels[i] = tokens - cost
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[3 * i - 1])
+    local burst = tonumber(ARGV[3 * i])
+    redis.call('HSET', key, 'tokens', levels[i], 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return {0, 0}
+"""
+
+class RateLimiter(object):
+    """
+    Token-bucket rate limits shared by all workers through Redis.
+    - Every bearer token gets a bucket of token_burst requests, refilled at
+      token_rate per second.
+    - Every saved API gets a bucket shared by all callers, refilled at
+      api_rate per second (0 disables it); api_limits overrides the rate and
+      burst of single APIs.
+    A request is admitted only if all of its buckets have room, and takes from
+    them in one atomic Lua call. A batch takes one request per query from the
+    token's bucket, and from each API's bucket one per query of that API.
+    When Redis cannot be reached, requests are admitted.
+    """
+
+    def __init__(self, redis_client, token_rate=50, token_burst=100, api_rate=0, api_burst=0, api_limits=None,
+                 key_prefix="ratelimit:"):
+        self.redis_client = redis_client
+        self.token_limit = (float(token_rate), float(token_burst))
+        self.api_limit = (float(api_rate), float(api_burst or api_rate))
+        self.api_limits = {name: (float(rate), float(burst)) for name, (rate, burst) in (api_limits or {}).items()}
+        self.key_prefix = key_prefix
+        self._check = redis_client.register_script(TOKEN_BUCKET_LUA) if redis_client is not None else None
+
+    def buckets(self, token, apis=()):
+        """
+        Return [(key, rate, burst, cost, reason)] of the buckets a request takes from.
+        :param apis: Saved API of each query the request runs (None for queries of no saved API).
+        """
+        buckets = []
+        if self.token_limit[0] > 0:
+            buckets.append((f"{self.key_prefix}token:{TokenCache.token_key(token)}",) + self.token_limit
+                           + (max(len(apis), 1), TOKEN_RATE))
+        for api, cost in sorted(Counter(api for api in apis if api).items()):
+            rate, burst = self.api_limits.get(api, self.api_limit)
+            if rate > 0:
+                buckets.append((f"{self.key_prefix}api:{api}", rate, burst, cost, API_RATE))
+        return buckets
+
+    @staticmethod
+    def script_args(buckets):
+        args = [int(time.time() * 1000)]
+        for _, rate, burst, cost, _ in buckets:
+            args.extend((rate, max(burst, cost), cost))
+        return [bucket[0] for bucket in buckets], args
+
+    @staticmethod
+    def parse_result(buckets, result):
+        """Return None when admitted, else (reason, seconds to wait before retrying)."""
+        index, wait_ms = int(result[0]), int(result[1])
+        if index == 0:
+            return None
+        return buckets[index - 1][4], max(int(math.ceil(wait_ms / 1000.0)), 1)
+
+    def check(self, token, apis=()):
+        """
+        Take a request per query from the token's and the APIs' buckets.
+        :param apis: Saved API of each query the request runs (None for queries of no saved API).
+        Returns None when the request is admitted, else (reason, Retry-After seconds).
+        """
+        buckets = self.buckets(token, apis)
+        if not buckets or self._check is None:
+            return None
+        keys, args = self.script_args(buckets)
+        try:
+            result = self._check(keys=keys, args=args)
+        except Exception as e:
+            logger.warning(f"Rate limit check failed, admitting request: {str(e)}")
+            return None
+        return self.parse_result(buckets, result)
+
+class ConcurrencyLimiter(object):
+    """
+    Cap on the queries a worker runs at once. A request over the cap waits for
+    a slot, but only if fewer than max_queue requests are already waiting and
+    only for up to queue_timeout seconds; otherwise it is rejected at once.
+    A batch takes a slot per query, up to the whole cap.
+    """
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=2):
+        self.max_concurrent = int(max_concurrent)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, slots=1):
+        """Take slots; returns False if the request must be rejected."""
+        if self.max_concurrent <= 0:
+            return True
+        slots = min(slots, self.max_concurrent)
+        with self._condition:
+            if self.active + slots <= self.max_concurrent:
+                self.active += slots
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self.active + slots <= self.max_concurrent,
+                                                self.queue_timeout):
+                    return False
+                self.active += slots
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, slots=1):
+        if self.max_concurrent <= 0:
+            return
+        with self._condition:
+            self.active -= min(slots, self.max_concurrent)
+            # Waiters may need different numbers of slots
+            self._condition.notify_all()
@@ -0,0 +1,445 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+import httpx
+from application.modules.metrics import (COALESCED_LOCAL, LEADER, Metrics, PINOT, PINOT_ERRORS_TOTAL, PINOT_FAILOVERS_TOTAL,
+                                         SINGLEFLIGHT_CALLS_TOTAL)
+from application.modules.brokers import BrokerPool, BrokerUnavailable, FAILOVER_STATUSES, FAILURE_STATUSES, parse_brokers
+from application.modules.pinot import PinotQueryError, query_body, query_headers
+from application.modules.deadlines import DeadlineExceeded, check_deadline
+from application.modules.logs import sql_fields
+from application.modules.serialization import decode_response
+from application.modules.registry import Registry, RESOLVE_LATEST_LUA, GET_VERSION_LUA
+from application.modules.admission import TOKEN_BUCKET_LUA, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+class AsyncPinotClient(object):
+    """
+    asyncio counterpart of PinotClient, backed by a pooled httpx.AsyncClient.
+    The underlying client is created on first use so it binds to the running loop.
+    Brokers are picked, and failed over, like PinotClient does; pass the
+    sync client's BrokerPool to share load and breaker state with it.
+    With cancel_queries, a query whose caller is cancelled (the client
+    disconnected) is also cancelled on the broker, through the clientQueryId
+    it was sent with.
+    """
+
+    def __init__(self, pinot_config, client_config=None, metrics=None, broker_pool=None):
+        client_config = client_config or {}
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.broker_pool = broker_pool if broker_pool is not None else BrokerPool(parse_brokers(pinot_config),
+                                                                                  probe_interval=0)
+        self.max_failovers = int(client_config.get('max_failovers', 2))
+        self.pool_size = int(client_config.get('async_pool_size', 100))
+        self.timeout = httpx.Timeout(float(client_config.get('read_timeout', 60)),
+                                     connect=float(client_config.get('connect_timeout', 3.05)))
+        self.max_retries = int(client_config.get('max_retries', 3))
+        self.timeout_margin_ms = float(client_config.get('timeout_margin_ms', 100))
+        self.cancel_queries = bool(client_config.get('cancel_queries', False))
+        self._client = None
+        self._background = set()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                # httpx only retries failed connection attempts, which are safe for every method;
+                # with several brokers they are left to failover instead
+                transport=httpx.AsyncHTTPTransport(
+                    retries=self.max_retries if len(self.broker_pool.brokers) <= 1 else 0)
+            )
+        return self._client
+
+    @property
+    def broker_url(self):
+        """The first configured broker, or None when none is configured."""
+        return self.broker_pool.brokers[0].url if self.broker_pool.brokers else None
+
+    def request_timeout(self):
+        """asyncio equivalent of PinotClient.request_timeout."""
+        left = check_deadline()
+        if left is None or left >= self.timeout.read:
+            return self.timeout, False
+        return httpx.Timeout(left, connect=min(self.timeout.connect, left)), True
+
+    async def send(self, method, path, stream=False, client_query_id=None, **kwargs):
+        """
+        asyncio equivalent of PinotClient.send.
+        :param client_query_id: clientQueryId the query was sent with, to cancel it if this call is cancelled.
+        """
+        if not self.broker_pool.brokers:
+            raise ValueError("Pinot broker URL is missing in the configuration")
+        tried, failed_response, error = [], None, None
+        for attempt in range(self.max_failovers + 1):
+            try:
+                timeout, cut = self.request_timeout()
+            except DeadlineExceeded:
+                if failed_response is not None:
+                    await failed_response.aclose()
+                raise
+            try:
+                broker = self.broker_pool.acquire(tried)
+            except BrokerUnavailable as e:
+                # Report what went wrong with the brokers already tried, if any
+                if failed_response is not None:
+                    return failed_response
+                raise error or httpx.ConnectError(str(e))
+            if failed_response is not None:
+                await failed_response.aclose()
+            if tried:
+                self.metrics.inc(PINOT_FAILOVERS_TOTAL, (tried[-1].url,))
+            tried.append(broker)
+            started = time.perf_counter()
+            try:
+                request = self.client.build_request(method, f"{broker.url}{path}", timeout=timeout, **kwargs)
+                response = await self.client.send(request, stream=stream)
+            except httpx.ConnectTimeout as e:
+                if cut and timeout.connect < self.timeout.connect:
+                    # Connecting was cut short by the deadline, which says nothing about the broker
+                    self.broker_pool.release(broker, time.perf_counter() - started, None)
+                    raise DeadlineExceeded("Query deadline exceeded") from e
+                # The broker could not be reached, so it never saw the query
+                self.broker_pool.release(broker, time.perf_counter() - started, True)
+                error = e
+                if attempt < self.max_failovers:
+                    continue
+                raise
+            except httpx.TimeoutException as e:
+                if not cut:
+                    self.broker_pool.release(broker, time.perf_counter() - started, True)
+                    raise
+                # The request ran out of time, which says nothing about the broker
+                self.broker_pool.release(broker, time.perf_counter() - started, None)
+                raise DeadlineExceeded("Query deadline exceeded") from e
+            except httpx.HTTPError as e:
+                self.broker_pool.release(broker, time.perf_counter() - started, True)
+                error = e
+                # Only a failed connection is certain not to have reached the broker
+                if isinstance(e, httpx.ConnectError) and attempt < self.max_failovers:
+                    continue
+                raise
+            except BaseException:
+                # Cancelled: says nothing about the broker
+                self.broker_pool.release(broker, time.perf_counter() - started, None)
+                if client_query_id is not None:
+                    self.cancel_query(broker.url, client_query_id, kwargs.get('headers'))
+                raise
+            self.broker_pool.release(broker, time.perf_counter() - started, response.status_code in FAILURE_STATUSES)
+            if response.status_code not in FAILOVER_STATUSES or attempt == self.max_failovers:
+                return response
+            failed_response = response
+        return failed_response
+
+    def query_id(self):
+        """A clientQueryId for the next query, when queries are cancelled with their caller."""
+        return uuid.uuid4().hex if self.cancel_queries else None
+
+    def cancel_query(self, broker_url, client_query_id, headers=None):
+        """Ask a broker to cancel a query nobody waits for any more; best effort, in the background."""
+        async def cancel():
+            try:
+                await self.client.delete(f"{broker_url}/clientQuery/{client_query_id}", headers=headers)
+            except httpx.HTTPError as e:
+                logger.warning(f"Cancelling Pinot query {client_query_id} failed: {str(e)}")
+
+        task = asyncio.ensure_future(cancel())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def query(self, sql, token):
+        """Send a SQL query to a broker and return the raw response."""
+        client_query_id = self.query_id()
+        return await self.send("POST", "/query/sql", client_query_id=client_query_id,
+                               json=query_body(sql, self.timeout_margin_ms, client_query_id),
+                               headers=query_headers(token))
+
+    async def fetch(self, sql, token):
+        """
+        Run a SQL query and return (response, response body bytes). The
+        response is left undecoded (RawJSON) in passthrough mode.
+        Raises PinotQueryError for non-200 responses.
+        """
+        try:
+            with self.metrics.stage(PINOT):
+                response = await self.query(sql, token)
+        except DeadlineExceeded:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "deadline")
+            logger.warning("Pinot query deadline exceeded", extra=sql_fields(sql))
+            raise
+        except httpx.HTTPError as e:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "error")
+            logger.warning(f"Pinot query failed: {str(e)}", extra=sql_fields(sql))
+            raise
+        if response.status_code != 200:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, str(response.status_code))
+            logger.warning(f"Pinot returned status {response.status_code}", extra=sql_fields(sql))
+            raise PinotQueryError(response.status_code, response.text)
+        return decode_response(response.content), response.content
+
+    async def stream(self, sql, token):
+        """
+        Run a SQL query and return the response with its body still unread,
+        for iterating with aiter_bytes(). The caller must aclose() it.
+        Raises PinotQueryError for non-200 responses.
+        """
+        try:
+            # Timed until the response headers arrive
+            with self.metrics.stage(PINOT):
+                client_query_id = self.query_id()
+                response = await self.send("POST", "/query/sql", stream=True, client_query_id=client_query_id,
+                                           json=query_body(sql, self.timeout_margin_ms, client_query_id),
+                                           headers=query_headers(token))
+        except DeadlineExceeded:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "deadline")
+            raise
+        except httpx.HTTPError:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "error")
+            raise
+        if response.status_code != 200:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, str(response.status_code))
+            try:
+                await response.aread()
+                raise PinotQueryError(response.status_code, response.text)
+            finally:
+                await response.aclose()
+        return response
+
+    async def health(self, token):
+        """Call the health endpoint of a broker with the given bearer token."""
+        return await self.send("GET", "/health", headers={"Authorization": f"Bearer {token}"})
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class AsyncRegistry(object):
+    """Read-only registry operations needed by the execute path, over redis.asyncio."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._resolve_latest = redis_client.register_script(RESOLVE_LATEST_LUA)
+        self._get_version = redis_client.register_script(GET_VERSION_LUA)
+
+    async def resolve_latest(self, name):
+        """Return (uuid, record dict) for the latest version of an API name."""
+        return Registry.parse_latest(name, await self._resolve_latest(keys=[name]))
+
+    async def get_version(self, uuid):
+        """Return the record dict for a version UUID."""
+        return Registry.parse_version(uuid, await self._get_version(keys=[uuid]))
+
+    async def resolve_many(self, refs):
+        """Resolve ("name" | "version", value) references in one pipelined round trip."""
+        if not refs:
+            return []
+        pipe = self.redis_client.pipeline(transaction=False)
+        for kind, value in refs:
+            if kind == "name":
+                await self._resolve_latest(keys=[value], client=pipe)
+            else:
+                await self._get_version(keys=[value], client=pipe)
+        return Registry.parse_many(refs, await pipe.execute())
+
+class AsyncTokenValidator(object):
+    """
+    Token validation for the asyncio path. Shares the in-process tier of the
+    app's TokenCache with the Flask views and uses the same Redis keys for
+    the shared tier, so results are reused across both serving modes.
+    """
+
+    def __init__(self, token_cache, pinot_client, redis_client=None):
+        self.token_cache = token_cache
+        self.pinot_client = pinot_client
+        self.redis_client = redis_client if token_cache.redis_client is not None else None
+        self._inflight = {}
+
+    async def check_with_broker(self, token):
+        """True/False for a definitive broker answer, None for a transient failure."""
+        try:
+            response = await self.pinot_client.health(token)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Error validating token: {str(e)}")
+            return None
+        if response.status_code == 200:
+            return True
+        if response.status_code in (401, 403):
+            return False
+        return None
+
+    async def _get_shared(self, token):
+        if self.redis_client is None:
+            return None
+        try:
+            value = await self.redis_client.get(self.token_cache.key_prefix + self.token_cache.token_key(token))
+        except Exception as e:
+            logger.warning(f"Token cache Redis lookup failed: {str(e)}")
+            return None
+        if value is None:
+            return None
+        valid = value == "1"
+        self.token_cache.set_local(token, valid)
+        return valid
+
+    async def _set_shared(self, token, valid):
+        ttl = self.token_cache.valid_ttl if valid else self.token_cache.invalid_ttl
+        if self.redis_client is None or ttl <= 0:
+            return
+        try:
+            await self.redis_client.set(self.token_cache.key_prefix + self.token_cache.token_key(token),
+                                        "1" if valid else "0", px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Token cache Redis write failed: {str(e)}")
+
+    async def _validate(self, token):
+        valid = await self._get_shared(token)
+        if valid is not None:
+            return valid
+        valid = await self.check_with_broker(token)
+        if valid is not None:
+            self.token_cache.set_local(token, valid)
+            await self._set_shared(token, valid)
+        return bool(valid)
+
+    async def validate(self, token):
+        """Return whether the token is valid; concurrent checks of one token share a call."""
+        valid = self.token_cache.get_local(token)
+        if valid is not None:
+            return valid
+
+        key = self.token_cache.token_key(token)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._validate(token))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+class AsyncSingleFlight(object):
+    """
+    In-process single-flight for coroutines. A single asyncio process serves
+    the concurrency of many sync workers, so it does not coordinate through
+    Redis the way SingleFlight does.
+    """
+
+    def __init__(self, metrics=None):
+        # key -> [task, callers waiting for it]
+        self._calls = {}
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+    async def do(self, key, func):
+        """
+        Await func() once for all concurrent callers with the same key. It is
+        cancelled when every caller waiting for it has been cancelled or has
+        given up at its request's deadline (DeadlineExceeded).
+        """
+        left = check_deadline()
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (LEADER,))
+            call = [asyncio.ensure_future(func()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (COALESCED_LOCAL,))
+        call[1] += 1
+        try:
+            # The call may belong to a caller with a later deadline
+            return await asyncio.wait_for(asyncio.shield(call[0]), left)
+        except DeadlineExceeded:
+            if leader:
+                raise
+            # The leader's deadline may be earlier than this caller's
+            check_deadline()
+            return await func()
+        except asyncio.CancelledError:
+            if call[1] == 1:
+                call[0].cancel()
+            raise
+        except asyncio.TimeoutError:
+            if call[0].done():
+                raise
+            if call[1] == 1:
+                call[0].cancel()
+            raise DeadlineExceeded("Query deadline exceeded")
+        finally:
+            call[1] -= 1
+
+class AsyncRateLimiter(object):
+    """The app's RateLimiter over redis.asyncio: same buckets, keys and Lua script."""
+
+    def __init__(self, rate_limiter, redis_client):
+        self.rate_limiter = rate_limiter
+        self._check = redis_client.register_script(TOKEN_BUCKET_LUA)
+
+    async def check(self, token, apis=()):
+        """Returns None when the request is admitted, else (reason, Retry-After seconds)."""
+        buckets = self.rate_limiter.buckets(token, apis)
+        if not buckets:
+            return None
+        keys, args = RateLimiter.script_args(buckets)
+        try:
+            result = await self._check(keys=keys, args=args)
+        except Exception as e:
+            logger.warning(f"Rate limit check failed, admitting request: {str(e)}")
+            return None
+        return RateLimiter.parse_result(buckets, result)
+
+class AsyncConcurrencyLimiter(object):
+    """asyncio equivalent of ConcurrencyLimiter, with the same limits, for the event loop's process."""
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=2):
+        self.max_concurrent = int(max_concurrent)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.active = 0
+        # [slots, future] of each waiting request, served in arrival order
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, slots=1):
+        """Take slots; returns False if the request must be rejected."""
+        if self.max_concurrent <= 0:
+            return True
+        slots = min(slots, self.max_concurrent)
+        if not self._waiters and self.active + slots <= self.max_concurrent:
+            self.active += slots
+            return True
+        if len(self._waiters) >= self.max_queue:
+            return False
+        waiter = [slots, asyncio.get_running_loop().create_future()]
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), self.queue_timeout)
+            return True
+        except BaseException as e:
+            if waiter[1].done():
+                # The slots were handed over as the wait ended
+                self.release(slots)
+            else:
+                self._waiters.remove(waiter)
+                self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self, slots=1):
+        if self.max_concurrent <= 0:
+            return
+        self.active -= min(slots, self.max_concurrent)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.active + self._waiters[0][0] <= self.max_concurrent:
+            slots, future = self._waiters.popleft()
+            self.active += slots
+            future.set_result(None)
@@ -0,0 +1,231 @@
+import math
+import re
+from datetime import datetime, timezone
+
+# Identifiers (columns, tables) accepted without an allowlist; dots for db.table, $ for virtual columns
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_$][A-Za-z0-9_$]*(\.[A-Za-z_$][A-Za-z0-9_$]*)*$")
+INTEGER_PATTERN = re.compile(r"^[+-]?\d+$")
+
+# integer is checked as 64-bit like long: saved APIs bind epoch milliseconds as integer
+LONG_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+LIST_SUFFIX = "_list"
+
+# Literals and quoted identifiers, which canonicalize_sql leaves untouched, and the comments and whitespace between them
+SQL_TOKENS = re.compile(r"""
+    (?P<literal>'(?:[^']|'')*')
+  | (?P<identifier>"(?:[^"]|"")*")
+  | (?P<gap>(?:--[^\n]*|/\*.*?\*/|\s+)+)
+""", re.VERBOSE | re.DOTALL)
+
+class BindingError(ValueError):
+    """A parameter value cannot be bound to its declared type."""
+
+    def __init__(self, name, message):
+        super(BindingError, self).__init__(f"Invalid value for parameter '{name}': {message}")
+        self.name = name
+
+def canonicalize_sql(sql):
+    """
+    Return the SQL with comments removed and whitespace collapsed to single
+    spaces, leaving string literals and quoted identifiers untouched.
+    """
+    def replace(match):
+        if match.group("literal") or match.group("identifier"):
+            return match.group(0)
+        return " "
+    return SQL_TOKENS.sub(replace, sql).strip().rstrip(";").rstrip()
+
+# %name% placeholders, and the quoted text they are never substituted into; a lone quote is unterminated
+PLACEHOLDER_TOKENS = re.compile(r"""
+    (?P<quoted>'(?:[^']|'')*'|"(?:[^"]|"")*")
+  | %(?P<placeholder>\w+)%
+  | (?P<unterminated>['"])
+""", re.VERBOSE)
+PLACEHOLDER_PATTERN = re.compile(r"%(\w+)%")
+
+def split_placeholders(sql):
+    """
+    Split SQL into the text around its %name% placeholders and their names,
+    as (segments, slots) with one more segment than slots. Placeholders are
+    only taken outside string literals and quoted identifiers, so a bound
+    value can never end up inside quotes; quoted text is kept as is.
+    Raises ValueError for an unterminated literal or identifier.
+    """
+    segments, slots = [""], []
+    position = 0
+    for match in PLACEHOLDER_TOKENS.finditer(sql):
+        if match.group("unterminated"):
+            raise ValueError("SQL has an unterminated quoted string or identifier")
+        segments[-1] += sql[position:match.start()]
+        position = match.end()
+        if match.group("placeholder"):
+            slots.append(match.group("placeholder"))
+            segments.append("")
+        else:
+            segments[-1] += match.group(0)
+    segments[-1] += sql[position:]
+    return tuple(segments), tuple(slots)
+
+def quoted_placeholders(sql):
+    """Names written as %name% inside string literals or quoted identifiers of the SQL."""
+    names = set()
+    for match in PLACEHOLDER_TOKENS.finditer(sql):
+        if match.group("quoted"):
+            names.update(PLACEHOLDER_PATTERN.findall(match.group("quoted")))
+    return names
+
+def quote_string(value):
+    """SQL string literal; embedded single quotes are doubled."""
+    return "'" + value.replace("'", "''") + "'"
+
+def quote_identifier(value):
+    """SQL quoted identifier; embedded double quotes are doubled."""
+    return '"' + value.replace('"', '""') + '"'
+
+def _check_identifier(name, value, spec):
+    if not isinstance(value, str):
+        raise BindingError(name, "expected an identifier string")
+    allowed = spec.get("allowed")
+    if allowed is not None:
+        if value not in allowed:
+            raise BindingError(name, f"'{value}' is not one of the allowed values")
+    elif not IDENTIFIER_PATTERN.match(value):
+        raise BindingError(name, f"'{value}' is not a valid identifier")
+    return value
+
+def _to_integer(name, value, bounds, type_name):
+    if isinstance(value, bool):
+        raise BindingError(name, f"expected {type_name}")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise BindingError(name, f"expected {type_name}")
+        value = int(value)
+    elif isinstance(value, str) and INTEGER_PATTERN.match(value.strip()):
+        value = int(value.strip())
+    elif not isinstance(value, int):
+        raise BindingError(name, f"expected {type_name}")
+    if not bounds[0] <= value <= bounds[1]:
+        raise BindingError(name, f"{value} is out of range for {type_name}")
+    return value
+
+def bind_column(name, value, spec):
+    return quote_identifier(_check_identifier(name, value, spec))
+
+def bind_table(name, value, spec):
+    # Table names stay unquoted (as before); they are validated or allowlisted instead
+    return _check_identifier(name, value, spec)
+
+def bind_string(name, value, spec):
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise BindingError(name, "expected a string")
+    value = str(value)
+    if "\x00" in value:
+        raise BindingError(name, "strings may not contain NUL characters")
+    allowed = spec.get("allowed")
+    if allowed is not None and value not in allowed:
+        raise BindingError(name, f"'{value}' is not one of the allowed values")
+    return quote_string(value)
+
+def bind_integer(name, value, spec):
+    return str(_to_integer(name, value, LONG_RANGE, "an integer"))
+
+def bind_long(name, value, spec):
+    return str(_to_integer(name, value, LONG_RANGE, "a long"))
+
+def bind_double(name, value, spec):
+    if isinstance(value, bool):
+        raise BindingError(name, "expected a number")
+    try:
+        number = float(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise BindingError(name, "expected a number")
+    if not math.isfinite(number):
+        raise BindingError(name, "expected a finite number")
+    return repr(number)
+
+def bind_bool(name, value, spec):
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int) and value in (0, 1):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return "TRUE" if value.strip().lower() == "true" else "FALSE"
+    raise BindingError(name, "expected a boolean")
+
+def bind_timestamp(name, value, spec):
+    """Timestamps are bound as epoch milliseconds, which Pinot compares with TIMESTAMP and LONG columns."""
+    if isinstance(value, bool):
+        raise BindingError(name, "expected a timestamp")
+    if isinstance(value, (int, float)) or (isinstance(value, str) and INTEGER_PATTERN.match(value.strip())):
+        return bind_long(name, value, spec)
+    if not isinstance(value, str):
+        raise BindingError(name, "expected a timestamp")
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise BindingError(name, "expected epoch milliseconds or an ISO 8601 timestamp")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return str(int(parsed.timestamp() * 1000))
+
+PARAMETER_BINDERS = {
+    "column": bind_column,
+    "table": bind_table,
+    "string": bind_string,
+    "integer": bind_integer,
+    "long": bind_long,
+    "double": bind_double,
+    "bool": bind_bool,
+    "timestamp": bind_timestamp,
+}
+
+# Element types that can be passed as lists and expand into IN (...) lists
+LIST_TYPES = frozenset(["string", "integer", "long", "double", "timestamp"])
+
+# Integer element binders, whose lists of plain ints are checked with one min/max
+INTEGER_RANGES = {bind_integer: LONG_RANGE, bind_long: LONG_RANGE}
+
+def list_literals(binder, name, value, spec):
+    """
+    Bind each value of a list with the element binder.
+    Returns the literals de-duplicated and sorted, which does not change the
+    meaning of IN but gives equal lists the same SQL and lets a long list be
+    split into disjoint slices.
+    Lists of plain ints and of strings without an allowlist skip the
+    per-value binder calls.
+    """
+    if not isinstance(value, (list, tuple)):
+        raise BindingError(name, "expected a list")
+    if not value:
+        raise BindingError(name, "expected a non-empty list")
+    bounds = INTEGER_RANGES.get(binder)
+    if bounds is not None and all(type(item) is int for item in value):
+        unique = set(value)
+        if bounds[0] <= min(unique) and max(unique) <= bounds[1]:
+            return sorted(map(str, unique))
+    elif (binder is bind_string and spec.get("allowed") is None
+          and all(type(item) is str for item in value)):
+        unique = set(value)
+        if not any("\x00" in item for item in unique):
+            return sorted(map(quote_string, unique))
+    # Mixed or out-of-range values: bind one by one, which also reports the invalid value
+    return sorted(set(binder(name, item, spec) for item in value))
+
+def bind_list(binder):
+    """Bind a list of values as a comma-separated list of literals for IN (...)."""
+    def bind(name, value, spec):
+        return ", ".join(list_literals(binder, name, value, spec))
+    return bind
+
+# List type -> binder of its elements
+LIST_ELEMENT_BINDERS = {f"{element}{LIST_SUFFIX}": PARAMETER_BINDERS[element] for element in LIST_TYPES}
+
+PARAMETER_BINDERS.update({list_type: bind_list(binder) for list_type, binder in LIST_ELEMENT_BINDERS.items()})
+
+def get_binder(param_type):
+    """Return the binder for a parameter type. Raises ValueError for unsupported types."""
+    binder = PARAMETER_BINDERS.get(param_type)
+    if binder is None:
+        raise ValueError(f"Unsupported parameter type: {param_type}")
+    return binder
@@ -0,0 +1,207 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = "least_outstanding"
+EWMA = "ewma"
+BALANCERS = (LEAST_OUTSTANDING, EWMA)
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Broker responses counted as failures of the broker itself, not of the query (a 500 can be a failed query)
+FAILURE_STATUSES = frozenset([502, 503, 504])
+# Failures after which a query is retried on another broker: the broker did not run it
+FAILOVER_STATUSES = frozenset([502, 503, 504])
+
+class BrokerUnavailable(Exception):
+    """Every broker is ejected by its circuit breaker, or was already tried for this request."""
+
+def parse_brokers(pinot_config):
+    """
+    Return the broker URLs of PINOT_CONFIG: "brokers" (a list or a comma-separated
+    string), else "broker", which may also hold several comma-separated URLs.
+    """
+    pinot_config = pinot_config or {}
+    brokers = pinot_config.get('brokers') or pinot_config.get('broker') or []
+    if isinstance(brokers, str):
+        brokers = brokers.split(",")
+    return [url.strip().rstrip("/") for url in brokers if url and url.strip()]
+
+class Broker(object):
+    """Load and health of one broker; only changed under the pool's lock."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_ms = None
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+        self.healthy = True
+        self.requests = 0
+        self.errors = 0
+
+    def describe(self):
+        return {"url": self.url, "state": self.state, "healthy": self.healthy, "outstanding": self.outstanding,
+                "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+                "consecutive_failures": self.failures, "requests": self.requests, "errors": self.errors}
+
+class BrokerPool(object):
+    """
+    Client-side load balancing and failure handling across Pinot brokers.
+    - Requests go to the available broker with the fewest outstanding requests
+      ("least_outstanding") or the lowest latency EWMA weighted by its
+      outstanding requests ("ewma"); ties are broken at random.
+    - A broker's circuit breaker opens after failure_threshold consecutive
+      failures (connection errors, timeouts, 5xx), ejecting it for
+      open_seconds. It then lets one trial request through (half-open) and
+      closes again when that succeeds.
+    - A background thread calls /health on every broker each probe_interval
+      seconds: brokers that do not answer are skipped, and an open breaker
+      whose broker answers again goes half-open early.
+    The pool is shared by the sync and asyncio clients of a process.
+    """
+
+    def __init__(self, urls, balancer=LEAST_OUTSTANDING, failure_threshold=5, open_seconds=30, ewma_alpha=0.3,
+                 probe_interval=10, probe_timeout=2):
+        if balancer not in BALANCERS:
+            raise ValueError(f"Unsupported broker balancer '{balancer}'. Must be one of {list(BALANCERS)}")
+        self.brokers = [Broker(url) for url in urls]
+        self.balancer = balancer
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.open_seconds = float(open_seconds)
+        self.ewma_alpha = float(ewma_alpha)
+        self.probe_interval = float(probe_interval)
+        self.probe_timeout = float(probe_timeout)
+        self._lock = threading.Lock()
+        self._prober = None
+        self._pid = None
+
+    @property
+    def urls(self):
+        return [broker.url for broker in self.brokers]
+
+    def _available(self, broker, now):
+        """Whether the broker's circuit breaker lets a request through."""
+        if broker.state == OPEN and now - broker.opened_at >= self.open_seconds:
+            broker.state, broker.trial = HALF_OPEN, False
+        if broker.state == OPEN:
+            return False
+        # One trial request at a time while half-open
+        return broker.state == CLOSED or not broker.trial
+
+    def _score(self, broker):
+        if self.balancer == EWMA:
+            # Unmeasured brokers score as the fastest, so each gets tried
+            return (broker.ewma_ms or 0.0) * (broker.outstanding + 1)
+        return broker.outstanding
+
+    def acquire(self, exclude=()):
+        """
+        Pick a broker for a request and count it as outstanding; the caller
+        must pass it to release(). Raises BrokerUnavailable.
+        :param exclude: Brokers already tried for this request.
+        """
+        self._ensure_prober()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [broker for broker in self.brokers
+                          if broker not in exclude and self._available(broker, now)]
+            if not candidates:
+                raise BrokerUnavailable("No Pinot broker is available")
+            # Health checks only steer traffic: if every broker fails them, still try one
+            candidates = [broker for broker in candidates if broker.healthy] or candidates
+            broker = min(candidates, key=lambda candidate: (self._score(candidate), random.random()))
+            if broker.state == HALF_OPEN:
+                broker.trial = True
+            broker.outstanding += 1
+            broker.requests += 1
+        return broker
+
+    def release(self, broker, elapsed, failed):
+        """
+        Record the outcome of a request sent to a broker by acquire().
+        :param failed: None for a request abandoned without an outcome, e.g. cancelled.
+        """
+        with self._lock:
+            broker.outstanding -= 1
+            if failed is None:
+                broker.trial = False
+                return
+            elapsed_ms = elapsed * 1000.0
+            if failed:
+                # Fast failures must not make a broker look fast: count them as twice the usual latency
+                self._update_ewma(broker, 2 * max(elapsed_ms, broker.ewma_ms or 0.0))
+                broker.errors += 1
+                broker.failures += 1
+                if broker.state == HALF_OPEN or broker.failures >= self.failure_threshold:
+                    if broker.state != OPEN:
+                        logger.warning(f"Pinot broker {broker.url} ejected after {broker.failures} failures")
+                    broker.state, broker.opened_at, broker.trial = OPEN, time.monotonic(), False
+                return
+            self._update_ewma(broker, elapsed_ms)
+            if broker.state != CLOSED:
+                logger.warning(f"Pinot broker {broker.url} restored")
+            broker.state, broker.failures, broker.trial = CLOSED, 0, False
+
+    def _update_ewma(self, broker, sample_ms):
+        broker.ewma_ms = sample_ms if broker.ewma_ms is None else (
+            self.ewma_alpha * sample_ms + (1 - self.ewma_alpha) * broker.ewma_ms)
+
+    def describe(self):
+        """Current state of every broker."""
+        with self._lock:
+            now = time.monotonic()
+            for broker in self.brokers:
+                self._available(broker, now)
+            return {"balancer": self.balancer, "brokers": [broker.describe() for broker in self.brokers]}
+
+    # Health probing
+
+    def _ensure_prober(self):
+        """Start the health probe thread for this process if it is not running."""
+        if self.probe_interval <= 0:
+            return
+        pid = os.getpid()
+        if self._prober is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._prober is not None and self._pid == pid:
+                return
+            self._pid = pid
+            self._prober = threading.Thread(target=self._run_prober, name="pinot-broker-probe", daemon=True)
+            self._prober.start()
+
+    def _run_prober(self):
+        session = requests.Session()
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe(session)
+            except Exception as e:
+                logger.warning(f"Pinot broker health probe failed: {str(e)}")
+
+    def probe(self, session=None):
+        """Call /health on every broker and record which ones answer."""
+        session = session or requests
+        for broker in self.brokers:
+            try:
+                # Any answer but a server error means the broker is up (it may want a token)
+                healthy = session.get(f"{broker.url}/health", timeout=self.probe_timeout).status_code < 500
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                if healthy != broker.healthy:
+                    logger.warning(f"Pinot broker {broker.url} health check {'passed' if healthy else 'failed'}")
+                broker.healthy = healthy
+                if healthy and broker.state == OPEN:
+                    broker.state, broker.trial = HALF_OPEN, False
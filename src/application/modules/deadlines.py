@@ -0,0 +1,93 @@
+import time
+from contextvars import ContextVar
+
+# Seconds the client is willing to wait for the response
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before Pinot answered."""
+
+class Deadline(object):
+    """
+    When the request being handled must be answered, on time.monotonic().
+    A deadline the client asked for is kept; otherwise the saved API's
+    timeout may replace the default.
+    """
+
+    def __init__(self, timeout, from_client=False, started=None):
+        self.started = time.monotonic() if started is None else started
+        self.expires = self.started + timeout
+        self.from_client = from_client
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+DEADLINE = ContextVar("deadline", default=None)
+
+def parse_timeout(value):
+    """Return a positive number of seconds from a header value, or None if it is missing or malformed."""
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return None
+    return timeout if 0 < timeout < float("inf") else None
+
+def start_deadline(header_value=None, default_timeout=30, max_timeout=300):
+    """
+    Start the deadline of the current request: the X-Request-Timeout it
+    was sent with, up to max_timeout, or default_timeout (0 for none).
+    """
+    timeout = parse_timeout(header_value)
+    if timeout is not None:
+        DEADLINE.set(Deadline(min(timeout, max_timeout) if max_timeout else timeout, from_client=True))
+    elif default_timeout:
+        DEADLINE.set(Deadline(float(default_timeout)))
+    else:
+        DEADLINE.set(None)
+
+def apply_api_timeout(timeout, max_timeout=None):
+    """
+    Use a saved API's timeout (seconds, up to max_timeout) for the current
+    request, unless the client set its own.
+    """
+    deadline = DEADLINE.get()
+    if not timeout or (deadline is not None and deadline.from_client):
+        return
+    timeout = min(float(timeout), max_timeout) if max_timeout else float(timeout)
+    DEADLINE.set(Deadline(timeout, started=deadline.started if deadline is not None else None))
+
+def limit_deadline(timeout):
+    """
+    Shorten the current deadline to at most timeout seconds from now; never
+    lengthens it. A batch query gets its saved API's timeout this way, so it
+    cannot outlast the batch.
+    """
+    if not timeout:
+        return
+    deadline = DEADLINE.get()
+    if deadline is not None and deadline.remaining() <= timeout:
+        return
+    DEADLINE.set(Deadline(float(timeout), from_client=deadline is not None and deadline.from_client))
+
+def remaining():
+    """Seconds left before the current request's deadline, or None without one."""
+    deadline = DEADLINE.get()
+    return deadline.remaining() if deadline is not None else None
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current request's deadline has passed; returns the seconds left, or None."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Query deadline exceeded")
+    return left
+
+def pinot_timeout_ms(margin_ms=100):
+    """
+    timeoutMs to send Pinot for the current request: the time left, less a
+    margin so the broker gives up, and says so, before the client does.
+    None without a deadline.
+    """
+    left = remaining()
+    if left is None:
+        return None
+    return max(int(left * 1000 - margin_ms), 1)
@@ -0,0 +1,180 @@
+import csv
+import io
+import json
+from operator import itemgetter
+from flask import Response
+from application.modules.streaming import stream_format
+
+JSON = "json"
+CSV = "csv"
+ARROW = "arrow"
+MSGPACK = "msgpack"
+
+MIMETYPES = {
+    JSON: "application/json",
+    CSV: "text/csv",
+    ARROW: "application/vnd.apache.arrow.stream",
+    MSGPACK: "application/msgpack",
+}
+
+# Accept header media types, in order of preference when several are listed
+ACCEPT_TYPES = (
+    ("application/vnd.apache.arrow.stream", ARROW),
+    ("application/msgpack", MSGPACK),
+    ("application/x-msgpack", MSGPACK),
+    ("text/csv", CSV),
+)
+
+class FormatUnavailable(Exception):
+    """The requested output format needs an optional package that is not installed."""
+
+def output_format(format_param, accept=None):
+    """
+    Return the requested output format for a query result, or None for the default JSON.
+    :param format_param: Value of the `format` query parameter, if any.
+    :param accept: Accept header, used when no `format` is given.
+    Raises ValueError for an unknown `format` value.
+    """
+    if format_param is not None:
+        value = format_param.strip().lower()
+        if value not in MIMETYPES:
+            raise ValueError(f"'format' must be one of {', '.join(MIMETYPES)}")
+        return None if value == JSON else value
+    if accept:
+        for media_type, fmt in ACCEPT_TYPES:
+            if media_type in accept:
+                return fmt
+    return None
+
+def requested_output(stream_param, format_param, accept=None):
+    """
+    Return (streaming format, output format) for a query or execute request;
+    at most one of them is set.
+    Raises ValueError for unknown values or when both are requested.
+    """
+    streamed = stream_format(stream_param, accept)
+    fmt = output_format(format_param, accept)
+    if streamed and fmt:
+        raise ValueError("'stream' cannot be combined with a 'format' other than json")
+    return streamed, fmt
+
+def result_columns(result_table):
+    """
+    Return (column names, Pinot column types, columns) for a resultTable.
+    Each column is gathered with a C-level map(itemgetter), not cell by cell.
+    """
+    schema = result_table.get("dataSchema", {})
+    names = list(schema.get("columnNames", []))
+    types = list(schema.get("columnDataTypes", []))
+    rows = result_table.get("rows", [])
+    width = len(rows[0]) if rows else len(names)
+    columns = [list(map(itemgetter(index), rows)) for index in range(width)]
+    return names, types, columns
+
+def to_csv(result_table):
+    """
+    CSV with a header row. Uses Arrow's vectorized CSV writer when pyarrow
+    is installed; array columns (written as JSON arrays) and installs without
+    pyarrow use the csv module. Booleans are written as true/false either way.
+    """
+    names, types, columns = result_columns(result_table)
+    has_arrays = any(column_type.endswith("_ARRAY") for column_type in types)
+    if not has_arrays:
+        try:
+            import pyarrow.csv
+        except ImportError:
+            pass
+        else:
+            sink = pyarrow.BufferOutputStream()
+            pyarrow.csv.write_csv(arrow_batch(pyarrow, names, types, columns), sink)
+            return sink.getvalue().to_pybytes()
+
+    encoders = {"BOOLEAN": lambda value: value if value is None else ("true" if value else "false")}
+    columns = [list(map(json.dumps, column)) if column_type.endswith("_ARRAY")
+               else list(map(encoders[column_type], column)) if column_type in encoders
+               else column
+               for column, column_type in zip(columns, types + [""] * (len(columns) - len(types)))]
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(names)
+    writer.writerows(zip(*columns))
+    return output.getvalue().encode("utf-8")
+
+def to_msgpack(result_table):
+    """MessagePack map of {columnNames, columnDataTypes, columns}, one list per column."""
+    try:
+        import msgpack
+    except ImportError:
+        raise FormatUnavailable("MessagePack output requires the 'msgpack' package")
+    names, types, columns = result_columns(result_table)
+    return msgpack.packb({"columnNames": names, "columnDataTypes": types, "columns": columns})
+
+def arrow_type(pa, pinot_type):
+    """Arrow type for a Pinot column type, or None to let Arrow infer it."""
+    if pinot_type.endswith("_ARRAY"):
+        element = arrow_type(pa, pinot_type[:-len("_ARRAY")])
+        return pa.list_(element) if element is not None else None
+    return {
+        "INT": pa.int32(),
+        "LONG": pa.int64(),
+        "FLOAT": pa.float32(),
+        "DOUBLE": pa.float64(),
+        "BOOLEAN": pa.bool_(),
+        "STRING": pa.string(),
+        "JSON": pa.string(),
+        "BYTES": pa.string(),  # Pinot returns bytes hex-encoded
+        "BIG_DECIMAL": pa.string(),  # Pinot returns decimals as strings
+        "TIMESTAMP": pa.string(),  # Pinot returns timestamps as formatted strings
+    }.get(pinot_type)
+
+def arrow_batch(pa, names, types, columns):
+    """Build a record batch with one typed Arrow array per column."""
+    types = types + [""] * (len(columns) - len(types))
+    arrays = [pa.array(column, type=arrow_type(pa, column_type)) for column, column_type in zip(columns, types)]
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+def to_arrow(result_table):
+    """Arrow IPC stream holding one record batch with a typed array per column."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise FormatUnavailable("Arrow output requires the 'pyarrow' package")
+    batch = arrow_batch(pa, *result_columns(result_table))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+ENCODERS = {
+    CSV: to_csv,
+    ARROW: to_arrow,
+    MSGPACK: to_msgpack,
+}
+
+def render_result(pinot_response, fmt):
+    """
+    Encode the resultTable of a Pinot response in the given format.
+    Returns (body bytes, mimetype), or None when the response has no
+    resultTable (e.g. it only carries query exceptions) and should be
+    returned as JSON instead.
+    Raises FormatUnavailable if the format's optional package is missing.
+    """
+    result_table = pinot_response.get("resultTable")
+    if not isinstance(result_table, dict):
+        return None
+    return ENCODERS[fmt](result_table), MIMETYPES[fmt]
+
+def format_response(pinot_response, fmt):
+    """
+    Build a Flask response holding a Pinot result in the given format, or
+    return None if it has no resultTable to convert. The number of query
+    exceptions, if any, is sent in the X-Pinot-Exceptions header.
+    """
+    rendered = render_result(pinot_response, fmt)
+    if rendered is None:
+        return None
+    payload, mimetype = rendered
+    response = Response(payload, mimetype=mimetype)
+    if pinot_response.get("exceptions"):
+        response.headers["X-Pinot-Exceptions"] = str(len(pinot_response["exceptions"]))
+    return response
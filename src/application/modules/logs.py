@@ -0,0 +1,215 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import uuid
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Correlation id of the request being handled, attached to every log record
+REQUEST_ID = ContextVar("request_id", default=None)
+# Whether INFO and DEBUG records of the current request are written (see LogSampler)
+SAMPLED = ContextVar("log_sampled", default=True)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Incoming ids are kept only if they are short and plain
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# Literals replaced by "?" in SQL fingerprints
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+SQL_VALUE_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+SQL_WHITESPACE = re.compile(r"\s+")
+
+# Attributes every LogRecord has; anything else was passed in `extra` and is written as a field
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id"}
+
+def set_request_id(value=None):
+    """Use the given request id, or a new one if it is missing or malformed, for this context. Returns it."""
+    if not value or not REQUEST_ID_PATTERN.match(value):
+        value = uuid.uuid4().hex
+    REQUEST_ID.set(value)
+    return value
+
+def get_request_id():
+    return REQUEST_ID.get()
+
+def bind_context(func):
+    """
+    Wrap func to run in a copy of the caller's context (request id, log
+    sampling, metric labels), for running it on a worker thread.
+    """
+    context = copy_context()
+    def run(*args, **kwargs):
+        # Each call gets its own copy: one context cannot be entered by two threads at once
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+def sql_fields(sql, max_length=200):
+    """
+    Log fields describing a query without writing it out in full:
+    - sql: the query with literals replaced by "?" and value lists collapsed,
+      cut to max_length characters.
+    - sql_hash: hash of the full query text, to tell queries with the same
+      fingerprint apart.
+    """
+    fingerprint = SQL_VALUE_LISTS.sub("(?, ...)", SQL_LITERALS.sub("?", SQL_WHITESPACE.sub(" ", sql).strip()))
+    if len(fingerprint) > max_length:
+        fingerprint = fingerprint[:max_length] + "..."
+    return {"sql": fingerprint, "sql_hash": hashlib.sha256(sql.encode("utf-8")).hexdigest()[:16]}
+
+class LogSampler(object):
+    """
+    Per-route sampling of request logs, and how much SQL they include.
+    Each request is sampled once, when it starts; WARNING and above are
+    always written.
+    :param rates: {route rule: fraction of requests logged}, e.g. {"/v1/execute/api/<name>": 0.1}
+    """
+
+    def __init__(self, rates=None, default_rate=1.0, sql_max_length=200):
+        self.rates = dict(rates or {})
+        self.default_rate = float(default_rate)
+        self.sql_max_length = int(sql_max_length)
+
+    def start(self, route):
+        """Decide whether the request for this route is logged, for the current context."""
+        rate = self.rates.get(route, self.default_rate)
+        SAMPLED.set(rate >= 1 or (rate > 0 and random.random() < rate))
+
+    def log_query(self, logger, message, sql, **fields):
+        """Log a query at INFO with its SQL fingerprint; skips building the record for unsampled requests."""
+        if SAMPLED.get() and logger.isEnabledFor(logging.INFO):
+            fields.update(sql_fields(sql, self.sql_max_length))
+            logger.info(message, extra=fields)
+
+class ContextFilter(logging.Filter):
+    """Adds the request id to records and drops INFO and DEBUG records of unsampled requests."""
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and not SAMPLED.get():
+            return False
+        record.request_id = REQUEST_ID.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message, request_id and any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue for the writer thread; when the queue is
+    full the record is dropped rather than blocking the request.
+    """
+
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only resolve what cannot cross threads; formatting is left to the writer thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class AsyncLogging(object):
+    """
+    Queue-backed logging: request threads only enqueue records, and a
+    background thread writes them to the target handler. A forked worker
+    starts its own queue and writer thread.
+    """
+
+    def __init__(self, target, queue_size=10000):
+        self.target = target
+        self.queue_size = int(queue_size)
+        self.handler = DroppingQueueHandler(queue.Queue(self.queue_size))
+        self.handler.addFilter(ContextFilter())
+        self.listener = QueueListener(self.handler.queue, target, respect_handler_level=True)
+        self.listener.start()
+        self.closed = False
+        atexit.register(self.stop)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._restart)
+
+    def _restart(self):
+        if self.closed:
+            return
+        # The parent's writer thread does not exist in the child
+        self.handler.queue = queue.Queue(self.queue_size)
+        self.listener = QueueListener(self.handler.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write the queued records and stop the writer thread."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        """Write the queued records, stop the writer thread for good and close the target."""
+        self.closed = True
+        self.stop()
+        atexit.unregister(self.stop)
+        self.target.close()
+
+# The AsyncLogging that configure_logging installed on the root logger
+_root_logging = None
+
+def configure_logging(app):
+    """
+    Send the root logger (and with it app.logger and every module logger)
+    through an AsyncLogging queue to LOGGING_LOCATION, as JSON lines unless
+    LOGGING_CONFIG["json"] is False. Sets up per-route sampling.
+    An AsyncLogging installed by an earlier call (e.g. a previous app in
+    the same process) is removed and closed.
+    """
+    global _root_logging
+    config = app.config.get('LOGGING_CONFIG') or {}
+    target = logging.FileHandler(app.config['LOGGING_LOCATION'])
+    target.setLevel(app.config['LOGGING_LEVEL'])
+    if config.get('json', True):
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(app.config['LOGGING_FORMAT']))
+
+    async_logging = AsyncLogging(target, config.get('queue_size', 10000))
+    root = logging.getLogger()
+    root.addHandler(async_logging.handler)
+    if _root_logging is not None:
+        root.removeHandler(_root_logging.handler)
+        _root_logging.close()
+    _root_logging = async_logging
+    root.setLevel(app.config['LOGGING_LEVEL'])
+    app.logger.setLevel(app.config['LOGGING_LEVEL'])
+    app.extensions['logging'] = async_logging
+    app.extensions['log_sampler'] = LogSampler(config.get('sample_rates'), config.get('default_sample_rate', 1.0),
+                                               config.get('sql_max_length', 200))
+    return async_logging
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextvars import ContextVar
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Seconds; covers in-process cache hits up to slow Pinot queries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUEST_SECONDS = "query_wrapper_request_duration_seconds"
+REQUESTS_TOTAL = "query_wrapper_requests_total"
+STAGE_SECONDS = "query_wrapper_stage_duration_seconds"
+RESULT_CACHE_TOTAL = "query_wrapper_result_cache_requests_total"
+PINOT_ERRORS_TOTAL = "query_wrapper_pinot_errors_total"
+PINOT_FAILOVERS_TOTAL = "query_wrapper_pinot_failovers_total"
+ADMISSION_REJECTED_TOTAL = "query_wrapper_admission_rejected_total"
+SINGLEFLIGHT_CALLS_TOTAL = "query_wrapper_singleflight_calls_total"
+BOOT_SECONDS = "query_wrapper_boot_seconds"
+WARMUP_TEMPLATES = "query_wrapper_warmup_templates"
+
+# Stages of a request timed in STAGE_SECONDS
+TOKEN_VALIDATION = "token_validation"
+REGISTRY_LOOKUP = "registry_lookup"
+TEMPLATE_BINDING = "template_binding"
+PINOT = "pinot"
+SERIALIZATION = "serialization"
+
+# Roles of a query in SINGLEFLIGHT_CALLS_TOTAL
+LEADER = "leader"
+COALESCED_LOCAL = "local"
+COALESCED_REMOTE = "remote"
+
+# (type, help, label names) of every metric family
+STANDARD_METRICS = {
+    REQUEST_SECONDS: (HISTOGRAM, "Time to handle a request, until its response starts.", ("endpoint", "method")),
+    REQUESTS_TOTAL: (COUNTER, "Requests handled, by response status.", ("endpoint", "method", "status")),
+    # Not labelled by version: every update of a saved API would add a histogram family that is never removed
+    STAGE_SECONDS: (HISTOGRAM, "Time spent in each stage of a query request.", ("stage", "api")),
+    RESULT_CACHE_TOTAL: (COUNTER, "Result cache lookups of saved APIs, by outcome.", ("result", "api", "version")),
+    PINOT_ERRORS_TOTAL: (COUNTER, "Failed Pinot broker calls, by HTTP status ('error' for connection failures).",
+                         ("status", "api", "version")),
+    PINOT_FAILOVERS_TOTAL: (COUNTER, "Pinot requests retried on another broker, by the broker that failed.",
+                            ("broker",)),
+    ADMISSION_REJECTED_TOTAL: (COUNTER, "Requests rejected with 429, by reason (token_rate, api_rate, concurrency).",
+                               ("reason",)),
+    SINGLEFLIGHT_CALLS_TOTAL: (COUNTER, "Coalesced queries, by role: leader (sent to Pinot), local (waited on a call in "
+                                        "this worker) or remote (read another worker's result).", ("role",)),
+    BOOT_SECONDS: (GAUGE, "Time spent starting the app, by phase (import, warmup, create_app).", ("phase",)),
+    WARMUP_TEMPLATES: (GAUGE, "Saved API templates preloaded into the template cache at boot.", ()),
+}
+
+# (API name, version) of the saved query the current request or worker is running
+API_LABELS = ContextVar("api_labels", default=("", ""))
+
+def set_api_labels(name, version):
+    """Label metrics recorded from now on in this context with a saved API's name and version."""
+    API_LABELS.set((name or "", version or ""))
+
+def clear_api_labels():
+    API_LABELS.set(("", ""))
+
+class _Timer(object):
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, self.labels)
+
+class _ShardOwner(object):
+    """Held only by its thread's local storage: collected, and its shard retired, when the thread ends."""
+    __slots__ = ("__weakref__",)
+
+def _merge(totals, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            total = totals.get(key)
+            totals[key] = list(value) if total is None else [a + b for a, b in zip(total, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels_text(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metrics(object):
+    """
+    Process-local counters and histograms, exposed in the Prometheus text format.
+    - Recording takes no locks: every thread writes only to its own shard, a
+      dict of (metric, label values) -> value.
+    - render() sums the shards of all threads. When a thread ends its shard
+      is folded into a retired total, so there are never more shards than
+      live threads.
+    - A forked worker starts from empty shards, but keeps the gauges set
+      before the fork (boot timings recorded in a pre-forking master).
+    Each worker process reports its own values, so every worker is a separate
+    scrape target.
+    """
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(float(bound) for bound in buckets)
+        self.definitions = dict(STANDARD_METRICS)
+        self._local = threading.local()
+        # id(shard) -> shard of each live thread
+        self._shards = {}
+        # Summed shards of finished threads
+        self._retired = {}
+        self._gauges = {}
+        # Only taken when a thread starts or stops recording and on render, never on the hot path
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            owner = self._local.owner = _ShardOwner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(owner, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        """Fold a finished thread's shard into the retired total."""
+        with self._lock:
+            # Shards from before a fork were dropped by _reset
+            if self._shards.pop(id(shard), None) is shard:
+                _merge(self._retired, shard)
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter. Labels are a tuple of values, in the order of the metric's label names."""
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """Record a value (in seconds for timings) in a histogram."""
+        if not self.enabled:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        cell = shard.get(key)
+        if cell is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            cell = shard[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def set_gauge(self, name, value, labels=()):
+        """Set a gauge; for rarely set, process-wide values such as boot timings."""
+        if not self.enabled:
+            return
+        self._gauges[(name, labels)] = value
+
+    def timer(self, name, labels=()):
+        """Context manager recording the time spent in its block in a histogram."""
+        return _Timer(self, name, labels)
+
+    def stage(self, stage):
+        """Timer for a stage of the current request, labelled with its saved API's name."""
+        return _Timer(self, STAGE_SECONDS, (stage, API_LABELS.get()[0]))
+
+    def count_api(self, name, value):
+        """Increment a counter labelled with a value and the current saved API's name and version."""
+        self.inc(name, (value,) + API_LABELS.get())
+
+    def collect(self):
+        """Return (metric, label values) -> value, summed over all threads, and the gauges."""
+        totals = {}
+        with self._lock:
+            shards = list(self._shards.values())
+            _merge(totals, self._retired)
+        for shard in shards:
+            # dict.copy() runs without releasing the GIL, so it never sees a half-updated shard
+            _merge(totals, shard.copy())
+        totals.update(self._gauges)
+        return totals
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format (version 0.0.4)."""
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(self.definitions):
+            kind, help_text, label_names = self.definitions[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name.get(name, []), key=lambda item: item[0]):
+                if kind in (COUNTER, GAUGE):
+                    lines.append(f"{name}{_labels_text(label_names, labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    bucket_labels = _labels_text(label_names, labels, 'le="' + le + '"')
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_labels_text(label_names, labels)} {_format_value(value[-2])}")
+                lines.append(f"{name}_count{_labels_text(label_names, labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
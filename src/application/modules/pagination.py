@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import re
+import uuid
+from collections import namedtuple
+from application.modules.serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# A LIMIT clause ending the query: "LIMIT n", "LIMIT n OFFSET m" or "LIMIT m, n"
+TRAILING_LIMIT = re.compile(r"\s+LIMIT\s+(\d+)(?:\s*,\s*(\d+)|\s+OFFSET\s+(\d+))?\s*;?\s*$", re.IGNORECASE)
+
+PageRequest = namedtuple('PageRequest', ['size', 'cursor', 'store'])
+PageCursor = namedtuple('PageCursor', ['version', 'sql_hash', 'offset', 'size', 'store_id', 'stored', 'more'])
+
+def sql_hash(sql):
+    """Short fingerprint tying a cursor to the rendered SQL it pages through."""
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()[:32]
+
+def window_sql(sql, offset, count):
+    """
+    Rewrite a query to return `count` rows starting at `offset`.
+    A LIMIT already ending the query bounds the window: offsets are relative
+    to it and no rows past it are returned.
+    Returns (sql, count actually requested).
+    """
+    match = TRAILING_LIMIT.search(sql)
+    if match is None:
+        base, base_offset, base_limit = sql.rstrip().rstrip(";"), 0, None
+    elif match.group(2) is not None:
+        base, base_offset, base_limit = sql[:match.start()], int(match.group(1)), int(match.group(2))
+    else:
+        base, base_offset, base_limit = sql[:match.start()], int(match.group(3) or 0), int(match.group(1))
+    if base_limit is not None:
+        count = max(min(count, base_limit - offset), 0)
+    # A new line ends any trailing "--" comment
+    return f"{base}\nLIMIT {count} OFFSET {base_offset + offset}", count
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class CursorCodec(object):
+    """
+    Encodes page cursors as opaque, HMAC-signed tokens, so clients cannot
+    forge offsets into another query or point at another caller's stored result.
+    """
+
+    def __init__(self, secret):
+        self.secret = (secret or "").encode("utf-8")
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:16]
+
+    def encode(self, cursor):
+        payload = json.dumps(list(cursor), separators=(",", ":")).encode("utf-8")
+        return f"{_b64encode(payload)}.{_b64encode(self._sign(payload))}"
+
+    def decode(self, token):
+        """Return the PageCursor for a token. Raises ValueError if it is malformed or was tampered with."""
+        try:
+            payload_text, signature_text = token.split(".", 1)
+            payload = _b64decode(payload_text)
+            signature = _b64decode(signature_text)
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise ValueError("Invalid cursor")
+        try:
+            return PageCursor(*json.loads(payload))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+
+def parse_page_request(args, codec, max_page_size):
+    """
+    Read page_size, cursor and store from the query string. page_size
+    defaults to the size the cursor was issued for.
+    Returns a PageRequest, or None when the request is not paginated.
+    Raises ValueError for invalid values.
+    """
+    size, token, store = args.get('page_size'), args.get('cursor'), args.get('store')
+    if size is None and not token:
+        if store is not None:
+            raise ValueError("'store' requires 'page_size'")
+        return None
+    cursor = codec.decode(token) if token else None
+    if size is None:
+        size = cursor.size
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise ValueError("'page_size' must be an integer")
+    if size < 1 or size > max_page_size:
+        raise ValueError(f"'page_size' must be between 1 and {max_page_size}")
+    return PageRequest(size, cursor, (store or "").lower() in ("1", "true"))
+
+class ResultStore(object):
+    """
+    Short-lived Redis store for full query results that are read page by page.
+    - Rows are kept as a Redis list of JSON rows, so a page is one LRANGE.
+    - The rest of the response (schema, stats) is kept next to them.
+    - Keys are scoped by the caller (token hash) and expire after `ttl` seconds.
+    """
+
+    def __init__(self, redis_client, ttl=300, max_rows=100000, key_prefix="pages:", batch_size=1000):
+        self.redis_client = redis_client
+        self.ttl = float(ttl)
+        self.max_rows = int(max_rows)
+        self.key_prefix = key_prefix
+        self.batch_size = int(batch_size)
+
+    def _keys(self, scope, store_id):
+        key = f"{self.key_prefix}{scope}:{store_id}"
+        return key, f"{key}:meta"
+
+    def save(self, scope, pinot_response, rows):
+        """Store the rows and metadata of a result; returns its store id, or None if Redis failed."""
+        store_id = uuid.uuid4().hex
+        rows_key, meta_key = self._keys(scope, store_id)
+        metadata = dict(pinot_response)
+        result_table = dict(metadata.get("resultTable") or {})
+        result_table.pop("rows", None)
+        metadata["resultTable"] = result_table
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for start in range(0, len(rows), self.batch_size):
+                pipe.rpush(rows_key, *[dumps(row) for row in rows[start:start + self.batch_size]])
+            pipe.set(meta_key, dumps(metadata), px=ttl_ms)
+            if rows:
+                pipe.pexpire(rows_key, ttl_ms)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Result store write failed: {str(e)}")
+            return None
+        return store_id
+
+    def read(self, scope, store_id, offset, count):
+        """Return (response without rows, page rows), or None once the result has expired."""
+        rows_key, meta_key = self._keys(scope, store_id)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(meta_key)
+            pipe.lrange(rows_key, offset, offset + count - 1)
+            metadata, rows = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Result store read failed: {str(e)}")
+            return None
+        if metadata is None:
+            return None
+        return loads(metadata), [loads(row) for row in rows]
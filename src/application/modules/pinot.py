@@ -0,0 +1,257 @@
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from application.modules.metrics import Metrics, PINOT, PINOT_ERRORS_TOTAL, PINOT_FAILOVERS_TOTAL
+from application.modules.brokers import BrokerPool, BrokerUnavailable, FAILOVER_STATUSES, FAILURE_STATUSES, parse_brokers
+from application.modules.logs import REQUEST_ID_HEADER, get_request_id, sql_fields
+from application.modules.deadlines import DeadlineExceeded, check_deadline, pinot_timeout_ms
+from application.modules.serialization import decode_response
+
+logger = logging.getLogger(__name__)
+
+class PinotQueryError(Exception):
+    """The broker answered a query with a non-200 status."""
+
+    def __init__(self, status_code, details):
+        super(PinotQueryError, self).__init__(f"Pinot returned status {status_code}")
+        self.status_code = status_code
+        self.details = details
+
+def query_headers(token):
+    """Headers of a query request; the request id lets broker logs be matched with ours."""
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
+    request_id = get_request_id()
+    if request_id is not None:
+        headers[REQUEST_ID_HEADER] = request_id
+    return headers
+
+def query_body(sql, margin_ms=100, client_query_id=None):
+    """
+    JSON body of a query request. The time left before the request's
+    deadline is passed as the timeoutMs query option, so Pinot stops
+    working on the query once nobody is waiting for it.
+    """
+    body = {"sql": sql}
+    options = []
+    timeout_ms = pinot_timeout_ms(margin_ms)
+    if timeout_ms is not None:
+        options.append(f"timeoutMs={timeout_ms}")
+    if client_query_id is not None:
+        options.append(f"clientQueryId={client_query_id}")
+    if options:
+        body["queryOptions"] = ";".join(options)
+    return body
+
+class PinotClient(object):
+    """
+    Pooled, keep-alive HTTP client for the Pinot brokers.
+    - One requests.Session per worker process, shared by all of its threads.
+    - Connection pool size, connect/read timeouts and retries are configurable.
+    - Each request goes to a broker picked by the BrokerPool. A request that
+      cannot connect, or gets 502-504, fails over to another broker up to
+      max_failovers times; with a single broker, connection failures are
+      retried on it instead.
+    - Read and 5xx failures are only retried for idempotent methods (GET/HEAD).
+    - Timeouts are cut to the time left before the request's deadline,
+      which is also sent to Pinot as timeoutMs; DeadlineExceeded is raised
+      once it has passed.
+    - Query round trips and failures are recorded in the metrics registry.
+    """
+
+    def __init__(self, pinot_config, client_config=None, metrics=None, broker_pool=None):
+        client_config = client_config or {}
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.broker_pool = broker_pool if broker_pool is not None else BrokerPool(parse_brokers(pinot_config),
+                                                                                  probe_interval=0)
+        self.max_failovers = int(client_config.get('max_failovers', 2))
+        self.pool_size = int(client_config.get('pool_size', 10))
+        self.timeout = (float(client_config.get('connect_timeout', 3.05)),
+                        float(client_config.get('read_timeout', 60)))
+        self.max_retries = int(client_config.get('max_retries', 3))
+        self.backoff_factor = float(client_config.get('backoff_factor', 0.3))
+        self.timeout_margin_ms = float(client_config.get('timeout_margin_ms', 100))
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _build_session(self):
+        """Create a session with a pooled adapter mounted for http and https."""
+        retry = Retry(
+            total=self.max_retries,
+            # With several brokers, an unreachable one is left to failover rather than retried
+            connect=self.max_retries if len(self.broker_pool.brokers) <= 1 else 0,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=max(len(self.broker_pool.brokers), 1), pool_maxsize=self.pool_size,
+                              max_retries=retry, pool_block=True)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """
+        Return the session for the current process.
+        Sessions are never shared across a fork, so a uWSGI worker forked from
+        the master opens its own sockets instead of reusing the parent's.
+        """
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._build_session()
+                    self._pid = pid
+        return self._session
+
+    @property
+    def broker_url(self):
+        """The first configured broker, or None when none is configured."""
+        return self.broker_pool.brokers[0].url if self.broker_pool.brokers else None
+
+    def request_timeout(self):
+        """
+        Return the (connect, read) timeouts of the next attempt, cut to the
+        time left before the request's deadline, and whether they were cut.
+        Raises DeadlineExceeded.
+        """
+        left = check_deadline()
+        if left is None or left >= self.timeout[1]:
+            return self.timeout, False
+        return (min(self.timeout[0], left), left), True
+
+    def send(self, method, path, **kwargs):
+        """
+        Send a request to a broker picked by the pool, failing over to another
+        broker when one cannot be reached or answers 502-504. Returns the last
+        response, or raises the last connection error, or DeadlineExceeded.
+        """
+        if not self.broker_pool.brokers:
+            raise ValueError("Pinot broker URL is missing in the configuration")
+        tried, failed_response, error = [], None, None
+        for attempt in range(self.max_failovers + 1):
+            try:
+                timeout, cut = self.request_timeout()
+            except DeadlineExceeded:
+                if failed_response is not None:
+                    failed_response.close()
+                raise
+            try:
+                broker = self.broker_pool.acquire(tried)
+            except BrokerUnavailable as e:
+                # Report what went wrong with the brokers already tried, if any
+                if failed_response is not None:
+                    return failed_response
+                raise error or requests.ConnectionError(str(e))
+            if failed_response is not None:
+                failed_response.close()
+            if tried:
+                self.metrics.inc(PINOT_FAILOVERS_TOTAL, (tried[-1].url,))
+            tried.append(broker)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, f"{broker.url}{path}", timeout=timeout, **kwargs)
+            except requests.ConnectTimeout as e:
+                if cut and timeout[0] < self.timeout[0]:
+                    # Connecting was cut short by the deadline, which says nothing about the broker
+                    self.broker_pool.release(broker, time.perf_counter() - started, None)
+                    raise DeadlineExceeded("Query deadline exceeded") from e
+                # The broker could not be reached, so it never saw the query
+                self.broker_pool.release(broker, time.perf_counter() - started, True)
+                error = e
+                if attempt < self.max_failovers:
+                    continue
+                raise
+            except requests.Timeout as e:
+                if not cut:
+                    self.broker_pool.release(broker, time.perf_counter() - started, True)
+                    raise
+                # The request ran out of time, which says nothing about the broker
+                self.broker_pool.release(broker, time.perf_counter() - started, None)
+                raise DeadlineExceeded("Query deadline exceeded") from e
+            except requests.RequestException as e:
+                self.broker_pool.release(broker, time.perf_counter() - started, True)
+                error = e
+                # Only a failed connection is certain not to have reached the broker
+                if isinstance(e, requests.ConnectionError) and attempt < self.max_failovers:
+                    continue
+                raise
+            self.broker_pool.release(broker, time.perf_counter() - started, response.status_code in FAILURE_STATUSES)
+            if response.status_code not in FAILOVER_STATUSES or attempt == self.max_failovers:
+                return response
+            failed_response = response
+        return failed_response
+
+    def query(self, sql, token):
+        """Send a SQL query to a broker and return the raw response."""
+        return self.send("POST", "/query/sql", json=query_body(sql, self.timeout_margin_ms),
+                         headers=query_headers(token))
+
+    def fetch(self, sql, token):
+        """
+        Run a SQL query and return (response, response body bytes). The
+        response is left undecoded (RawJSON) in passthrough mode.
+        Raises PinotQueryError for non-200 responses.
+        """
+        try:
+            with self.metrics.stage(PINOT):
+                response = self.query(sql, token)
+        except DeadlineExceeded:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "deadline")
+            logger.warning("Pinot query deadline exceeded", extra=sql_fields(sql))
+            raise
+        except requests.RequestException as e:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "error")
+            logger.warning(f"Pinot query failed: {str(e)}", extra=sql_fields(sql))
+            raise
+        if response.status_code != 200:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, str(response.status_code))
+            logger.warning(f"Pinot returned status {response.status_code}", extra=sql_fields(sql))
+            raise PinotQueryError(response.status_code, response.text)
+        return decode_response(response.content), response.content
+
+    def stream(self, sql, token):
+        """
+        Run a SQL query and return the response with its body still unread,
+        for iterating with iter_content(). The caller must close it.
+        Raises PinotQueryError for non-200 responses.
+        """
+        try:
+            # Timed until the response headers arrive
+            with self.metrics.stage(PINOT):
+                response = self.send("POST", "/query/sql", json=query_body(sql, self.timeout_margin_ms),
+                                     headers=query_headers(token), stream=True)
+        except DeadlineExceeded:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "deadline")
+            raise
+        except requests.RequestException:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, "error")
+            raise
+        if response.status_code != 200:
+            self.metrics.count_api(PINOT_ERRORS_TOTAL, str(response.status_code))
+            try:
+                raise PinotQueryError(response.status_code, response.text)
+            finally:
+                response.close()
+        return response
+
+    def health(self, token):
+        """Call the health endpoint of a broker with the given bearer token."""
+        return self.send("GET", "/health", headers={"Authorization": f"Bearer {token}"})
+
+    def close(self):
+        """Close the pooled connections held by this process."""
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
@@ -0,0 +1,285 @@
+import atexit
+import logging
+import math
+import os
+import threading
+import time
+from application.modules.logs import sql_fields
+from application.modules.serialization import dumps, has_exceptions, loads, number_fields
+
+logger = logging.getLogger(__name__)
+
+# Pinot response statistics added up per API, version and time bucket
+SUMMED_FIELDS = (
+    "timeUsedMs", "numDocsScanned", "numEntriesScannedInFilter", "numEntriesScannedPostFilter",
+    "numServersQueried", "numServersResponded", "numSegmentsQueried", "numSegmentsProcessed",
+    "numSegmentsMatched",
+)
+
+# Log-spaced histogram buckets: bucket i holds values in (factor ** (i - 1), factor ** i]
+LATENCY_FACTOR = 1.25
+DOCS_FACTOR = 2.0
+
+# Rollup resolutions: (name, bucket seconds)
+MINUTE = ("m", 60)
+HOUR = ("h", 3600)
+
+PERCENTILES = (50, 95, 99)
+# Characters of the query kept in a slow-log entry: its shape, and its full text when log_raw_sql is set
+MAX_LOGGED_SQL = 4000
+
+def histogram_bucket(value, factor):
+    """Index of the log-spaced bucket holding a non-negative value; 0 holds values up to 1."""
+    if value <= 1:
+        return 0
+    return int(math.ceil(math.log(value) / math.log(factor) - 1e-9))
+
+def percentile(histogram, factor, q):
+    """
+    Estimate the q-th percentile from {bucket index: count}, interpolating
+    linearly inside the bucket it falls in. Returns None for an empty histogram.
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = total * q / 100.0
+    seen = 0
+    for index in sorted(histogram):
+        count = histogram[index]
+        if seen + count >= rank:
+            lower = 0.0 if index == 0 else factor ** (index - 1)
+            upper = factor ** index
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return factor ** max(histogram)
+
+class QueryStats(object):
+    """
+    Cost of the Pinot queries run for each saved API and version, from the
+    statistics Pinot returns with every response.
+    - Statistics are summed into per-minute and per-hour Redis hashes, with
+      log-spaced histograms of timeUsedMs and numDocsScanned for percentiles.
+    - Queries at or above slow_query_ms are added to a capped slow-query log,
+      identified by API, version, parameter fingerprint and SQL hash. The
+      SQL is logged with its literals masked; the bound text, which holds
+      caller values, only with log_raw_sql.
+    - Recording only updates an in-process buffer; a background thread writes
+      it to Redis every flush_interval seconds in one pipeline.
+    """
+
+    def __init__(self, redis_client, slow_query_ms=1000, slow_log_size=1000, flush_interval=5,
+                 minute_retention=86400, hour_retention=30 * 86400, key_prefix="qstats:", log_raw_sql=False):
+        self.redis_client = redis_client
+        self.slow_query_ms = float(slow_query_ms)
+        self.slow_log_size = int(slow_log_size)
+        self.log_raw_sql = bool(log_raw_sql)
+        self.flush_interval = float(flush_interval)
+        self.retention = {MINUTE[0]: int(minute_retention), HOUR[0]: int(hour_retention)}
+        self.key_prefix = key_prefix
+        self._buffer = {}
+        self._slow = []
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._pid = None
+        self._stopped = threading.Event()
+        atexit.register(self.flush)
+
+    # Keys
+
+    def _bucket_key(self, resolution, api, version, bucket):
+        return f"{self.key_prefix}{resolution}:{api}:{version}:{bucket}"
+
+    @property
+    def index_key(self):
+        """Sorted set of "api:version" members, scored by the time they last ran."""
+        return f"{self.key_prefix}apis"
+
+    @property
+    def slow_key(self):
+        return f"{self.key_prefix}slow"
+
+    # Recording
+
+    def record(self, api, version, pinot_response, sql=None, fingerprint=None):
+        """
+        Add the statistics of one Pinot response for a saved API version.
+        A response passed through undecoded stays undecoded unless it has exceptions.
+        """
+        now = time.time()
+        values = number_fields(pinot_response, SUMMED_FIELDS)
+        errors = has_exceptions(pinot_response)
+        time_used = values.get("timeUsedMs") or 0
+        docs = values.get("numDocsScanned") or 0
+        fields = {"count": 1,
+                  "errors": 1 if errors else 0,
+                  f"lat:{histogram_bucket(time_used, LATENCY_FACTOR)}": 1,
+                  f"docs:{histogram_bucket(docs, DOCS_FACTOR)}": 1}
+        fields.update(values)
+
+        slow_entry = None
+        if time_used >= self.slow_query_ms:
+            slow_entry = {"ts": round(now, 3), "api": api or "", "version": version or "", "fingerprint": fingerprint}
+            slow_entry.update(sql_fields(sql or "", MAX_LOGGED_SQL))
+            if self.log_raw_sql:
+                slow_entry["raw_sql"] = (sql or "")[:MAX_LOGGED_SQL]
+            slow_entry.update(values)
+            slow_entry["exceptions"] = len(pinot_response.get("exceptions") or []) if errors else 0
+
+        key = (api or "", version or "", int(now // MINUTE[1]))
+        with self._lock:
+            totals = self._buffer.setdefault(key, {})
+            for field, value in fields.items():
+                totals[field] = totals.get(field, 0) + value
+            if slow_entry is not None:
+                self._slow.append(slow_entry)
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        """Start the background flush thread for this process if it is not running."""
+        pid = os.getpid()
+        if self._flusher is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._flusher is not None and self._pid == pid:
+                return
+            if self._pid is not None and self._pid != pid:
+                # Forked: the parent's buffer is flushed by the parent
+                self._buffer, self._slow = {}, []
+            self._pid = pid
+            self._flusher = threading.Thread(target=self._run_flusher, name="query-stats-flush", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered statistics and slow queries to Redis."""
+        with self._lock:
+            buffer, slow = self._buffer, self._slow
+            self._buffer, self._slow = {}, []
+        if not buffer and not slow:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            last_seen = {}
+            for (api, version, minute), totals in buffer.items():
+                for resolution, seconds in (MINUTE, HOUR):
+                    bucket = minute * MINUTE[1] // seconds
+                    key = self._bucket_key(resolution, api, version, bucket)
+                    for field, value in totals.items():
+                        if isinstance(value, float) and not value.is_integer():
+                            pipe.hincrbyfloat(key, field, value)
+                        else:
+                            pipe.hincrby(key, field, int(value))
+                    pipe.expire(key, self.retention[resolution] + seconds)
+                member = f"{api}:{version}"
+                last_seen[member] = max(last_seen.get(member, 0), (minute + 1) * MINUTE[1])
+            if last_seen:
+                pipe.zadd(self.index_key, last_seen)
+            if slow:
+                pipe.lpush(self.slow_key, *[dumps(entry) for entry in slow])
+                pipe.ltrim(self.slow_key, 0, self.slow_log_size - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Query stats flush failed: {str(e)}")
+
+    # Reading
+
+    def summary(self, window=3600, api=None, now=None):
+        """
+        Return per-API, per-version statistics for the last `window` seconds,
+        slowest total time first. Windows up to a day use minute buckets,
+        longer ones hour buckets.
+        :param api: Only report this API name.
+        """
+        now = time.time() if now is None else now
+        resolution, seconds = MINUTE if window <= self.retention[MINUTE[0]] else HOUR
+        window = min(window, self.retention[resolution])
+        first, last = int((now - window) // seconds) + 1, int(now // seconds)
+
+        members = self.redis_client.zrangebyscore(self.index_key, now - window, "+inf")
+        targets = []
+        for member in members:
+            member_api, _, version = member.rpartition(":")
+            if api is None or member_api == api:
+                targets.append((member_api, version))
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for target_api, version in targets:
+            for bucket in range(first, last + 1):
+                pipe.hgetall(self._bucket_key(resolution, target_api, version, bucket))
+        replies = pipe.execute() if targets else []
+
+        per_target = last - first + 1
+        results = []
+        for index, (target_api, version) in enumerate(targets):
+            totals = {}
+            for reply in replies[index * per_target:(index + 1) * per_target]:
+                for field, value in reply.items():
+                    totals[field] = totals.get(field, 0) + float(value)
+            if totals.get("count"):
+                results.append(self._describe(target_api, version, totals))
+        results.sort(key=lambda result: result["total_time_ms"], reverse=True)
+        return results
+
+    def top_apis(self, limit=100, window=86400, now=None):
+        """
+        Return the names of the APIs run most often in the last `window`
+        seconds (all versions counted, from the hourly buckets), most first.
+        """
+        now = time.time() if now is None else now
+        window = min(window, self.retention[HOUR[0]])
+        first, last = int((now - window) // HOUR[1]) + 1, int(now // HOUR[1])
+        members = self.redis_client.zrangebyscore(self.index_key, now - window, "+inf")
+        targets = [member.rpartition(":") for member in members]
+        if not targets:
+            return []
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for api, _, version in targets:
+            for bucket in range(first, last + 1):
+                pipe.hget(self._bucket_key(HOUR[0], api, version, bucket), "count")
+        replies = pipe.execute()
+
+        per_target = last - first + 1
+        counts = {}
+        for index, (api, _, _) in enumerate(targets):
+            executions = sum(int(count) for count in replies[index * per_target:(index + 1) * per_target] if count)
+            if api and executions:
+                counts[api] = counts.get(api, 0) + executions
+        return sorted(counts, key=counts.get, reverse=True)[:limit]
+
+    @staticmethod
+    def _describe(api, version, totals):
+        count = totals["count"]
+        latency = {int(field[4:]): value for field, value in totals.items() if field.startswith("lat:")}
+        docs = {int(field[5:]): value for field, value in totals.items() if field.startswith("docs:")}
+
+        def percentiles(histogram, factor):
+            return {f"p{q}": round(percentile(histogram, factor, q), 1) for q in PERCENTILES}
+
+        def scan(field):
+            return {"total": int(totals.get(field, 0)), "avg": round(totals.get(field, 0) / count, 1)}
+
+        return {
+            "api": api,
+            "version": version,
+            "count": int(count),
+            "errors": int(totals.get("errors", 0)),
+            "total_time_ms": int(totals.get("timeUsedMs", 0)),
+            "latency_ms": dict(percentiles(latency, LATENCY_FACTOR),
+                               avg=round(totals.get("timeUsedMs", 0) / count, 1)),
+            "docs_scanned": dict(percentiles(docs, DOCS_FACTOR), **scan("numDocsScanned")),
+            "entries_scanned_in_filter": scan("numEntriesScannedInFilter"),
+            "entries_scanned_post_filter": scan("numEntriesScannedPostFilter"),
+            "servers_queried": scan("numServersQueried"),
+        }
+
+    def slow_queries(self, limit=100, api=None):
+        """Return the most recent slow queries, newest first."""
+        entries = [loads(entry) for entry in self.redis_client.lrange(self.slow_key, 0, self.slow_log_size - 1)]
+        if api is not None:
+            entries = [entry for entry in entries if entry.get("api") == api]
+        return entries[:limit]
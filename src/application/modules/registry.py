@@ -0,0 +1,453 @@
+import json
+import threading
+import time
+from application.modules.serialization import dumps, loads
+
+# Version record schema. Schema 2 records are hashes:
+# - schema: the schema version.
+# - body: JSON of the immutable fields (name, sql, parameters, per-version options).
+# - name: the API name, so deletes can look it up without reading the body.
+# - active: "1" or "0", and updated_at: when active last changed (epoch seconds).
+# Schema 1 records, written before, are plain JSON strings including "active";
+# they are still read and updated in place until migrated (Registry.migrate_records).
+LEGACY_SCHEMA = 1
+SCHEMA_VERSION = 2
+
+# Shared Lua helper: read a version record as {schema, body, active} | false.
+# Only the fields the execute path needs are fetched.
+READ_RECORD_LUA = """
+local function read_record(key)
+    local kind = redis.call('TYPE', key)['ok']
+    if kind == 'hash' then
+        return redis.call('HMGET', key, 'schema', 'body', 'active')
+    end
+    if kind == 'string' then
+        return {'""" + str(LEGACY_SCHEMA) + """', redis.call('GET', key), false}
+    end
+    return false
+end
+"""
+
+# Shared Lua helper: write a schema 2 version record.
+WRITE_RECORD_LUA = """
+local function write_record(key, name, body, active, now)
+    redis.call('HSET', key, 'schema', '""" + str(SCHEMA_VERSION) + """', 'name', name, 'body', body,
+               'active', active, 'updated_at', now)
+end
+"""
+
+# Shared Lua helper: set the "active" flag of a stored record. For a hash
+# this is a single-field write. A legacy JSON record is written with
+# "active" as its last key, so the flag is flipped by rewriting the suffix
+# without re-encoding the SQL and parameters (cjson would reorder keys and
+# lose integer precision); anything else falls back to a cjson round trip.
+SET_ACTIVE_LUA = """
+local function set_active(key, flag, now)
+    local kind = redis.call('TYPE', key)['ok']
+    if kind == 'hash' then
+        redis.call('HSET', key, 'active', flag and '1' or '0', 'updated_at', now)
+        return
+    end
+    if kind ~= 'string' then
+        return
+    end
+    local record = redis.call('GET', key)
+    local on, off = '"active": true}', '"active": false}'
+    local want, other = off, on
+    if flag then
+        want, other = on, off
+    end
+    if string.sub(record, -#want) == want then
+        return
+    end
+    if string.sub(record, -#other) == other then
+        redis.call('SET', key, string.sub(record, 1, #record - #other) .. want)
+    else
+        local data = cjson.decode(record)
+        data['active'] = flag
+        redis.call('SET', key, cjson.encode(data))
+    end
+end
+"""
+
+# KEYS[1] = name -> {uuid, record fields} | {}
+RESOLVE_LATEST_LUA = READ_RECORD_LUA + """
+local latest = redis.call('LINDEX', KEYS[1], 0)
+if not latest then
+    return {}
+end
+return {latest, read_record(latest)}
+"""
+
+# KEYS[1] = uuid -> record fields | false
+GET_VERSION_LUA = READ_RECORD_LUA + """
+return read_record(KEYS[1])
+"""
+
+# KEYS[1] = name, KEYS[2] = new uuid, KEYS[3] = names by mtime, KEYS[4] = names by name
+# ARGV[1] = record body, ARGV[2] = now -> status
+CREATE_LUA = WRITE_RECORD_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 'exists'
+end
+write_record(KEYS[2], KEYS[1], ARGV[1], '1', ARGV[2])
+redis.call('LPUSH', KEYS[1], KEYS[2])
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[1])
+redis.call('ZADD', KEYS[4], 0, KEYS[1])
+return 'ok'
+"""
+
+# KEYS[1] = name, KEYS[2] = new uuid, KEYS[3] = names by mtime, KEYS[4] = names by name
+# ARGV[1] = record body, ARGV[2] = now -> {status, previous uuid}
+UPDATE_LUA = WRITE_RECORD_LUA + SET_ACTIVE_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'not_found'}
+end
+local latest = redis.call('LINDEX', KEYS[1], 0)
+if not latest then
+    return {'no_versions'}
+end
+write_record(KEYS[2], KEYS[1], ARGV[1], '1', ARGV[2])
+set_active(latest, false, ARGV[2])
+redis.call('LPUSH', KEYS[1], KEYS[2])
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[1])
+redis.call('ZADD', KEYS[4], 0, KEYS[1])
+return {'ok', latest}
+"""
+
+# KEYS[1] = name, KEYS[2] = names by mtime, KEYS[3] = names by name -> list of deleted versions | false
+DELETE_BY_NAME_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local versions = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = 1, #versions, 1000 do
+    redis.call('DEL', unpack(versions, i, math.min(i + 999, #versions)))
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], KEYS[1])
+redis.call('ZREM', KEYS[3], KEYS[1])
+return versions
+"""
+
+# KEYS[1] = uuid, KEYS[2] = names by mtime, ARGV[1] = now -> {status, name}
+DELETE_BY_VERSION_LUA = SET_ACTIVE_LUA + """
+local name, active
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'hash' then
+    local fields = redis.call('HMGET', KEYS[1], 'name', 'active')
+    name, active = fields[1], fields[2] == '1'
+elseif kind == 'string' then
+    local data = cjson.decode(redis.call('GET', KEYS[1]))
+    name, active = data['name'], data['active'] == true
+else
+    return {'not_found'}
+end
+if type(name) ~= 'string' or name == '' then
+    return {'no_name'}
+end
+if redis.call('LLEN', name) == 1 and redis.call('LINDEX', name, 0) == KEYS[1] then
+    return {'last_version', name}
+end
+redis.call('LREM', name, 0, KEYS[1])
+if active then
+    local next_uuid = redis.call('LINDEX', name, 0)
+    if next_uuid then
+        set_active(next_uuid, true, ARGV[1])
+    end
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZADD', KEYS[2], ARGV[1], name)
+return {'ok', name}
+"""
+
+# KEYS[1] = uuid; ARGV[1] = legacy JSON record, ARGV[2] = name, ARGV[3] = record body,
+# ARGV[4] = active, ARGV[5] = now -> 1 if converted, 0 if the record changed meanwhile
+MIGRATE_RECORD_LUA = WRITE_RECORD_LUA + """
+if redis.call('TYPE', KEYS[1])['ok'] ~= 'string' or redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+write_record(KEYS[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+return 1
+"""
+
+# Secondary indexes of API names. Normalized names never contain ':', so
+# these keys cannot collide with a name or a version UUID.
+NAMES_BY_MTIME_KEY = "registry:names"
+NAMES_BY_NAME_KEY = "registry:names:lex"
+INDEX_BUILT_KEY = "registry:names:built"
+
+class RegistryError(ValueError):
+    """A registry operation failed; status_code is the HTTP status to return."""
+
+    def __init__(self, message, status_code=400):
+        super(RegistryError, self).__init__(message)
+        self.status_code = status_code
+
+def serialize_record(name, sql, parameters, options=None):
+    """
+    Serialize the immutable body of a version record (see SCHEMA_VERSION).
+    options holds optional per-version settings (e.g. "cache") stored alongside the SQL.
+    """
+    record = {
+        "name": name,
+        "sql": sql,
+        "parameters": parameters
+    }
+    for key, value in (options or {}).items():
+        if value is not None and key not in record and key != "active":
+            record[key] = value
+    return dumps(record)
+
+def decode_record(fields):
+    """
+    Turn the {schema, body, active} fields read by READ_RECORD_LUA into a
+    record dict, or None when there is no record.
+    """
+    if not fields or not fields[1]:
+        return None
+    schema, body, active = fields
+    record = loads(body)
+    if int(schema) == LEGACY_SCHEMA:
+        return record
+    if int(schema) != SCHEMA_VERSION:
+        raise RegistryError(f"Unsupported registry record schema {schema}", 500)
+    record["active"] = active == "1"
+    return record
+
+class Registry(object):
+    """
+    Saved-query registry operations, each a single atomic round trip to Redis.
+    - Each API name is a list of version UUIDs, newest first.
+    - Each version UUID is a hash holding the record body (name, sql,
+      parameters) apart from its mutable active flag (see SCHEMA_VERSION).
+    - Names are indexed in two sorted sets, maintained by the same scripts:
+      by last-modified time and lexicographically (for prefix paging).
+    Scripts address version keys read from the name list, so the registry
+    assumes a single (non-cluster) Redis.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._resolve_latest = redis_client.register_script(RESOLVE_LATEST_LUA)
+        self._get_version = redis_client.register_script(GET_VERSION_LUA)
+        self._create = redis_client.register_script(CREATE_LUA)
+        self._update = redis_client.register_script(UPDATE_LUA)
+        self._delete_by_name = redis_client.register_script(DELETE_BY_NAME_LUA)
+        self._delete_by_version = redis_client.register_script(DELETE_BY_VERSION_LUA)
+        self._migrate_record = redis_client.register_script(MIGRATE_RECORD_LUA)
+        self._index_checked = False
+        self._index_lock = threading.Lock()
+
+    @staticmethod
+    def parse_latest(name, result):
+        """Turn the RESOLVE_LATEST_LUA reply into (uuid, record dict)."""
+        if not result:
+            raise RegistryError(f"API name '{name}' not found", 404)
+        latest_uuid, record = result[0], decode_record(result[1]) if len(result) > 1 else None
+        if not record:
+            raise RegistryError(f"No valid record found for API name '{name}'", 404)
+        return latest_uuid, record
+
+    @staticmethod
+    def parse_version(uuid, fields):
+        """Turn the GET_VERSION_LUA reply into a record dict."""
+        record = decode_record(fields)
+        if not record:
+            raise RegistryError(f"Version '{uuid}' not found", 404)
+        return record
+
+    @classmethod
+    def parse_many(cls, refs, replies):
+        """Turn the pipelined replies for resolve_many into results or RegistryErrors."""
+        results = []
+        for (kind, value), reply in zip(refs, replies):
+            try:
+                if kind == "name":
+                    results.append(cls.parse_latest(value, reply))
+                else:
+                    results.append((value, cls.parse_version(value, reply)))
+            except RegistryError as e:
+                results.append(e)
+        return results
+
+    def resolve_latest(self, name):
+        """
+        Return (uuid, record dict) for the latest version of an API name.
+        """
+        return self.parse_latest(name, self._resolve_latest(keys=[name]))
+
+    def get_version(self, uuid):
+        """Return the record dict for a version UUID."""
+        return self.parse_version(uuid, self._get_version(keys=[uuid]))
+
+    def resolve_many(self, refs):
+        """
+        Resolve several saved APIs in one pipelined round trip.
+        :param refs: List of ("name", api name) or ("version", uuid) pairs.
+        Returns a list in the same order holding (uuid, record dict) for each
+        resolved reference, or the RegistryError explaining why it failed.
+        """
+        if not refs:
+            return []
+        pipe = self.redis_client.pipeline(transaction=False)
+        for kind, value in refs:
+            if kind == "name":
+                self._resolve_latest(keys=[value], client=pipe)
+            else:
+                self._get_version(keys=[value], client=pipe)
+        return self.parse_many(refs, pipe.execute())
+
+    def create(self, name, uuid, sql, parameters, options=None):
+        """Create a new API name with its first, active version."""
+        status = self._create(keys=[name, uuid, NAMES_BY_MTIME_KEY, NAMES_BY_NAME_KEY],
+                              args=[serialize_record(name, sql, parameters, options), time.time()])
+        if status == 'exists':
+            raise RegistryError(f"Key '{name}' already exists", 409)
+        return uuid
+
+    def update(self, name, uuid, sql, parameters, options=None):
+        """
+        Add a new active version for an API name and mark the previous one inactive.
+        Returns the UUID of the previous latest version.
+        """
+        result = self._update(keys=[name, uuid, NAMES_BY_MTIME_KEY, NAMES_BY_NAME_KEY],
+                              args=[serialize_record(name, sql, parameters, options), time.time()])
+        if result[0] == 'not_found':
+            raise RegistryError(f"API name '{name}' not found", 404)
+        if result[0] == 'no_versions':
+            raise RegistryError(f"No versions found for API name '{name}'", 404)
+        return result[1]
+
+    def delete_by_name(self, name):
+        """Delete an API name and all of its versions. Returns the deleted versions."""
+        versions = self._delete_by_name(keys=[name, NAMES_BY_MTIME_KEY, NAMES_BY_NAME_KEY])
+        if versions is None:
+            raise RegistryError(f"API name '{name}' not found", 404)
+        return versions
+
+    def delete_by_version(self, uuid):
+        """
+        Delete a single version. If it was active, the next newest version is
+        marked active. The last version of a name cannot be deleted.
+        Returns the API name the version belonged to.
+        """
+        result = self._delete_by_version(keys=[uuid, NAMES_BY_MTIME_KEY], args=[time.time()])
+        status = result[0]
+        if status == 'not_found':
+            raise RegistryError(f"UUID '{uuid}' not found", 404)
+        if status == 'no_name':
+            raise RegistryError("Record does not have an associated name", 400)
+        if status == 'last_version':
+            raise RegistryError(f"Cannot delete the last UUID for API name '{result[1]}'", 400)
+        return result[1]
+
+    def list_names(self, limit=100, cursor=None, prefix=None):
+        """
+        Return (names, next_cursor) from the name index, in name order.
+        :param limit: Maximum number of names to return.
+        :param cursor: Last name of the previous page; paging resumes after it.
+        :param prefix: Only return names starting with this prefix.
+        """
+        self.ensure_index()
+        low, high = "-", "+"
+        if prefix:
+            low, high = f"[{prefix}", f"[{prefix}\xff"
+        if cursor and (not prefix or cursor >= prefix):
+            low = f"({cursor}"
+        names = self.redis_client.zrangebylex(NAMES_BY_NAME_KEY, low, high, start=0, num=limit + 1)
+        if len(names) > limit:
+            return names[:limit], names[limit - 1]
+        return names, None
+
+    def recent_names(self, limit=100):
+        """Return the most recently modified API names, newest first."""
+        self.ensure_index()
+        return self.redis_client.zrevrange(NAMES_BY_MTIME_KEY, 0, limit - 1)
+
+    def ensure_index(self):
+        """Build the name indexes once per process if they have never been built."""
+        if self._index_checked:
+            return
+        with self._index_lock:
+            if self._index_checked:
+                return
+            if not self.redis_client.exists(INDEX_BUILT_KEY):
+                self.rebuild_index()
+            self._index_checked = True
+
+    def rebuild_index(self, batch_size=500):
+        """
+        Rebuild the name indexes from a full keyspace scan. Only needed for
+        registries written before the indexes existed.
+        Returns the number of names indexed.
+        """
+        now = time.time()
+        indexed = 0
+        cursor = 0
+        while True:
+            cursor, keys = self.redis_client.scan(cursor, count=batch_size)
+            keys = [key for key in keys if ':' not in key]
+            if keys:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.type(key)
+                names = [key for key, key_type in zip(keys, pipe.execute()) if key_type == "list"]
+                if names:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    pipe.zadd(NAMES_BY_MTIME_KEY, {name: now for name in names}, nx=True)
+                    pipe.zadd(NAMES_BY_NAME_KEY, {name: 0 for name in names})
+                    pipe.execute()
+                    indexed += len(names)
+            if cursor == 0:
+                break
+        self.redis_client.set(INDEX_BUILT_KEY, int(now))
+        return indexed
+
+    def migrate_records(self, batch_size=500, dry_run=False):
+        """
+        Convert legacy (schema 1) JSON string records to schema 2 hashes,
+        scanning the keyspace in batches. Records changed while being
+        converted are left for the next run; anything that is not a version
+        record is left alone.
+        Returns {"migrated": n, "skipped": n}; with dry_run, migrated counts
+        the records that would be converted and nothing is written.
+        """
+        counts = {"migrated": 0, "skipped": 0}
+        cursor = 0
+        while True:
+            cursor, keys = self.redis_client.scan(cursor, count=batch_size)
+            keys = [key for key in keys if ':' not in key]
+            if keys:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.type(key)
+                keys = [key for key, key_type in zip(keys, pipe.execute()) if key_type == "string"]
+            if keys:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.get(key)
+                for key, record in zip(keys, pipe.execute()):
+                    try:
+                        # The standard library keeps integers of any size exact
+                        data = json.loads(record)
+                    except (TypeError, ValueError):
+                        continue
+                    if not isinstance(data, dict) or "sql" not in data:
+                        continue
+                    if not isinstance(data.get("name"), str) or not data["name"]:
+                        counts["skipped"] += 1
+                        continue
+                    if not dry_run:
+                        options = {k: v for k, v in data.items() if k not in ("name", "sql", "parameters", "active")}
+                        body = serialize_record(data["name"], data["sql"], data.get("parameters", {}), options)
+                        if not self._migrate_record(keys=[key], args=[record, data["name"], body,
+                                                                      "1" if data.get("active") else "0",
+                                                                      time.time()]):
+                            counts["skipped"] += 1
+                            continue
+                    counts["migrated"] += 1
+            if cursor == 0:
+                break
+        return counts
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from application.modules.metrics import RESULT_CACHE_TOTAL
+from application.modules.serialization import decode_response, dumps
+
+logger = logging.getLogger(__name__)
+
+HIT = "HIT"
+MISS = "MISS"
+STALE = "STALE"
+
+class _Entry(object):
+    __slots__ = ("data", "size", "fresh_until", "stale_until")
+
+    def __init__(self, data, size, fresh_until, stale_until):
+        self.data = data
+        self.size = size
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+class ResultCache(object):
+    """
+    Two-tier cache of Pinot query results for saved APIs.
+    - L1: in-process LRU holding parsed results, capped by entry count and bytes.
+    - L2: Redis, shared by all workers, holding the serialized result.
+    Entries are fresh for `ttl` seconds and may then be served for another
+    `stale_ttl` seconds while a single background refresh runs.
+    Lookups are counted by outcome in the metrics registry, if one is given.
+    """
+
+    def __init__(self, redis_client=None, max_entries=1000, max_bytes=64 * 1024 * 1024,
+                 key_prefix="result:", refresh_workers=2, metrics=None):
+        self.redis_client = redis_client
+        self.metrics = metrics
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.key_prefix = key_prefix
+        self.refresh_workers = int(refresh_workers)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @staticmethod
+    def make_key(version, query, scope):
+        """
+        Cache key for a version, its query and the caller's scope.
+        :param query: The substituted SQL, or the fingerprint of the bound parameters.
+        """
+        digest = hashlib.sha256()
+        for part in (version or "", query.strip(), scope or ""):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    # L1
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.stale_until <= time.time():
+                self._remove_local(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _remove_local(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _set_local(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove_local(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    # L2
+
+    @staticmethod
+    def encode_shared(payload, fresh_until, stale_until):
+        """Return (value, ttl in ms) for storing a result in Redis."""
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        ttl_ms = max(int((stale_until - time.time()) * 1000), 1)
+        return f"{fresh_until} {stale_until}\n{payload}", ttl_ms
+
+    def accept_shared(self, key, value):
+        """
+        Decode a value read from Redis, copy it into the local tier and
+        return (data, HIT|STALE), or (None, MISS) for an empty value.
+        """
+        if not value:
+            return None, MISS
+        header, _, payload = value.partition("\n")
+        fresh_until, _, stale_until = header.partition(" ")
+        entry = _Entry(decode_response(payload), len(payload), float(fresh_until), float(stale_until))
+        self._set_local(key, entry)
+        return entry.data, HIT if entry.fresh_until > time.time() else STALE
+
+    def _get_shared(self, key):
+        if self.redis_client is None:
+            return None, MISS
+        try:
+            value = self.redis_client.get(self.key_prefix + key)
+        except Exception as e:
+            logger.warning(f"Result cache Redis lookup failed: {str(e)}")
+            return None, MISS
+        return self.accept_shared(key, value)
+
+    def _set_shared(self, key, payload, fresh_until, stale_until):
+        if self.redis_client is None:
+            return
+        try:
+            value, ttl_ms = self.encode_shared(payload, fresh_until, stale_until)
+            self.redis_client.set(self.key_prefix + key, value, px=ttl_ms)
+        except Exception as e:
+            logger.warning(f"Result cache Redis write failed: {str(e)}")
+
+    # Public API
+
+    def get_local(self, key):
+        """Return (data, HIT|STALE) from the local tier only, or (None, MISS)."""
+        entry = self._get_local(key)
+        if entry is None:
+            return None, MISS
+        if entry.fresh_until > time.time():
+            return entry.data, HIT
+        return entry.data, STALE
+
+    def get(self, key):
+        """Return (data, HIT|STALE) for a cached result, or (None, MISS)."""
+        data, status = self.get_local(key)
+        if status == MISS:
+            data, status = self._get_shared(key)
+        return data, status
+
+    def set(self, key, data, ttl, stale_ttl=0, payload=None, shared=True):
+        """
+        Cache a result; payload is its JSON body, if already available.
+        Returns (payload, fresh_until, stale_until) so callers with their own
+        Redis client can write the shared tier themselves (shared=False).
+        """
+        if payload is None:
+            payload = dumps(data)
+        now = time.time()
+        fresh_until = now + ttl
+        stale_until = fresh_until + max(stale_ttl, 0)
+        self._set_local(key, _Entry(data, len(payload), fresh_until, stale_until))
+        if shared:
+            self._set_shared(key, payload, fresh_until, stale_until)
+        return payload, fresh_until, stale_until
+
+    def get_or_load(self, key, loader, ttl, stale_ttl=0):
+        """
+        Return (data, status) for a key, calling loader() on a miss.
+        loader returns (data, payload) for a cacheable result, or raises.
+        Stale entries are returned immediately and refreshed in the background.
+        """
+        data, status = self.get(key)
+        self.record(status)
+        if status == HIT:
+            return data, HIT
+        if status == STALE:
+            self._refresh(key, loader, ttl, stale_ttl)
+            return data, STALE
+
+        data, payload = loader()
+        if payload is not None:
+            self.set(key, data, ttl, stale_ttl, payload)
+        return data, MISS
+
+    def record(self, status):
+        """Count a lookup outcome (HIT, MISS or STALE) for the current saved API."""
+        if self.metrics is not None:
+            self.metrics.count_api(RESULT_CACHE_TOTAL, status.lower())
+
+    def _refresh(self, key, loader, ttl, stale_ttl):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.refresh_workers,
+                                                    thread_name_prefix="result-cache-refresh")
+        self._executor.submit(self._run_refresh, key, loader, ttl, stale_ttl)
+
+    def _run_refresh(self, key, loader, ttl, stale_ttl):
+        try:
+            data, payload = loader()
+            if payload is not None:
+                self.set(key, data, ttl, stale_ttl, payload)
+        except Exception as e:
+            logger.warning(f"Result cache background refresh failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def clear(self):
+        """Empty the local tier."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,202 @@
+import json
+import re
+import uuid
+from collections.abc import Mapping
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib json module is used instead
+    orjson = None
+
+AUTO = "auto"
+ORJSON = "orjson"
+STDLIB = "json"
+
+# An empty top-level exceptions array, as Pinot and the stub broker write it
+NO_EXCEPTIONS = re.compile(rb'"exceptions"\s*:\s*\[\s*\]')
+# A top-level number field; keys inside JSON strings have escaped quotes and never match
+NUMBER_FIELD = rb'"(%s)"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)'
+# Stands in for the n-th RawJSON while encoding; both serializers escape NUL as \u0000
+RAW_MARKER = uuid.uuid4().hex
+RAW_PLACEHOLDER = re.compile(rb'"\\u0000' + RAW_MARKER.encode("ascii") + rb':(\d+)"')
+
+class StdlibSerializer(object):
+    """JSON through the standard library; always available."""
+
+    name = STDLIB
+
+    @staticmethod
+    def dumps(value, default=None):
+        return json.dumps(value, default=default, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+class OrjsonSerializer(object):
+    """
+    JSON through orjson. Values orjson rejects (non-string keys, integers
+    beyond 64 bits) are encoded by the standard library instead. Dates are
+    left to `default`, as with the standard library.
+    """
+
+    name = ORJSON
+
+    @staticmethod
+    def dumps(value, default=None):
+        try:
+            return orjson.dumps(value, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return StdlibSerializer.dumps(value, default)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+def create_serializer(backend=AUTO):
+    """
+    Return the serializer for a backend name: "orjson", "json", or "auto"
+    (orjson when installed). Raises ValueError for an unknown name, or
+    "orjson" when it is not installed.
+    """
+    if backend == AUTO:
+        return OrjsonSerializer() if orjson is not None else StdlibSerializer()
+    if backend == ORJSON:
+        if orjson is None:
+            raise ValueError("JSON backend 'orjson' is not installed")
+        return OrjsonSerializer()
+    if backend == STDLIB:
+        return StdlibSerializer()
+    raise ValueError(f"Unknown JSON backend: {backend}")
+
+class RawJSON(Mapping):
+    """
+    A JSON object kept as the bytes it was received as (a broker response).
+    - Reads as a read-only mapping, decoded on first access.
+    - Encoded by dumps() by splicing the original bytes in, decoded or not,
+      so a response that is only passed through is never parsed nor re-encoded.
+    """
+
+    __slots__ = ("raw", "_value")
+
+    def __init__(self, raw):
+        self.raw = raw.encode("utf-8") if isinstance(raw, str) else raw
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = _serializer.loads(self.raw)
+        return self._value
+
+    @property
+    def decoded(self):
+        return self._value is not None
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __repr__(self):
+        return f"RawJSON({len(self.raw)} bytes)"
+
+_serializer = create_serializer()
+_passthrough = False
+
+def configure_serialization(config):
+    """
+    Select the serializer used by dumps/loads and the Flask JSON provider,
+    and whether broker responses are passed through undecoded.
+    """
+    global _serializer, _passthrough
+    config = config or {}
+    _serializer = create_serializer(config.get('backend', AUTO))
+    _passthrough = bool(config.get('passthrough', True))
+
+def get_serializer():
+    return _serializer
+
+def dumps(value, default=None):
+    """
+    Encode a value as JSON bytes with the configured serializer. RawJSON
+    values, at any depth, are spliced in as their original bytes.
+    """
+    raw = []
+
+    def encode(obj):
+        if isinstance(obj, RawJSON):
+            raw.append(obj.raw)
+            return f"\0{RAW_MARKER}:{len(raw) - 1}"
+        if default is not None:
+            return default(obj)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    if isinstance(value, RawJSON):
+        return value.raw
+    payload = _serializer.dumps(value, encode)
+    if not raw:
+        return payload
+    return RAW_PLACEHOLDER.sub(lambda match: raw[int(match.group(1))], payload)
+
+def loads(data):
+    """Decode JSON text or bytes with the configured serializer."""
+    return _serializer.loads(data)
+
+def decode_response(payload):
+    """A broker response body: RawJSON in passthrough mode, decoded otherwise."""
+    return RawJSON(payload) if _passthrough else _serializer.loads(payload)
+
+def has_exceptions(pinot_response):
+    """
+    Whether a broker response carries query exceptions. An undecoded RawJSON
+    with an empty exceptions array is answered without decoding it.
+    """
+    if isinstance(pinot_response, RawJSON) and not pinot_response.decoded \
+            and len(NO_EXCEPTIONS.findall(pinot_response.raw)) == 1:
+        return False
+    return bool(pinot_response.get('exceptions'))
+
+def number_fields(pinot_response, fields):
+    """
+    Return {field: value} for the top-level number fields of a broker
+    response that are present. An undecoded RawJSON is scanned, not decoded.
+    """
+    if isinstance(pinot_response, RawJSON) and not pinot_response.decoded:
+        pattern = re.compile(NUMBER_FIELD % b"|".join(re.escape(field.encode("ascii")) for field in fields))
+        return {key.decode("ascii"): json.loads(value) for key, value in pattern.findall(pinot_response.raw)}
+    return {field: pinot_response[field] for field in fields
+            if isinstance(pinot_response.get(field), (int, float)) and not isinstance(pinot_response.get(field), bool)}
+
+class SerializerJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider on the configured serializer: jsonify() and
+    request.get_json() use it, and RawJSON values are spliced in unparsed.
+    Output is compact and keeps key order; debug mode still pretty-prints.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # Formatted output goes through the standard library, which needs RawJSON decoded
+            kwargs.setdefault("default", self.decode_raw)
+            return super(SerializerJSONProvider, self).dumps(obj, **kwargs)
+        return dumps(obj, self.default).decode("utf-8")
+
+    def decode_raw(self, obj):
+        return dict(obj.value) if isinstance(obj, RawJSON) else self.default(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super(SerializerJSONProvider, self).loads(s, **kwargs)
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        if self._app.debug:
+            return super(SerializerJSONProvider, self).response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, self.default), mimetype=self.mimetype)
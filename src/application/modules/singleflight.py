@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from application.modules.deadlines import DeadlineExceeded, check_deadline
+from application.modules.metrics import COALESCED_LOCAL, COALESCED_REMOTE, LEADER, SINGLEFLIGHT_CALLS_TOTAL, Metrics
+from application.modules.serialization import decode_response
+
+logger = logging.getLogger(__name__)
+
+# Release the cross-worker lock only if we still own it
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class _Call(object):
+    """An in-flight call that other threads in this process can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Coalesce identical concurrent Pinot queries.
+    - Within a process, callers with the same key wait on one call.
+    - Across workers (when a Redis client is given), the first worker to take
+      a short Redis lock runs the query and publishes the serialized result
+      under a result key; other workers poll for that result instead of
+      querying Pinot themselves.
+    Only the leader's result is shared; errors are re-raised in local waiters
+    and make remote waiters fall back to running the query themselves.
+    Waiters give up after wait_timeout seconds, or with DeadlineExceeded at
+    the request's deadline, whichever comes first.
+    Calls are counted by role in the metrics registry, if one is given.
+    """
+
+    def __init__(self, redis_client=None, lock_ttl=30, result_ttl=5, poll_interval=0.02,
+                 wait_timeout=30, key_prefix="singleflight:", metrics=None):
+        self.redis_client = redis_client
+        self.lock_ttl = float(lock_ttl)
+        self.result_ttl = float(result_ttl)
+        self.poll_interval = float(poll_interval)
+        self.wait_timeout = float(wait_timeout)
+        self.key_prefix = key_prefix
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._release = redis_client.register_script(RELEASE_LOCK_LUA) if redis_client is not None else None
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+
+    @staticmethod
+    def make_key(query, scope):
+        """Key for a substituted SQL string (or a bound-parameter fingerprint) and the caller's auth scope."""
+        return hashlib.sha256(f"{scope}\0{query}".encode("utf-8")).hexdigest()
+
+    def do(self, key, func):
+        """
+        Run func() once for all concurrent callers with the same key.
+        func returns (data, payload) where payload is the JSON body of data,
+        or None if the result must not be shared with other workers.
+        Returns (data, payload).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (COALESCED_LOCAL,))
+            if not call.event.wait(self.wait_time()):
+                check_deadline()
+                return func()
+            if isinstance(call.error, DeadlineExceeded):
+                # The leader's deadline may be earlier than this caller's
+                check_deadline()
+                return func()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_shared(key, func)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def wait_time(self):
+        """Seconds to wait for a leader: wait_timeout, cut to the time left before the request's deadline."""
+        left = check_deadline()
+        return self.wait_timeout if left is None else min(self.wait_timeout, left)
+
+    def _do_shared(self, key, func):
+        if self.redis_client is None:
+            self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (LEADER,))
+            return func()
+
+        lock_key = f"{self.key_prefix}lock:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.redis_client.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+            leader_token = token if acquired else self.redis_client.get(lock_key)
+        except Exception as e:
+            logger.warning(f"Single-flight lock failed, running query directly: {str(e)}")
+            self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (LEADER,))
+            return func()
+
+        if not acquired and leader_token:
+            shared = self._wait_for_result(lock_key, leader_token)
+            if shared is not None:
+                self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (COALESCED_REMOTE,))
+                return decode_response(shared), shared
+
+        self.metrics.inc(SINGLEFLIGHT_CALLS_TOTAL, (LEADER,))
+        try:
+            data, payload = func()
+            if payload is not None and acquired:
+                try:
+                    self.redis_client.set(self._result_key(lock_key, token), payload,
+                                          px=int(self.result_ttl * 1000))
+                except Exception as e:
+                    logger.warning(f"Single-flight result publish failed: {str(e)}")
+            return data, payload
+        finally:
+            if acquired:
+                try:
+                    self._release(keys=[lock_key], args=[token])
+                except Exception as e:
+                    logger.warning(f"Single-flight lock release failed: {str(e)}")
+
+    @staticmethod
+    def _result_key(lock_key, leader_token):
+        # Results are published per leader so waiters never pick up an older run
+        return f"{lock_key}:{leader_token}"
+
+    def _wait_for_result(self, lock_key, leader_token):
+        """
+        Poll for the leader's result until it appears or the leader gives up.
+        Raises DeadlineExceeded when the request's deadline passes first.
+        """
+        result_key = self._result_key(lock_key, leader_token)
+        deadline = time.monotonic() + self.wait_time()
+        while time.monotonic() < deadline:
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.get(result_key)
+                pipe.get(lock_key)
+                shared, current_token = pipe.execute()
+            except Exception as e:
+                logger.warning(f"Single-flight wait failed: {str(e)}")
+                return None
+            if shared is not None:
+                return shared
+            if current_token != leader_token:
+                # Check once more: the leader publishes before releasing the lock
+                try:
+                    return self.redis_client.get(result_key)
+                except Exception:
+                    return None
+            time.sleep(max(min(self.poll_interval, deadline - time.monotonic()), 0))
+        check_deadline()
+        return None
@@ -0,0 +1,119 @@
+import re
+from collections import namedtuple
+from operator import itemgetter
+from application.modules.pagination import TRAILING_LIMIT
+from application.modules.resultcache import HIT, MISS, STALE
+
+# Pinot returns this many rows for a selection query without LIMIT
+DEFAULT_SELECTION_LIMIT = 10
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+ORDER_BY = re.compile(r"\s+ORDER\s+BY\s+(.+)$", re.IGNORECASE | re.DOTALL)
+ORDER_KEY = re.compile(r'^("(?:[^"]|"")*"|[A-Za-z_$][\w$.]*)(?:\s+(ASC|DESC))?$', re.IGNORECASE)
+
+# Clauses and aggregate functions whose results cannot be combined by concatenating rows
+NOT_MERGEABLE = re.compile(r"""
+    \b(?:GROUP\s+BY|HAVING|DISTINCT|JOIN|UNION|INTERSECT|EXCEPT)\b
+  | \b(?:COUNT|SUM|MIN|MAX|AVG|MODE|MINMAXRANGE|SUMPRECISION|HISTOGRAM|LISTAGG|ARRAY_?AGG
+      |FIRSTWITHTIME|LASTWITHTIME|\w*DISTINCT\w*|PERCENTILE\w*|\w*HLL\w*|\w*THETA\w*|\w*SKETCH\w*)(?:MV)?\s*\(
+""", re.IGNORECASE | re.VERBOSE)
+
+# Response statistics added up across the split queries; timeUsedMs and
+# totalDocs take the largest value, everything else comes from the first
+SUMMED_STATS = (
+    "numDocsScanned", "numEntriesScannedInFilter", "numEntriesScannedPostFilter",
+    "numSegmentsQueried", "numSegmentsProcessed", "numSegmentsMatched",
+    "numConsumingSegmentsQueried", "numServersQueried", "numServersResponded",
+)
+MAX_STATS = ("timeUsedMs", "totalDocs")
+
+SplitPlan = namedtuple('SplitPlan', ['order_by', 'limit'])
+
+def split_plan(sql):
+    """
+    Return how the results of a query split over slices of a list parameter
+    are merged back together.
+    - order_by: (column, descending) keys of a trailing ORDER BY, if any.
+    - limit: the query's LIMIT, or Pinot's default for selection queries.
+    Only selection queries can be merged: raises ValueError for aggregations,
+    GROUP BY, DISTINCT, joins and set operations, for an OFFSET, and for
+    ORDER BY keys that are not plain columns.
+    :param sql: Any one of the split queries; they differ only in the list values.
+    """
+    text = STRING_LITERAL.sub("''", sql)
+    if NOT_MERGEABLE.search(text):
+        raise ValueError("only selection queries without aggregation, GROUP BY or DISTINCT can be split")
+
+    limit = DEFAULT_SELECTION_LIMIT
+    match = TRAILING_LIMIT.search(text)
+    if match is not None:
+        if match.group(2) is not None:
+            offset, limit = int(match.group(1)), int(match.group(2))
+        else:
+            offset, limit = int(match.group(3) or 0), int(match.group(1))
+        if offset:
+            raise ValueError("queries with an OFFSET cannot be split")
+        text = text[:match.start()]
+
+    order_by = []
+    match = ORDER_BY.search(text)
+    if match is not None:
+        for key in match.group(1).split(","):
+            key_match = ORDER_KEY.match(key.strip())
+            if key_match is None:
+                raise ValueError(f"ORDER BY '{key.strip()}' is not a plain column, so the query cannot be split")
+            column, direction = key_match.groups()
+            if column.startswith('"'):
+                column = column[1:-1].replace('""', '"')
+            order_by.append((column, (direction or "").upper() == "DESC"))
+    return SplitPlan(tuple(order_by), limit)
+
+def _column_index(names, column):
+    if column in names:
+        return names.index(column)
+    # "t.col" is returned as "col"
+    short = column.rsplit(".", 1)[-1]
+    if short in names:
+        return names.index(short)
+    raise ValueError(f"ORDER BY column '{column}' is not in the result, so split results cannot be merged")
+
+def merge_responses(responses, plan):
+    """
+    Merge the Pinot responses of split queries into one response.
+    Rows are concatenated, sorted by the plan's ORDER BY keys and cut to its
+    LIMIT, so the result matches what the unsplit query would return.
+    Exceptions are concatenated and scan statistics combined.
+    Raises ValueError when the rows cannot be ordered.
+    """
+    merged = dict(responses[0])
+    tables = [response.get("resultTable") for response in responses]
+    if all(isinstance(table, dict) for table in tables):
+        rows = [row for table in tables for row in table.get("rows", [])]
+        names = tables[0].get("dataSchema", {}).get("columnNames", [])
+        # Stable sorts from the last key to the first give the combined ordering
+        for column, descending in reversed(plan.order_by):
+            try:
+                rows.sort(key=itemgetter(_column_index(names, column)), reverse=descending)
+            except TypeError:
+                raise ValueError(f"Rows cannot be ordered by '{column}', so split results cannot be merged")
+        merged["resultTable"] = dict(tables[0], rows=rows[:plan.limit])
+
+    merged["exceptions"] = [exception for response in responses for exception in response.get("exceptions") or []]
+    for stat in SUMMED_STATS:
+        values = [response[stat] for response in responses if isinstance(response.get(stat), int)]
+        if values:
+            merged[stat] = sum(values)
+    for stat in MAX_STATS:
+        values = [response[stat] for response in responses if isinstance(response.get(stat), int)]
+        if values:
+            merged[stat] = max(values)
+    return merged
+
+def merge_cache_status(statuses):
+    """Combined X-Cache status of split queries: HIT only if every query hit, STALE if any was stale."""
+    statuses = [status for status in statuses if status is not None]
+    if not statuses:
+        return None
+    if all(status == HIT for status in statuses):
+        return HIT
+    return STALE if STALE in statuses else MISS
@@ -0,0 +1,401 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+from functools import partial
+from application.modules.binding import LIST_ELEMENT_BINDERS, PARAMETER_BINDERS, canonicalize_sql, list_literals
+from application.modules.binding import quoted_placeholders, split_placeholders
+
+logger = logging.getLogger(__name__)
+
+def _unsupported_formatter(param_type):
+    def formatter(value):
+        raise ValueError(f"Unsupported parameter type: {param_type}")
+    return formatter
+
+def _missing_formatter(placeholder):
+    def formatter(value):
+        raise ValueError(f"Parameter '{placeholder}' not found in defaults or provided data")
+    return formatter
+
+def _bound_formatter(binder, placeholder, spec):
+    def formatter(value):
+        if value is None:
+            raise ValueError(f"Parameter '{placeholder}' not found in defaults or provided data")
+        return binder(placeholder, value, spec)
+    return formatter
+
+_MISSING = object()
+
+# Record fields that are not per-version options
+RECORD_FIELDS = frozenset(["name", "sql", "parameters", "active"])
+
+BoundQuery = namedtuple('BoundQuery', ['sql', 'fingerprint'])
+
+class CompiledTemplate(namedtuple('CompiledTemplate', ['version', 'name', 'segments', 'slots', 'formatters', 'lists', 'defaults', 'options'])):
+    """
+    Immutable, pre-parsed form of a saved SQL query.
+    - segments: literal SQL text around the placeholders (len(slots) + 1 items),
+      with comments removed and whitespace collapsed.
+    - slots: parameter name for each placeholder, in order.
+    - formatters: parameter name -> callable validating a value and returning its SQL literal.
+    - lists: list parameter name -> callable returning the sorted, unique literals of a value.
+    - defaults: parameter name -> default value.
+    - options: per-version settings stored with the record (e.g. "cache").
+    """
+    __slots__ = ()
+
+    def bind(self, user_params):
+        """
+        Validate and substitute user parameters (or defaults) into the template.
+        Returns a BoundQuery holding the canonical SQL and a fingerprint of the
+        version and its bound values, usable as a cache or coalescing key.
+        Raises ValueError for missing or invalid values.
+        """
+        literals = {}
+        for placeholder, formatter in self.formatters.items():
+            literals[placeholder] = formatter(user_params.get(placeholder, self.defaults.get(placeholder)))
+        return self._assemble(literals)
+
+    def bind_chunks(self, user_params, chunk_size, max_values=None):
+        """
+        Bind like bind(), splitting a list parameter with more than chunk_size
+        values into one query per slice of at most chunk_size values.
+        Returns a list of BoundQuery, with a single item when nothing is split.
+        Raises ValueError for invalid values, a list over max_values, or more
+        than one list that would need splitting.
+        """
+        literals = {}
+        oversized = []
+        for placeholder, formatter in self.formatters.items():
+            value = user_params.get(placeholder, self.defaults.get(placeholder))
+            list_formatter = self.lists.get(placeholder)
+            if list_formatter is None:
+                literals[placeholder] = formatter(value)
+                continue
+            items = list_formatter(value)
+            if max_values is not None and len(items) > max_values:
+                raise ValueError(f"Parameter '{placeholder}' has {len(items)} values; at most {max_values} are allowed")
+            if len(items) > chunk_size:
+                oversized.append(placeholder)
+            literals[placeholder] = items
+
+        if len(oversized) > 1:
+            raise ValueError(f"Only one list parameter may have more than {chunk_size} values; "
+                             f"got {', '.join(sorted(oversized))}")
+        joined = {placeholder: ", ".join(items) if placeholder in self.lists else items
+                  for placeholder, items in literals.items()}
+        if not oversized:
+            return [self._assemble(joined)]
+        placeholder = oversized[0]
+        items = literals[placeholder]
+        return [self._assemble(dict(joined, **{placeholder: ", ".join(items[start:start + chunk_size])}))
+                for start in range(0, len(items), chunk_size)]
+
+    def _assemble(self, literals):
+        """Build the BoundQuery for parameter name -> SQL literal."""
+        segments = self.segments
+        parts = [segments[0]]
+        for index, placeholder in enumerate(self.slots):
+            parts.append(literals[placeholder])
+            parts.append(segments[index + 1])
+
+        digest = hashlib.sha256((self.version or "").encode("utf-8"))
+        for placeholder in sorted(literals):
+            digest.update(b"\0" + placeholder.encode("utf-8") + b"=" + literals[placeholder].encode("utf-8"))
+        return BoundQuery("".join(parts), digest.hexdigest())
+
+    def render(self, user_params):
+        """Substitute user parameters (or defaults) into the template and return the SQL."""
+        return self.bind(user_params).sql
+
+def check_quoted_placeholders(sql, parameters):
+    """Raise ValueError if a declared parameter is written inside a string literal or quoted identifier."""
+    quoted = sorted(quoted_placeholders(sql) & set(parameters or {}))
+    if quoted:
+        raise ValueError(f"Parameter '{quoted[0]}' is inside quotes; write %{quoted[0]}% outside them, "
+                         f"its value is quoted when it is bound")
+
+def compile_template(sql, parameters, version=None, name=None, options=None):
+    """
+    Compile a saved SQL string and its parameter definitions into a CompiledTemplate.
+    :param sql: SQL string with placeholders (e.g., %param1%).
+    :param parameters: Dictionary of parameters with "default", "type" and optionally "allowed".
+    :param version: UUID of the saved version, if any.
+    :param name: API name of the saved version, if any.
+    :param options: Per-version settings from the record, if any.
+    Raises ValueError for a parameter placeholder inside quotes, or an unterminated quote.
+    """
+    sql = canonicalize_sql(sql)
+    check_quoted_placeholders(sql, parameters)
+    segments, slots = split_placeholders(sql)
+
+    formatters = {}
+    lists = {}
+    defaults = {}
+    for placeholder in set(slots):
+        param_data = parameters.get(placeholder)
+        if not param_data:
+            formatters[placeholder] = _missing_formatter(placeholder)
+            continue
+        param_type = param_data.get("type")
+        binder = PARAMETER_BINDERS.get(param_type)
+        formatters[placeholder] = (_bound_formatter(binder, placeholder, param_data) if binder
+                                   else _unsupported_formatter(param_type))
+        if param_type in LIST_ELEMENT_BINDERS:
+            lists[placeholder] = _bound_formatter(partial(list_literals, LIST_ELEMENT_BINDERS[param_type]),
+                                                  placeholder, param_data)
+        defaults[placeholder] = param_data.get("default")
+
+    return CompiledTemplate(version, name, segments, slots,
+                            MappingProxyType(formatters), MappingProxyType(lists), MappingProxyType(defaults),
+                            MappingProxyType(dict(options or {})))
+
+class TemplateCache(object):
+    """
+    In-process cache of compiled templates for saved API versions.
+    - Templates are keyed by version UUID and kept until evicted by the LRU,
+      since a saved version's SQL and parameters never change.
+    - Name -> latest UUID lookups are cached only while this process is
+      subscribed to the registry invalidation channel, and are dropped when
+      an update or delete is published for the name.
+    - preload() fills the cache at boot, e.g. in a pre-forking master; the
+      preloaded names are re-resolved whenever the listener subscribes.
+    """
+
+    def __init__(self, registry, max_size=1000, channel="query_wrapper:registry"):
+        self.registry = registry
+        self.redis_client = registry.redis_client
+        self.max_size = int(max_size)
+        self.channel = channel
+        self._templates = OrderedDict()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._listening = False
+        self._listener = None
+        self._generation = 0
+        self._preloaded = []
+        self._preload_batch_size = 500
+
+    # Invalidation
+
+    def ensure_listener(self):
+        """Start the invalidation subscriber for this process if it is not running."""
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen, name="template-cache-invalidation", daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        backoff = 0.5
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Anything cached before subscribing may have missed a message
+                self._resync()
+                backoff = 0.5
+                for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._handle_message(message.get("data"))
+            except Exception as e:
+                logger.warning(f"Template cache invalidation listener failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._listening = False
+                    self._latest.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _resync(self):
+        """
+        Start trusting the cache once subscribed: forget name lookups, drop
+        templates of versions deleted meanwhile, and re-resolve the preloaded
+        names in pipelined batches.
+        """
+        with self._lock:
+            self._latest.clear()
+            self._generation += 1
+            self._listening = True
+            generation = self._generation
+            versions = list(self._templates)
+        if versions:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for version in versions:
+                pipe.exists(version)
+            deleted = [version for version, exists in zip(versions, pipe.execute()) if not exists]
+            with self._lock:
+                for version in deleted:
+                    self._templates.pop(version, None)
+        self._load_names(self._preloaded, self._preload_batch_size, generation)
+
+    def _handle_message(self, data):
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        self.invalidate(payload.get("name"), payload.get("versions") or [])
+
+    def invalidate(self, name=None, versions=()):
+        """Drop the cached latest version for a name and any deleted versions."""
+        with self._lock:
+            self._generation += 1
+            if name:
+                self._latest.pop(name, None)
+            for version in versions:
+                self._templates.pop(version, None)
+
+    def publish_change(self, name, versions=()):
+        """Tell every worker that the version list for a name has changed."""
+        self.invalidate(name, versions)
+        try:
+            self.redis_client.publish(self.channel, json.dumps({"name": name, "versions": list(versions)}))
+        except Exception as e:
+            logger.warning(f"Failed to publish registry change for '{name}': {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._latest.clear()
+
+    # Lookups
+
+    def _store(self, template):
+        with self._lock:
+            self._templates[template.version] = template
+            self._templates.move_to_end(template.version)
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+
+    def _compile(self, uuid, record_data):
+        options = {key: value for key, value in record_data.items() if key not in RECORD_FIELDS}
+        return compile_template(record_data.get('sql'), record_data.get('parameters', {}),
+                                version=uuid, name=record_data.get('name'), options=options)
+
+    def _cached(self, uuid):
+        with self._lock:
+            template = self._templates.get(uuid, _MISSING)
+            if template is not _MISSING:
+                self._templates.move_to_end(uuid)
+                return template
+        return None
+
+    @property
+    def generation(self):
+        """Counter bumped on every invalidation; pass it back to add()."""
+        return self._generation
+
+    def lookup_by_version(self, uuid):
+        """Return the cached template for a version UUID, or None (no Redis access)."""
+        self.ensure_listener()
+        return self._cached(uuid)
+
+    def lookup_by_name(self, name):
+        """Return the cached template for the latest version of a name, or None (no Redis access)."""
+        self.ensure_listener()
+        latest_uuid = self._latest.get(name)
+        if latest_uuid is None:
+            return None
+        return self._cached(latest_uuid)
+
+    def add(self, uuid, record_data, name=None, generation=None):
+        """
+        Compile (unless cached) and store the template for a record read from the registry.
+        When name is given, remember uuid as its latest version, unless an
+        invalidation arrived since `generation` was read.
+        """
+        template = self._cached(uuid)
+        if template is None:
+            template = self._compile(uuid, record_data)
+            self._store(template)
+        if name is not None:
+            with self._lock:
+                if self._listening and generation == self._generation:
+                    self._latest[name] = uuid
+        return template
+
+    def _load_names(self, names, batch_size, generation=None):
+        """Resolve and cache the latest versions of names in pipelined batches; return the names loaded."""
+        loaded = []
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            for name, result in zip(batch, self.registry.resolve_many([("name", name) for name in batch])):
+                if isinstance(result, Exception):
+                    continue
+                try:
+                    self.add(result[0], result[1], name=name, generation=generation)
+                except ValueError as e:
+                    logger.warning(f"Failed to compile the saved query '{name}': {str(e)}")
+                    continue
+                loaded.append(name)
+        return loaded
+
+    def preload(self, names, batch_size=500):
+        """
+        Compile and cache the latest versions of API names, batch_size names
+        per pipelined Redis call. Returns the number of templates loaded.
+        """
+        self._preload_batch_size = max(int(batch_size), 1)
+        self._preloaded = self._load_names(list(names)[:self.max_size], self._preload_batch_size)
+        return len(self._preloaded)
+
+    def get_by_version(self, uuid):
+        """Return the compiled template for a version UUID."""
+        template = self.lookup_by_version(uuid)
+        if template is None:
+            template = self.add(uuid, self.registry.get_version(uuid))
+        return template
+
+    def get_by_name(self, name):
+        """Return the compiled template for the latest version of an API name."""
+        template = self.lookup_by_name(name)
+        if template is not None:
+            return template
+
+        # Resolve the latest version and its record in a single round trip
+        generation = self._generation
+        latest_uuid, record_data = self.registry.resolve_latest(name)
+        return self.add(latest_uuid, record_data, name=name, generation=generation)
+
+    def get_many(self, refs):
+        """
+        Return compiled templates for several ("name", api name) or
+        ("version", uuid) references, in order. Templates missing from memory
+        are resolved together in one pipelined Redis call; references that
+        cannot be resolved yield their ValueError instead of a template.
+        """
+        templates = [None] * len(refs)
+        missing = []
+        for index, (kind, value) in enumerate(refs):
+            if kind == "name":
+                templates[index] = self.lookup_by_name(value)
+            else:
+                templates[index] = self.lookup_by_version(value)
+            if templates[index] is None:
+                missing.append(index)
+        if not missing:
+            return templates
+
+        generation = self._generation
+        resolved = self.registry.resolve_many([refs[index] for index in missing])
+        for index, result in zip(missing, resolved):
+            if isinstance(result, Exception):
+                templates[index] = result
+                continue
+            uuid, record_data = result
+            kind, value = refs[index]
+            templates[index] = self.add(uuid, record_data, name=value if kind == "name" else None,
+                                        generation=generation)
+        return templates
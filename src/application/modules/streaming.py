@@ -0,0 +1,256 @@
+import json
+import re
+from flask import Response
+
+JSON = "json"
+NDJSON = "ndjson"
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+CHUNK_SIZE = 64 * 1024
+
+JSON_PREFIX = b'{"success": true, "data": '
+JSON_SUFFIX = b'}'
+
+STREAM_VALUES = {
+    "ndjson": NDJSON,
+    "json": JSON,
+    "true": JSON,
+    "1": JSON,
+    "false": None,
+    "0": None,
+    "": None,
+}
+
+# Next character that matters for tracking the document structure
+STRUCTURAL = re.compile(rb'[{}\[\]",:]')
+# Rest of a JSON string after its opening quote
+STRING_TAIL = re.compile(rb'(?:[^"\\]|\\.)*"', re.S)
+# One row of scalar values, optionally preceded by its separator
+FLAT_ROW = re.compile(rb'[\s,]*(\[(?:[^\[\]"]|"(?:[^"\\]|\\.)*")*\])', re.S)
+# Separator before the next row (or the end of the rows array)
+SEPARATOR = re.compile(rb'[\s,]*')
+# Characters that matter when scanning a nested row
+NESTED = re.compile(rb'[\[\]"]')
+
+def stream_format(stream_param, accept=None):
+    """
+    Return the requested streaming format (JSON, NDJSON) or None.
+    :param stream_param: Value of the `stream` query parameter, if any.
+    :param accept: Accept header; application/x-ndjson selects NDJSON.
+    Raises ValueError for an unknown `stream` value.
+    """
+    if stream_param is not None:
+        value = stream_param.strip().lower()
+        if value not in STREAM_VALUES:
+            raise ValueError("'stream' must be one of json, ndjson, true or false")
+        return STREAM_VALUES[value]
+    if accept and NDJSON_MIMETYPE in accept:
+        return NDJSON
+    return None
+
+class RowStreamer(object):
+    """
+    Incremental converter from a Pinot broker response to NDJSON lines.
+    - First line: {"dataSchema": ...}, when the schema precedes the rows.
+    - Then one line per row of resultTable.rows, copied as raw JSON text.
+    - Last line: {"metadata": ...} holding every other top-level field
+      (exceptions, stats). Its presence marks a complete stream.
+    Rows are never decoded into Python objects; only the small parts of the
+    document around them (schema, metadata) are parsed.
+    """
+
+    SEEK, ROWS, TAIL = range(3)
+
+    def __init__(self):
+        self.state = self.SEEK
+        self.buffer = bytearray()
+        self.pos = 0
+        self.stack = []  # [is_object, current key, expecting key] per open container
+        self.prefix = None
+        self.closers = b''
+
+    def feed(self, chunk):
+        """Consume a chunk of the broker response and return the complete NDJSON lines it produced."""
+        if self.state == self.TAIL:
+            self.buffer += chunk
+            return b''
+        self.buffer += chunk
+        out = []
+        if self.state == self.SEEK:
+            self._seek(out)
+        if self.state == self.ROWS:
+            self._rows(out)
+        return b''.join(out)
+
+    def finish(self):
+        """Return the trailing metadata line once the broker response is complete."""
+        if self.state == self.SEEK:
+            document = bytes(self.buffer)
+        elif self.state == self.ROWS:
+            raise ValueError("Broker response ended inside resultTable.rows")
+        else:
+            document = self.prefix + b'[]' + bytes(self.buffer)
+        metadata = json.loads(document) if document.strip() else {}
+        result_table = metadata.pop("resultTable", None)
+        lines = []
+        if self.prefix is None and isinstance(result_table, dict):
+            # The rows array was never found while streaming (unexpected layout)
+            if "dataSchema" in result_table:
+                lines.append(self._line({"dataSchema": result_table["dataSchema"]}))
+            lines.extend(self._line(row) for row in result_table.get("rows", []))
+        lines.append(self._line({"metadata": metadata}))
+        return b''.join(lines)
+
+    @staticmethod
+    def _line(value):
+        return json.dumps(value).encode('utf-8') + b'\n'
+
+    def _seek(self, out):
+        """Track the document structure until the resultTable.rows array opens."""
+        buffer = self.buffer
+        stack = self.stack
+        pos = self.pos
+        while True:
+            match = STRUCTURAL.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            char = buffer[match.start()]
+            if char == 0x22:  # '"'
+                end = STRING_TAIL.match(buffer, match.end())
+                if end is None:
+                    # Incomplete string; resume from its opening quote
+                    pos = match.start()
+                    break
+                if stack and stack[-1][0] and stack[-1][2]:
+                    stack[-1][1] = bytes(buffer[match.end():end.end() - 1])
+                    stack[-1][2] = False
+                pos = end.end()
+            elif char == 0x5b and len(stack) == 2 and stack[0][1] == b'resultTable' and stack[1][1] == b'rows':
+                self._start_rows(match.start(), out)
+                return
+            elif char in (0x7b, 0x5b):  # '{', '['
+                stack.append([char == 0x7b, None, char == 0x7b])
+                pos = match.end()
+            elif char in (0x7d, 0x5d):  # '}', ']'
+                if stack:
+                    stack.pop()
+                pos = match.end()
+            else:
+                if char == 0x2c and stack and stack[-1][0]:  # ',' inside an object
+                    stack[-1][2] = True
+                pos = match.end()
+        self.pos = pos
+
+    def _start_rows(self, start, out):
+        self.prefix = bytes(self.buffer[:start])
+        self.closers = b'}' * len(self.stack)
+        header = json.loads(self.prefix + b'[]' + self.closers).get("resultTable", {})
+        if "dataSchema" in header:
+            out.append(self._line({"dataSchema": header["dataSchema"]}))
+        del self.buffer[:start + 1]
+        self.pos = 0
+        self.state = self.ROWS
+
+    def _rows(self, out):
+        """Copy complete rows to the output and keep any partial row buffered."""
+        buffer = self.buffer
+        pos = 0
+        length = len(buffer)
+        while pos < length:
+            match = FLAT_ROW.match(buffer, pos)
+            if match is not None:
+                row = match.group(1)
+            else:
+                pos = SEPARATOR.match(buffer, pos).end()
+                if pos >= length:
+                    break
+                if buffer[pos] == 0x5d:  # ']' closes the rows array
+                    self.buffer = bytearray(buffer[pos + 1:])
+                    self.state = self.TAIL
+                    return
+                end = self._nested_row_end(buffer, pos)
+                if end is None:
+                    break
+                row = buffer[pos:end]
+            if b'\n' in row or b'\r' in row:
+                # Only insignificant whitespace can hold raw line breaks
+                row = row.replace(b'\r', b' ').replace(b'\n', b' ')
+            out.append(bytes(row) + b'\n')
+            pos = match.end() if match is not None else end
+        del buffer[:pos]
+
+    @staticmethod
+    def _nested_row_end(buffer, start):
+        """Return the end of a row holding nested arrays, or None if it is incomplete."""
+        depth = 0
+        pos = start
+        while True:
+            match = NESTED.search(buffer, pos)
+            if match is None:
+                return None
+            char = buffer[match.start()]
+            if char == 0x22:
+                end = STRING_TAIL.match(buffer, match.end())
+                if end is None:
+                    return None
+                pos = end.end()
+                continue
+            depth += 1 if char == 0x5b else -1
+            pos = match.end()
+            if depth == 0:
+                return pos
+
+def iter_stream(chunks, fmt):
+    """
+    Convert an iterable of broker response chunks into the output chunks of
+    a streaming format. JSON wraps the broker's bytes unchanged.
+    """
+    if fmt == JSON:
+        yield JSON_PREFIX
+        for chunk in chunks:
+            yield chunk
+        yield JSON_SUFFIX
+        return
+    streamer = RowStreamer()
+    for chunk in chunks:
+        lines = streamer.feed(chunk)
+        if lines:
+            yield lines
+    yield streamer.finish()
+
+async def aiter_stream(chunks, fmt):
+    """asyncio equivalent of iter_stream for an async iterable of chunks."""
+    if fmt == JSON:
+        yield JSON_PREFIX
+        async for chunk in chunks:
+            yield chunk
+        yield JSON_SUFFIX
+        return
+    streamer = RowStreamer()
+    async for chunk in chunks:
+        lines = streamer.feed(chunk)
+        if lines:
+            yield lines
+    yield streamer.finish()
+
+def mimetype_for(fmt):
+    return NDJSON_MIMETYPE if fmt == NDJSON else "application/json"
+
+def stream_query(pinot_client, token, sql, fmt):
+    """
+    Run a query and stream the broker response back in the given format.
+    Raises PinotQueryError, DeadlineExceeded or requests.RequestException
+    before any output is produced, so callers can still answer with a normal
+    error response. A client that disconnects closes the broker response.
+    """
+    response = pinot_client.stream(sql, token)
+
+    def generate():
+        try:
+            for chunk in iter_stream(response.iter_content(CHUNK_SIZE), fmt):
+                yield chunk
+        finally:
+            response.close()
+
+    return Response(generate(), mimetype=mimetype_for(fmt))
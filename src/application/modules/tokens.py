@@ -0,0 +1,164 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class _Flight(object):
+    """An in-flight validation that other callers can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class TokenCache(object):
+    """
+    Process-wide cache of bearer token validation results.
+    - Bounded LRU with separate TTLs for valid and invalid tokens.
+    - Keyed by a SHA-256 hash of the token; raw tokens are never stored.
+    - Optionally shared between workers through Redis.
+    - Concurrent validations of the same token share one outbound call.
+    """
+
+    def __init__(self, max_size=10000, valid_ttl=300, invalid_ttl=30,
+                 redis_client=None, key_prefix="token:", wait_timeout=10):
+        self.max_size = int(max_size)
+        self.valid_ttl = float(valid_ttl)
+        self.invalid_ttl = float(invalid_ttl)
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.wait_timeout = float(wait_timeout)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def token_key(token):
+        """Return the cache key for a token."""
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            valid, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return valid
+
+    def _set_local(self, key, valid, ttl):
+        with self._lock:
+            self._entries[key] = (valid, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, key):
+        if self.redis_client is None:
+            return None
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(self.key_prefix + key)
+            pipe.pttl(self.key_prefix + key)
+            value, pttl = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Token cache Redis lookup failed: {str(e)}")
+            return None
+        if value is None:
+            return None
+        valid = value == "1"
+        ttl = self.valid_ttl if valid else self.invalid_ttl
+        if pttl and pttl > 0:
+            ttl = min(ttl, pttl / 1000.0)
+        self._set_local(key, valid, ttl)
+        return valid
+
+    def _set_shared(self, key, valid, ttl):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self.key_prefix + key, "1" if valid else "0", px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Token cache Redis write failed: {str(e)}")
+
+    def get_local(self, token):
+        """Return the result cached in this process for a token, or None."""
+        return self._get_local(self.token_key(token))
+
+    def set_local(self, token, valid):
+        """Cache a validation result in this process only."""
+        ttl = self.valid_ttl if valid else self.invalid_ttl
+        if ttl > 0:
+            self._set_local(self.token_key(token), valid, ttl)
+
+    def get(self, token):
+        """Return the cached result for a token, or None if unknown or expired."""
+        key = self.token_key(token)
+        valid = self._get_local(key)
+        if valid is None:
+            valid = self._get_shared(key)
+        return valid
+
+    def set(self, token, valid):
+        """Cache a validation result using the TTL for its outcome."""
+        key = self.token_key(token)
+        ttl = self.valid_ttl if valid else self.invalid_ttl
+        if ttl <= 0:
+            return
+        self._set_local(key, valid, ttl)
+        self._set_shared(key, valid, ttl)
+
+    def invalidate(self, token):
+        """Drop a token from the local and shared tiers."""
+        key = self.token_key(token)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.delete(self.key_prefix + key)
+            except Exception as e:
+                logger.warning(f"Token cache Redis delete failed: {str(e)}")
+
+    def validate(self, token, validator):
+        """
+        Return whether the token is valid, calling validator(token) on a miss.
+        The validator returns True or False for a definitive answer, which is
+        cached, or None for a transient failure, which is treated as invalid
+        but not cached.
+        """
+        cached = self.get(token)
+        if cached is not None:
+            return cached
+
+        key = self.token_key(token)
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+
+        if not leader:
+            # Another thread is already validating this token
+            flight.event.wait(self.wait_timeout)
+            return bool(flight.result)
+
+        try:
+            flight.result = validator(token)
+            if flight.result is not None:
+                self.set(token, flight.result)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+        return bool(flight.result)
+
+    def clear(self):
+        """Empty the local tier."""
+        with self._lock:
+            self._entries.clear()
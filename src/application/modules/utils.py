@@ -1,10 +1,25 @@
+import logging
 import redis
 from functools import wraps
 from flask import request, jsonify
 import re
-import json
-from flask import current_app, session
+from flask import current_app
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from application.modules.tokens import TokenCache
+from application.modules.registry import Registry
+from application.modules.resultcache import ResultCache
+from application.modules.singleflight import SingleFlight
+from application.modules.pagination import ResultStore
+from application.modules.querystats import QueryStats
+from application.modules.brokers import BrokerPool, parse_brokers
+from application.modules.admission import API_RATE, CONCURRENCY, TOKEN_RATE, ConcurrencyLimiter, RateLimiter
+from application.modules.sqltemplate import TemplateCache, check_quoted_placeholders, compile_template
+from application.modules.binding import PARAMETER_BINDERS, canonicalize_sql, get_binder, split_placeholders
+from application.modules.metrics import ADMISSION_REJECTED_TOTAL, Metrics, TOKEN_VALIDATION
+from application.modules.serialization import has_exceptions
+
+logger = logging.getLogger(__name__)
 
 def normalize_name(name):
     """
@@ -23,12 +38,13 @@ def validate_sql_and_parameters(sql, parameters):
     Validate that every parameter in the SQL query exists in the parameters object
     and that the object types are valid.
     """
-    print("got here")
-    # Extract placeholders from the SQL query
-    placeholders = re.findall(r"%(\w+)%", sql)
-    
+    # Extract placeholders from the SQL query; values are never bound inside quotes
+    sql = canonicalize_sql(sql)
+    check_quoted_placeholders(sql, parameters)
+    placeholders = split_placeholders(sql)[1]
+
     # Check if each placeholder exists in the parameters and has a valid type
-    valid_types = {"column", "string", "integer", "bool"}
+    valid_types = set(PARAMETER_BINDERS)
     for placeholder in placeholders:
         if placeholder not in parameters:
             raise ValueError(f"Missing parameter definition for '{placeholder}' in parameters")
@@ -40,45 +56,83 @@ def validate_sql_and_parameters(sql, parameters):
             raise ValueError(f"Missing default definition for '{placeholder}'")
         param_type = parameters[placeholder].get("type")
         if param_type not in valid_types:
-            raise ValueError(f"Invalid type '{param_type}' for parameter '{placeholder}'. Must be one of {valid_types}")
+            raise ValueError(f"Invalid type '{param_type}' for parameter '{placeholder}'. Must be one of {sorted(valid_types)}")
+        allowed = parameters[placeholder].get("allowed")
+        if allowed is not None and (not isinstance(allowed, list) or not all(isinstance(value, str) for value in allowed)):
+            raise ValueError(f"'allowed' for parameter '{placeholder}' must be a list of strings")
+        # A null default makes the parameter required; any other default must bind
+        default = parameters[placeholder]["default"]
+        if default is not None:
+            PARAMETER_BINDERS[param_type](placeholder, default, parameters[placeholder])
 
-def is_token_valid(token):
+def check_token_with_broker(token):
     """
-    Function to validate the bearer token using Pinot's cluster_health endpoint.
-    Caches the validation result in the Flask session to avoid redundant checks.
+    Validate the bearer token using Pinot's health endpoint.
+    Returns True or False for a definitive answer from the broker, or None
+    when the broker could not give one (network error, 5xx).
     """
     try:
-        # Check if the token is already validated and cached in the session
-        if session.get("validated_token") == token:
-            return True
-
-        # Retrieve the Pinot broker URL from the Flask app config
-        pinot_config = current_app.config.get("PINOT_CONFIG")
-        broker_url = pinot_config.get("broker")
-        if not broker_url:
+        pinot_client = current_app.get_pinot_client()
+        if not pinot_client.broker_url:
             raise ValueError("Pinot broker URL is missing in the configuration")
 
-        # Use the broker URL to validate the token
-        validate_url = f"{broker_url}/health"
-        headers = {"Authorization": f"Bearer {token}"}
-
-        # Send the request to validate the token
-        response = requests.get(validate_url, headers=headers)
+        response = pinot_client.health(token)
 
-        # If the response is successful, cache the token in the session
         if response.status_code == 200:
-            session["validated_token"] = token
             return True
-
-        return False
+        if response.status_code in (401, 403):
+            return False
+        return None
 
     except requests.RequestException as e:
-        # Log or handle the exception as needed
-        print(f"Error validating token: {str(e)}")
-        return False
+        logger.warning(f"Error validating token: {str(e)}")
+        return None
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        return False
+        logger.warning(f"Unexpected error validating token: {str(e)}")
+        return None
+
+def validate_cache_config(cache):
+    """
+    Validate the optional result-cache settings of a saved API:
+    {"ttl": seconds > 0, "stale_ttl": seconds >= 0, "scope": "token" | "global"}
+    """
+    if cache is None:
+        return
+    if not isinstance(cache, dict):
+        raise ValueError("'cache' must be an object")
+    ttl = cache.get("ttl")
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+        raise ValueError("'cache.ttl' must be a positive number of seconds")
+    stale_ttl = cache.get("stale_ttl", 0)
+    if isinstance(stale_ttl, bool) or not isinstance(stale_ttl, (int, float)) or stale_ttl < 0:
+        raise ValueError("'cache.stale_ttl' must be a non-negative number of seconds")
+    scope = cache.get("scope", "token")
+    if scope not in ("token", "global"):
+        raise ValueError("'cache.scope' must be 'token' or 'global'")
+
+def max_api_timeout():
+    """Longest timeout a saved API may set: DEADLINE_CONFIG["max_timeout"] (0 or None for no limit)."""
+    return (current_app.config.get('DEADLINE_CONFIG') or {}).get('max_timeout')
+
+def validate_timeout(timeout, max_timeout=None):
+    """Validate the optional query timeout of a saved API: seconds > 0, up to max_timeout if given."""
+    if timeout is None:
+        return
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        raise ValueError("'timeout' must be a positive number of seconds")
+    if max_timeout and timeout > max_timeout:
+        raise ValueError(f"'timeout' may be at most {max_timeout:g} seconds")
+
+def is_token_valid(token):
+    """
+    Function to validate the bearer token using Pinot's cluster_health endpoint.
+    Results are cached process-wide (and optionally in Redis) by the token cache,
+    and concurrent checks of the same token share a single broker call.
+    """
+    token_cache = current_app.extensions.get('token_cache')
+    if token_cache is None:
+        return bool(check_token_with_broker(token))
+    return token_cache.validate(token, check_token_with_broker)
 
 def verify_bearer_token():
     """
@@ -102,7 +156,9 @@ def verify_bearer_token():
             bearer_token = auth_header.split(" ", 1)[1]
 
             # Validate the token
-            if not is_token_valid(bearer_token):
+            with current_app.extensions['metrics'].stage(TOKEN_VALIDATION):
+                valid = is_token_valid(bearer_token)
+            if not valid:
                 return jsonify({"error": "Invalid or expired token"}), 401
 
             # Pass the token to the view function
@@ -111,6 +167,284 @@ def verify_bearer_token():
         return wrapper
     return decorator
 
+ADMISSION_ERRORS = {
+    TOKEN_RATE: "Rate limit exceeded for this token",
+    API_RATE: "Rate limit exceeded for this API",
+    CONCURRENCY: "Too many queries in progress",
+}
+
+def reject_request(reason, retry_after):
+    """429 response for a request turned away by admission control."""
+    current_app.extensions['metrics'].inc(ADMISSION_REJECTED_TOTAL, (reason,))
+    response = jsonify({"success": False, "error": ADMISSION_ERRORS[reason], "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def version_api(template_cache, uuid):
+    """Name of the saved API a version belongs to, loading the version into the template cache; None if unknown."""
+    try:
+        return template_cache.get_by_version(uuid).name
+    except ValueError:
+        return None
+
+def requested_apis(kwargs):
+    """Saved API of each query a request runs, from its route arguments (None for a pass-through query)."""
+    if kwargs.get('name'):
+        return [kwargs['name'].lower().replace(" ", "_")]
+    if kwargs.get('uuid'):
+        return [version_api(current_app.extensions['template_cache'], kwargs['uuid'])]
+    return [None]
+
+def admission_control(apis=None):
+    """
+    Decorator for routes that query Pinot, placed under @verify_bearer_token().
+    - Checks the token's and the APIs' rate limits; over the limit, answers
+      429 with Retry-After at once.
+    - Holds one of the worker's concurrent query slots per query while the
+      view runs (until a streamed response is closed); when they do not free
+      up within the queue timeout, answers 429.
+    :param apis: Function returning the saved API of each query the current request runs
+                 (default: the API of the route's name or uuid argument).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(token, *args, **kwargs):
+            queries = apis() if apis else requested_apis(kwargs)
+            rate_limiter = current_app.extensions.get('rate_limiter')
+            if rate_limiter is not None:
+                rejection = rate_limiter.check(token, queries)
+                if rejection is not None:
+                    return reject_request(*rejection)
+
+            concurrency_limiter = current_app.extensions.get('concurrency_limiter')
+            if concurrency_limiter is None:
+                return func(token, *args, **kwargs)
+            slots = max(len(queries), 1)
+            if not concurrency_limiter.acquire(slots):
+                return reject_request(CONCURRENCY, 1)
+            try:
+                response = current_app.make_response(func(token, *args, **kwargs))
+            except BaseException:
+                concurrency_limiter.release(slots)
+                raise
+            if response.is_streamed:
+                response.call_on_close(lambda: concurrency_limiter.release(slots))
+            else:
+                concurrency_limiter.release(slots)
+            return response
+
+        return wrapper
+    return decorator
+
+def create_token_cache(config, redis_client=None):
+    """Initialize and return the token validation cache."""
+    config = config or {}
+    return TokenCache(
+        max_size=config.get('max_size', 10000),
+        valid_ttl=config.get('valid_ttl', 300),
+        invalid_ttl=config.get('invalid_ttl', 30),
+        redis_client=redis_client if config.get('use_redis') else None
+    )
+
+def create_template_cache(config, registry):
+    """Initialize and return the compiled query-template cache."""
+    config = config or {}
+    return TemplateCache(
+        registry,
+        max_size=config.get('max_size', 1000),
+        channel=config.get('channel', 'query_wrapper:registry')
+    )
+
+def warm_template_cache(config, registry, template_cache, query_stats=None):
+    """
+    Preload the template cache with the latest versions of saved APIs: the
+    top_n most executed ones (from query stats), or every API name when
+    top_n is 0, up to the cache size. Returns the number of templates loaded.
+    """
+    config = config or {}
+    if not config.get('enabled', True):
+        return 0
+    top_n = int(config.get('top_n', 0))
+    batch_size = int(config.get('batch_size', 500))
+    if top_n > 0 and query_stats is not None:
+        names = query_stats.top_apis(min(top_n, template_cache.max_size), window=config.get('window', 86400))
+    else:
+        names, cursor = [], None
+        while len(names) < template_cache.max_size:
+            page, cursor = registry.list_names(limit=min(batch_size, template_cache.max_size - len(names)),
+                                               cursor=cursor)
+            names.extend(page)
+            if cursor is None:
+                break
+    return template_cache.preload(names, batch_size)
+
+def create_result_cache(config, redis_client, metrics=None):
+    """Initialize and return the Pinot result cache."""
+    config = config or {}
+    return ResultCache(
+        redis_client if config.get('use_redis', True) else None,
+        max_entries=config.get('max_entries', 1000),
+        max_bytes=config.get('max_bytes', 64 * 1024 * 1024),
+        refresh_workers=config.get('refresh_workers', 2),
+        metrics=metrics
+    )
+
+def create_broker_pool(pinot_config, client_config):
+    """Initialize and return the load balancer and circuit breakers of the configured Pinot brokers."""
+    client_config = client_config or {}
+    return BrokerPool(
+        parse_brokers(pinot_config),
+        balancer=client_config.get('balancer', 'least_outstanding'),
+        failure_threshold=client_config.get('failure_threshold', 5),
+        open_seconds=client_config.get('open_seconds', 30),
+        probe_interval=client_config.get('probe_interval', 10),
+        probe_timeout=client_config.get('connect_timeout', 3.05)
+    )
+
+def create_rate_limiter(config, redis_client):
+    """Initialize and return the Redis token-bucket rate limiter, or None if admission control is disabled."""
+    config = config or {}
+    if not config.get('enabled', True):
+        return None
+    return RateLimiter(
+        redis_client,
+        token_rate=config.get('token_rate', 50),
+        token_burst=config.get('token_burst', 100),
+        api_rate=config.get('api_rate', 0),
+        api_burst=config.get('api_burst', 0),
+        api_limits=config.get('api_limits')
+    )
+
+def create_concurrency_limiter(config):
+    """Initialize and return the per-worker concurrent query cap, or None if disabled."""
+    config = config or {}
+    if not config.get('enabled', True) or int(config.get('max_concurrent', 32)) <= 0:
+        return None
+    return ConcurrencyLimiter(
+        max_concurrent=config.get('max_concurrent', 32),
+        max_queue=config.get('max_queue', 64),
+        queue_timeout=config.get('queue_timeout', 2)
+    )
+
+def create_query_stats(config, redis_client):
+    """Initialize and return the per-API query cost recorder, or None if disabled."""
+    config = config or {}
+    if not config.get('enabled', True):
+        return None
+    return QueryStats(
+        redis_client,
+        slow_query_ms=config.get('slow_query_ms', 1000),
+        slow_log_size=config.get('slow_log_size', 1000),
+        flush_interval=config.get('flush_interval', 5),
+        minute_retention=config.get('minute_retention', 86400),
+        hour_retention=config.get('hour_retention', 30 * 86400),
+        log_raw_sql=config.get('log_raw_sql', False)
+    )
+
+def create_metrics(config):
+    """Initialize and return the process-wide metrics registry; recording is a no-op when disabled."""
+    config = config or {}
+    return Metrics(enabled=config.get('enabled', True))
+
+def create_single_flight(config, redis_client, metrics=None):
+    """Initialize and return the single-flight query coalescer, or None if disabled."""
+    config = config or {}
+    if not config.get('enabled', True):
+        return None
+    return SingleFlight(
+        redis_client if config.get('use_redis', True) else None,
+        lock_ttl=config.get('lock_ttl', 30),
+        result_ttl=config.get('result_ttl', 5),
+        wait_timeout=config.get('wait_timeout', 30),
+        metrics=metrics
+    )
+
+def create_result_store(config, redis_client):
+    """Initialize and return the Redis store for paged results, or None if disabled."""
+    config = config or {}
+    if not config.get('store_enabled', True):
+        return None
+    return ResultStore(
+        redis_client,
+        ttl=config.get('store_ttl', 300),
+        max_rows=config.get('store_max_rows', 100000)
+    )
+
+def create_batch_executor(config):
+    """
+    Initialize and return the bounded thread pool shared by batch executions.
+    Worker threads are only started on first use, so this is safe before forking.
+    """
+    config = config or {}
+    return ThreadPoolExecutor(max_workers=int(config.get('max_workers', 16)), thread_name_prefix="batch-execute")
+
+def fetch_coalesced(single_flight, pinot_client, sql, token, fingerprint=None, on_response=None):
+    """
+    Run a query through the single-flight layer, so identical concurrent
+    queries with the same token share one call to Pinot. Queries are
+    identified by their fingerprint when given, otherwise by their SQL.
+    on_response, if given, is called with each response actually fetched
+    from Pinot (not with responses shared by another caller).
+    Returns (response, response body); the body is None when the
+    response carries query exceptions and must not be shared or cached.
+    """
+    def fetch():
+        pinot_response, payload = pinot_client.fetch(sql, token)
+        if on_response is not None:
+            on_response(pinot_response)
+        return pinot_response, None if has_exceptions(pinot_response) else payload
+
+    if single_flight is None:
+        return fetch()
+    return single_flight.do(single_flight.make_key(fingerprint or sql, TokenCache.token_key(token)), fetch)
+
+def parse_batch_items(data, max_items):
+    """
+    Validate a batch request body.
+    Returns (item ids, ("name" | "version", value) references, parameters) or raises ValueError.
+    """
+    items = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("Batch must include a non-empty 'queries' list")
+    if len(items) > max_items:
+        raise ValueError(f"Batch may include at most {max_items} queries")
+
+    ids, refs, parameters = [], [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"Query {index} must be an object")
+        item_id = str(item.get('id', index))
+        if item_id in ids:
+            raise ValueError(f"Duplicate query id '{item_id}'")
+        if bool(item.get('name')) == bool(item.get('version')):
+            raise ValueError(f"Query '{item_id}' must include exactly one of 'name' or 'version'")
+        if item.get('name'):
+            refs.append(("name", str(item['name']).lower().replace(" ", "_")))  # Normalize the name
+        else:
+            refs.append(("version", str(item['version'])))
+        item_parameters = item.get('parameters', {})
+        if not isinstance(item_parameters, dict):
+            raise ValueError(f"Query '{item_id}' parameters must be an object")
+        ids.append(item_id)
+        parameters.append(item_parameters)
+    return ids, refs, parameters
+
+def batch_apis(refs, versions):
+    """
+    Saved API of each query of a batch, for admission control.
+    :param refs: ("name" | "version", value) references of the queries.
+    :param versions: Templates (or errors, which yield None) of the "version" references, in order.
+    """
+    templates = iter(versions)
+    apis = []
+    for kind, value in refs:
+        if kind == "name":
+            apis.append(value)
+            continue
+        template = next(templates)
+        apis.append(None if isinstance(template, Exception) else template.name)
+    return apis
+
 def create_redis_client(config):
     """Initialize and return a Redis client."""
     return redis.StrictRedis(
@@ -129,23 +463,13 @@ def get_sql_and_parameters(redis_client, identifier, is_name=True):
     :param is_name: True if identifier is a name, False if it's a UUID.
     :return: Tuple (SQL string, parameters dictionary, name or UUID).
     """
+    registry = Registry(redis_client)
     if is_name:
-        # Fetch the latest version for the name
-        if not redis_client.exists(identifier):
-            raise ValueError(f"API name '{identifier}' not found")
-        latest_uuid = redis_client.lindex(identifier, 0)
-        record = redis_client.get(latest_uuid)
-        if not record:
-            raise ValueError(f"No valid record found for API name '{identifier}'")
+        # Fetch the latest version and its record in one round trip
+        _, record_data = registry.resolve_latest(identifier)
     else:
-        # Fetch the record for the UUID
-        if not redis_client.exists(identifier):
-            raise ValueError(f"Version '{identifier}' not found")
-        record = redis_client.get(identifier)
-        if not record:
-            raise ValueError(f"No valid record found for version '{identifier}'")
-    
-    record_data = json.loads(record)
+        record_data = registry.get_version(identifier)
+
     sql = record_data.get('sql')
     parameters = record_data.get('parameters', {})
     return sql, parameters, identifier
@@ -157,38 +481,14 @@ def format_parameter(value, param_type):
     :param param_type: The type of the parameter (e.g., "column", "string").
     :return: Formatted parameter value as a string.
     """
-    if param_type == "column":
-        return f'"{value}"'  # Double quotes for column names
-    if param_type == "table":
-        return str(value)  # No quotes for table names
-    elif param_type == "string":
-        return f"'{value}'"  # Single quotes for strings
-    elif param_type == "integer":
-        return str(value)  # No quotes for integers
-    elif param_type == "bool":
-        return "TRUE" if value else "FALSE"  # Boolean values without quotes
-    else:
-        raise ValueError(f"Unsupported parameter type: {param_type}")
+    return get_binder(param_type)("value", value, {})
 
 def replace_parameters_in_sql(sql, parameters, user_params):
     """
     Replace placeholders in the SQL query with actual parameter values.
     :param sql: SQL string with placeholders (e.g., %param1%).
     :param parameters: Dictionary of parameters with "default" and "type".
-    :param user_params: User-provided parameter values from the request.
-    :return: Processed SQL string with values replaced.
-    """
-    def replace_placeholder(match):
-        placeholder = match.group(1)  # Extract the parameter name
-        param_data = parameters.get(placeholder)
-        if not param_data:
-            raise ValueError(f"Parameter '{placeholder}' not found in defaults or provided data")
-        
-        # Get the value from user input or defaults
-        value = user_params.get(placeholder, param_data["default"])
-        param_type = param_data["type"]
-        return format_parameter(value, param_type)
-
-    # Use regex to find and replace %param% placeholders
-    processed_sql = re.sub(r"%(\w+)%", replace_placeholder, sql)
-    return processed_sql
\ No newline at end of file
+    :param user_params: User-provided parameter values from the request; list types take a list of values.
+    :return: Processed SQL string with values replaced; lists become comma-separated literals for IN (...).
+    """
+    return compile_template(sql, parameters).render(user_params)
@@ -1,9 +1,53 @@
-from flask import Blueprint, current_app
-from application.modules import create, delete, get, query, update
-import json
+from flask import Blueprint, current_app, request
+from application.modules.utils import verify_bearer_token
+from application.modules.serialization import dumps
 
 mod = Blueprint('views', __name__, url_prefix='/v1')
 
 @mod.route('/', methods=['GET', 'POST'])
 def index():
-    return json.dumps({'success': True}), 200, {'Content-Type':'application/json'}
\ No newline at end of file
+    return dumps({'success': True}), 200, {'Content-Type':'application/json'}
+
+@mod.route('/stats/queries', methods=['GET'])
+@verify_bearer_token()
+def query_stats(token):
+    """
+    Report the Pinot cost of each saved API and version over the last ?window= seconds (default 3600).
+    - ?api= limits the report to one API name.
+    """
+    recorder = current_app.extensions.get('query_stats')
+    if recorder is None:
+        return dumps({'success': False, 'error': 'Query stats are disabled'}), 404, {'Content-Type':'application/json'}
+    try:
+        window = int(request.args.get('window', 3600))
+        if window <= 0:
+            raise ValueError
+    except ValueError:
+        return dumps({'success': False, 'error': "'window' must be a positive number of seconds"}), 400, {'Content-Type':'application/json'}
+    recorder.flush()
+    apis = recorder.summary(window, request.args.get('api'))
+    return dumps({'success': True, 'window': window, 'apis': apis}), 200, {'Content-Type':'application/json'}
+
+@mod.route('/stats/slow', methods=['GET'])
+@verify_bearer_token()
+def slow_queries(token):
+    """Return the most recent slow queries (?limit=, default 100), optionally for one ?api= only."""
+    recorder = current_app.extensions.get('query_stats')
+    if recorder is None:
+        return dumps({'success': False, 'error': 'Query stats are disabled'}), 404, {'Content-Type':'application/json'}
+    try:
+        limit = int(request.args.get('limit', 100))
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return dumps({'success': False, 'error': "'limit' must be a positive integer"}), 400, {'Content-Type':'application/json'}
+    recorder.flush()
+    queries = recorder.slow_queries(limit, request.args.get('api'))
+    return dumps({'success': True, 'queries': queries}), 200, {'Content-Type':'application/json'}
+
+@mod.route('/stats/brokers', methods=['GET'])
+@verify_bearer_token()
+def broker_stats(token):
+    """Report the load, latency and circuit breaker state of each Pinot broker as seen by this worker."""
+    broker_pool = current_app.extensions['broker_pool']
+    return dumps(dict(broker_pool.describe(), success=True)), 200, {'Content-Type':'application/json'}
@@ -1,6 +1,8 @@
-from flask import Blueprint, current_app, request, jsonify
-from application.modules.utils import verify_bearer_token, normalize_name, validate_sql_and_parameters
-import json
+from flask import Blueprint, current_app, request
+from application.modules.utils import verify_bearer_token, normalize_name, validate_sql_and_parameters, validate_cache_config
+from application.modules.utils import max_api_timeout, validate_timeout
+from application.modules.registry import RegistryError
+from application.modules.serialization import dumps
 import uuid
 
 mod = Blueprint('v1create', __name__, url_prefix='/v1/create')
@@ -17,29 +19,31 @@ def index(token):
         processed_request['sql'] = data['sql']
         processed_request['parameters'] = data['parameters']
         processed_request['active'] = True
+        processed_request['cache'] = data.get('cache')
+        processed_request['timeout'] = data.get('timeout')
 
         # Validate SQL and parameters
         validate_sql_and_parameters(processed_request['sql'], processed_request['parameters'])
+        validate_cache_config(processed_request['cache'])
+        validate_timeout(processed_request['timeout'], max_api_timeout())
 
     except KeyError as e:
-        return json.dumps({'success': False, "error": f"Missing key: {str(e)}"}), 401, {'Content-Type': 'application/json'}
+        return dumps({'success': False, "error": f"Missing key: {str(e)}"}), 401, {'Content-Type': 'application/json'}
     except ValueError as e:
-        return json.dumps({'success': False, "error": str(e)}), 400, {'Content-Type': 'application/json'}
+        return dumps({'success': False, "error": str(e)}), 400, {'Content-Type': 'application/json'}
 
     # Generate a UUID for the request
     request_id = str(uuid.uuid4())
 
-    # Store the processed_request in Redis
-    redis_client = current_app.get_redis_client()
+    # Store the processed_request in Redis (existence check, record and name list in one atomic call)
+    registry = current_app.extensions['registry']
     try:
-        # Check if the key already exists
-        if redis_client.exists(processed_request['name']):
-            return json.dumps({'success': False, "error": f"Key '{processed_request['name']}' already exists"}), 409, {'Content-Type': 'application/json'}
-
-        redis_client.set(request_id, json.dumps(processed_request))
-        redis_client.lpush(processed_request['name'], request_id)
+        registry.create(processed_request['name'], request_id, processed_request['sql'], processed_request['parameters'],
+                        options={'cache': processed_request['cache'], 'timeout': processed_request['timeout']})
+    except RegistryError as e:
+        return dumps({'success': False, "error": str(e)}), e.status_code, {'Content-Type': 'application/json'}
     except Exception as e:
-        return json.dumps({'success': False, "error": "Failed to store request in Redis", "details": str(e)}), 500, {'Content-Type': 'application/json'}
+        return dumps({'success': False, "error": "Failed to store request in Redis", "details": str(e)}), 500, {'Content-Type': 'application/json'}
 
     # Return success response with the generated UUID
-    return json.dumps({'success': True, "id": request_id}), 200, {'Content-Type': 'application/json'}
\ No newline at end of file
+    return dumps({'success': True, "id": request_id}), 200, {'Content-Type': 'application/json'}
\ No newline at end of file
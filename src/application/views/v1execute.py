@@ -1,101 +1,465 @@
 from flask import Blueprint, current_app, request, jsonify
-from application.modules.utils import verify_bearer_token, get_sql_and_parameters, replace_parameters_in_sql
-import json
+from application.modules.utils import verify_bearer_token, admission_control, fetch_coalesced, parse_batch_items
+from application.modules.utils import batch_apis, max_api_timeout
+from application.modules.pinot import PinotQueryError
+from application.modules.tokens import TokenCache
+from application.modules.streaming import stream_query
+from application.modules.formats import FormatUnavailable, format_response, requested_output
+from application.modules.pagination import PageCursor, parse_page_request, sql_hash, window_sql
+from application.modules.splitting import merge_cache_status, merge_responses, split_plan
+from application.modules.metrics import (REGISTRY_LOOKUP, SERIALIZATION, TEMPLATE_BINDING, clear_api_labels,
+                                         set_api_labels)
+from application.modules.logs import bind_context
+from application.modules.deadlines import DeadlineExceeded, apply_api_timeout, limit_deadline, remaining
+from concurrent.futures import wait
+import logging
 import requests
+import time
 
 mod = Blueprint('v1execute', __name__, url_prefix='/v1/execute')
 
+logger = logging.getLogger(__name__)
+
+def query_template(pinot_client, single_flight, result_cache, token, template, processed_sql, fingerprint=None,
+                   query_stats=None):
+    """
+    Send the rendered SQL of a saved version to Pinot.
+    Versions saved with a "cache" setting are served through the result cache.
+    The fingerprint of the bound parameters, when given, keys the cache and
+    query coalescing instead of the SQL text.
+    Every query that reaches Pinot is recorded in query_stats, when given.
+    Returns (response body, status code, cache status or None). Does not
+    need an application context, so it can run on batch worker threads.
+    """
+    # Label the Pinot and cache metrics of this thread with the saved API
+    set_api_labels(template.name, template.version)
+    cache_config = template.options.get('cache')
+    on_response = None
+    if query_stats is not None:
+        def on_response(pinot_response):
+            query_stats.record(template.name, template.version, pinot_response, processed_sql, fingerprint)
+    try:
+        if not cache_config:
+            # Send the query to the Pinot broker, sharing identical in-flight queries
+            pinot_response, _ = fetch_coalesced(single_flight, pinot_client, processed_sql, token, fingerprint,
+                                                on_response)
+            return {"success": True, "data": pinot_response}, 200, None
+
+        scope = "" if cache_config.get('scope') == 'global' else TokenCache.token_key(token)
+        key = result_cache.make_key(template.version, fingerprint or processed_sql, scope)
+
+        def load():
+            # Responses carrying query exceptions are returned but never cached
+            return fetch_coalesced(single_flight, pinot_client, processed_sql, token, fingerprint, on_response)
+
+        pinot_response, status = result_cache.get_or_load(
+            key, load, cache_config['ttl'], cache_config.get('stale_ttl', 0))
+        return {"success": True, "data": pinot_response}, 200, status
+
+    except PinotQueryError as e:
+        return {"success": False, "error": "Failed to query Pinot", "details": e.details}, 500, None
+    except DeadlineExceeded as e:
+        return {"success": False, "error": str(e)}, 504, None
+    except requests.RequestException as e:
+        return {"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}, 500, None
+
+def bind_template(template, user_params):
+    """
+    Bind request parameters into a saved version. A list parameter longer
+    than IN_LIST_CONFIG["chunk_size"] is split over several queries.
+    Returns a list of BoundQuery. Raises ValueError for invalid parameters.
+    """
+    in_list_config = current_app.config.get('IN_LIST_CONFIG') or {}
+    return template.bind_chunks(user_params, int(in_list_config.get('chunk_size', 1000)),
+                                int(in_list_config.get('max_values', 100000)))
+
+def query_split(pinot_client, single_flight, result_cache, token, template, bounds, map_func=map,
+                query_stats=None):
+    """
+    Run the queries of a split list parameter and merge their results into
+    one response, as query_template does for a single query.
+    :param map_func: Runs query_template over the queries, e.g. an executor's map to run them in parallel.
+    Returns (response body, status code, cache status or None); the first
+    failing query's response is returned as is.
+    """
+    try:
+        plan = split_plan(bounds[0].sql)
+    except ValueError as e:
+        return {"success": False, "error": f"The list parameter needs {len(bounds)} queries, but {e}"}, 400, None
+
+    # Worker threads run the queries in this request's context, so their logs keep its request id
+    results = list(map_func(bind_context(lambda bound: query_template(pinot_client, single_flight, result_cache, token,
+                                                         template, bound.sql, bound.fingerprint, query_stats)),
+                            bounds))
+    for body, status_code, _ in results:
+        if status_code != 200:
+            return body, status_code, None
+    try:
+        merged = merge_responses([body["data"] for body, _, _ in results], plan)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}, 400, None
+    return {"success": True, "data": merged}, 200, merge_cache_status([status for _, _, status in results])
+
+def page_request():
+    """Return the PageRequest of the current request, or None. Raises ValueError."""
+    pagination_config = current_app.config.get('PAGINATION_CONFIG') or {}
+    return parse_page_request(request.args, current_app.extensions['cursor_codec'],
+                              int(pagination_config.get('max_page_size', 10000)))
+
+def run_page(pinot_client, token, template, processed_sql, page, fmt, fingerprint=None):
+    """
+    Run one page of a saved version.
+    - Pages are read with LIMIT/OFFSET rewritten onto the rendered SQL, one
+      row more than the page size to tell whether another page follows.
+    - With ?store=true, the first page runs the full query (up to the store's
+      row limit) and keeps it in the result store; later pages are read from
+      there until it expires, then fall back to LIMIT/OFFSET.
+    The cursor for the next page is signed and tied to the version and its
+    rendered SQL.
+    """
+    digest = sql_hash(processed_sql)
+    cursor = page.cursor
+    if cursor is not None and (cursor.version != template.version or cursor.sql_hash != digest):
+        return jsonify({"success": False, "error": "Cursor does not match this query and its parameters"}), 400
+
+    result_store = current_app.extensions['result_store']
+    single_flight = current_app.extensions['single_flight']
+    result_cache = current_app.extensions['result_cache']
+    query_stats = current_app.extensions['query_stats']
+    scope = TokenCache.token_key(token)
+    offset = cursor.offset if cursor else 0
+    store_id, stored, more = (cursor.store_id, cursor.stored, cursor.more) if cursor else (None, 0, False)
+    pinot_response, rows, has_next, cache_status, source = None, None, False, None, "query"
+
+    if store_id and result_store is not None and offset < stored:
+        found = result_store.read(scope, store_id, offset, min(page.size, stored - offset))
+        if found is not None:
+            pinot_response, rows = found
+            has_next = offset + len(rows) < stored or more
+            source = "store"
+        else:
+            # The stored result expired; continue with LIMIT/OFFSET
+            store_id, stored, more = None, 0, False
+
+    elif cursor is None and page.store and result_store is not None:
+        full_sql, count = window_sql(processed_sql, 0, result_store.max_rows + 1)
+        body, status_code, cache_status = query_template(
+            pinot_client, single_flight, result_cache, token, template, full_sql,
+            f"{fingerprint}:0:{count}" if fingerprint else None, query_stats)
+        if status_code != 200 or not isinstance(body["data"].get("resultTable"), dict):
+            return jsonify(body), status_code
+        pinot_response = body["data"]
+        all_rows = pinot_response["resultTable"].get("rows", [])
+        more = len(all_rows) > result_store.max_rows
+        all_rows = all_rows[:result_store.max_rows]
+        store_id = result_store.save(scope, pinot_response, all_rows)
+        stored = len(all_rows) if store_id else 0
+        rows = all_rows[:page.size]
+        has_next = len(all_rows) > page.size or more
+        source = "store" if store_id else "query"
+
+    if pinot_response is None:
+        page_sql, count = window_sql(processed_sql, offset, page.size + 1)
+        body, status_code, cache_status = query_template(
+            pinot_client, single_flight, result_cache, token, template, page_sql,
+            f"{fingerprint}:{offset}:{count}" if fingerprint else None, query_stats)
+        if status_code != 200 or not isinstance(body["data"].get("resultTable"), dict):
+            return jsonify(body), status_code
+        pinot_response = body["data"]
+        rows = pinot_response["resultTable"].get("rows", [])
+        has_next = len(rows) > page.size
+        rows = rows[:page.size]
+
+    next_cursor = None
+    if has_next:
+        next_cursor = current_app.extensions['cursor_codec'].encode(PageCursor(
+            template.version, digest, offset + len(rows), page.size, store_id, stored, more))
+
+    # Replace the rows with the page, without copying the rest of the response
+    data = dict(pinot_response)
+    data["resultTable"] = dict(pinot_response["resultTable"], rows=rows)
+    response = None
+    with current_app.extensions['metrics'].stage(SERIALIZATION):
+        if fmt:
+            try:
+                response = format_response(data, fmt)
+            except FormatUnavailable as e:
+                return jsonify({"success": False, "error": str(e)}), 406
+        if response is None:
+            response = jsonify({"success": True, "data": data,
+                                "page": {"offset": offset, "size": len(rows), "next_cursor": next_cursor,
+                                         "source": source}})
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    if cache_status is not None:
+        response.headers['X-Cache'] = cache_status
+    return response, 200
+
+def run_template(pinot_client, token, template, processed_sql, page=None, fingerprint=None):
+    """
+    Run a saved version and build the response. Cached versions carry an
+    X-Cache header (HIT, MISS or STALE).
+    - ?stream=json|ndjson (or Accept: application/x-ndjson) streams the broker
+      response instead, bypassing the result cache and query coalescing.
+    - ?format=arrow|csv|msgpack (or the matching Accept header) converts the
+      resultTable into that format.
+    - A page request (?page_size=, ?cursor=) returns one page; see run_page.
+    """
+    try:
+        streamed, fmt = requested_output(request.args.get('stream'), request.args.get('format'),
+                                         request.headers.get('Accept'))
+        if streamed and page is not None:
+            raise ValueError("'stream' cannot be combined with paging")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if page is not None:
+        return run_page(pinot_client, token, template, processed_sql, page, fmt, fingerprint)
+    if streamed:
+        try:
+            return stream_query(pinot_client, token, processed_sql, streamed)
+        except PinotQueryError as e:
+            return jsonify({"success": False, "error": "Failed to query Pinot", "details": e.details}), 500
+        except DeadlineExceeded as e:
+            return jsonify({"success": False, "error": str(e)}), 504
+        except requests.RequestException as e:
+            return jsonify({"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}), 500
+
+    body, status_code, cache_status = query_template(
+        pinot_client, current_app.extensions['single_flight'], current_app.extensions['result_cache'],
+        token, template, processed_sql, fingerprint, current_app.extensions['query_stats'])
+    return template_response(body, status_code, cache_status, fmt)
+
+def run_split(pinot_client, token, template, bounds, page=None):
+    """
+    Run a saved version whose list parameter was split over several queries.
+    The queries run in parallel on the batch worker pool and the response
+    carries their number in an X-Split-Queries header. Output formats are
+    supported; streaming and paging are not.
+    """
+    try:
+        streamed, fmt = requested_output(request.args.get('stream'), request.args.get('format'),
+                                         request.headers.get('Accept'))
+        if streamed or page is not None:
+            raise ValueError(f"The list parameter needs {len(bounds)} queries, which cannot be streamed or paged")
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    body, status_code, cache_status = query_split(
+        pinot_client, current_app.extensions['single_flight'], current_app.extensions['result_cache'],
+        token, template, bounds, current_app.extensions['batch_executor'].map, current_app.extensions['query_stats'])
+    response, status_code = template_response(body, status_code, cache_status, fmt)
+    response.headers['X-Split-Queries'] = str(len(bounds))
+    return response, status_code
+
+def template_response(body, status_code, cache_status, fmt):
+    """Build the response for a query result, converted to the requested output format if any."""
+    response = None
+    with current_app.extensions['metrics'].stage(SERIALIZATION):
+        if fmt and status_code == 200:
+            try:
+                response = format_response(body["data"], fmt)
+            except FormatUnavailable as e:
+                return jsonify({"success": False, "error": str(e)}), 406
+        if response is None:
+            response = jsonify(body)
+    if cache_status is not None:
+        response.headers['X-Cache'] = cache_status
+    return response, status_code
+
 @mod.route('/api/<name>', methods=['POST'])
 @verify_bearer_token()
+@admission_control()
 def execute_by_name(token, name):
-    # Retrieve the Pinot configuration from the app config
-    pinot_broker_url = "{}".format(current_app.config.get("PINOT_CONFIG")['broker'])
-    if not pinot_broker_url:
+    # Retrieve the pooled Pinot broker client
+    pinot_client = current_app.get_pinot_client()
+    if not pinot_client.broker_url:
         return jsonify({"success": False, "error": "Pinot broker URL is not configured"}), 500
     
     # Execute SQL for the given API name using parameters from the request body or defaults.
-    redis_client = current_app.get_redis_client()
+    template_cache = current_app.extensions['template_cache']
     name = name.lower().replace(" ", "_")  # Normalize the name
 
     try:
-        sql, default_parameters, identifier = get_sql_and_parameters(redis_client, name, is_name=True)
+        page = page_request()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    metrics = current_app.extensions['metrics']
+    try:
+        with metrics.stage(REGISTRY_LOOKUP):
+            if page is not None and page.cursor is not None:
+                # Keep paging through the version the first page was read from
+                template = template_cache.get_by_version(page.cursor.version)
+            else:
+                template = template_cache.get_by_name(name)
+        if page is not None and page.cursor is not None and template.name != name:
+            return jsonify({"success": False, "error": "Cursor does not match this query and its parameters"}), 400
     except ValueError as e:
         return jsonify({"success": False, "error": str(e)}), 404
+    set_api_labels(template.name, template.version)
+    apply_api_timeout(template.options.get('timeout'), max_api_timeout())
 
     # Merge request parameters with defaults
     user_params = (request.get_json() or {}).get('parameters', {})
 
-    # Replace parameters in the SQL query
-    processed_sql = replace_parameters_in_sql(sql, default_parameters, user_params)
-
-    # Print the final SQL query
-    print(f"Executing SQL for API name '{name}':")
-    print(f"SQL: {processed_sql}")
-
+    # Bind the validated parameters into the compiled SQL template
     try:
-        # Send the query to the Pinot broker
-        response = requests.post(
-            f"{pinot_broker_url}/query/sql",
-            json={"sql": processed_sql},
-            headers={"Content-Type": "application/json", 
-                     "Authorization": f"Bearer {token}"}
-        )
-
-        # Handle Pinot's response
-        if response.status_code != 200:
-            return jsonify({"success": False, "error": "Failed to query Pinot", "details": response.text}), 500
-
-        pinot_response = response.json()
+        with metrics.stage(TEMPLATE_BINDING):
+            bounds = bind_template(template, user_params)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-        # Return the Pinot response to the client
-        return jsonify({"success": True, "data": pinot_response}), 200
+    current_app.extensions['log_sampler'].log_query(
+        logger, "Executing saved API", bounds[0].sql, api=template.name, version=template.version, queries=len(bounds))
 
-    except requests.RequestException as e:
-        return jsonify({"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}), 500
+    if len(bounds) > 1:
+        return run_split(pinot_client, token, template, bounds, page)
+    return run_template(pinot_client, token, template, bounds[0].sql, page, bounds[0].fingerprint)
 
 @mod.route('/version/<uuid>', methods=['POST'])
 @verify_bearer_token()
+@admission_control()
 def execute_by_version(token, uuid):
-    # Retrieve the Pinot configuration from the app config
-    pinot_broker_url = "{}".format(current_app.config.get("PINOT_CONFIG")['broker'])
-    if not pinot_broker_url:
+    # Retrieve the pooled Pinot broker client
+    pinot_client = current_app.get_pinot_client()
+    if not pinot_client.broker_url:
         return jsonify({"success": False, "error": "Pinot broker URL is not configured"}), 500
     
     # Execute SQL for the given version (UUID) using parameters from the request body or defaults.
-    redis_client = current_app.get_redis_client()
+    template_cache = current_app.extensions['template_cache']
 
     try:
-        sql, default_parameters, identifier = get_sql_and_parameters(redis_client, uuid, is_name=False)
+        page = page_request()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    metrics = current_app.extensions['metrics']
+    try:
+        with metrics.stage(REGISTRY_LOOKUP):
+            template = template_cache.get_by_version(uuid)
     except ValueError as e:
         return jsonify({"success": False, "error": str(e)}), 404
+    set_api_labels(template.name, template.version)
+    apply_api_timeout(template.options.get('timeout'), max_api_timeout())
 
     # Merge request parameters with defaults
     user_params = (request.get_json() or {}).get('parameters', {})
 
-    # Replace parameters in the SQL query
-    processed_sql = replace_parameters_in_sql(sql, default_parameters, user_params)
+    # Bind the validated parameters into the compiled SQL template
+    try:
+        with metrics.stage(TEMPLATE_BINDING):
+            bounds = bind_template(template, user_params)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    current_app.extensions['log_sampler'].log_query(
+        logger, "Executing saved API", bounds[0].sql, api=template.name, version=template.version, queries=len(bounds))
+
+    if len(bounds) > 1:
+        return run_split(pinot_client, token, template, bounds, page)
+    return run_template(pinot_client, token, template, bounds[0].sql, page, bounds[0].fingerprint)
 
-    # Print the final SQL query
-    print(f"Executing SQL for version '{uuid}':")
-    print(f"SQL: {processed_sql}")
+def with_api_timeout(template, func):
+    """
+    Wrap func to run a batch query on a worker thread, within its saved API's
+    timeout when that ends before the batch's deadline.
+    """
+    def run(*args):
+        limit_deadline(template.options.get('timeout'))
+        return func(*args)
+    return run
 
+def batch_queries():
+    """
+    Saved API of each query of a batch, which counts against the rate limits
+    and concurrency cap as one request per query. An invalid batch, answered
+    400 by the view, counts as one.
+    """
+    batch_config = current_app.config.get('BATCH_CONFIG') or {}
     try:
-        # Send the query to the Pinot broker
-        response = requests.post(
-            f"{pinot_broker_url}/query/sql",
-            json={"sql": processed_sql},
-            headers={"Content-Type": "application/json", 
-                     "Authorization": f"Bearer {token}"}
-        )
+        _, refs, _ = parse_batch_items(request.get_json(silent=True), int(batch_config.get('max_items', 50)))
+    except ValueError:
+        return [None]
+    # Versions missing from the template cache are resolved now, and stay cached for the view
+    versions = [ref for ref in refs if ref[0] == "version"]
+    return batch_apis(refs, current_app.extensions['template_cache'].get_many(versions) if versions else [])
 
-        # Handle Pinot's response
-        if response.status_code != 200:
-            return jsonify({"success": False, "error": "Failed to query Pinot", "details": response.text}), 500
+@mod.route('/batch', methods=['POST'])
+@verify_bearer_token()
+@admission_control(apis=batch_queries)
+def execute_batch(token):
+    """
+    Execute several saved APIs in one request.
+    - The token is validated once and all templates are resolved in one Redis round trip.
+    - Queries run concurrently on the shared, bounded batch worker pool.
+    - Each query succeeds or fails on its own; results are keyed by query id.
+    - Queries still running when the batch deadline passes fail with status 504.
+    """
+    pinot_client = current_app.get_pinot_client()
+    if not pinot_client.broker_url:
+        return jsonify({"success": False, "error": "Pinot broker URL is not configured"}), 500
+
+    batch_config = current_app.config.get('BATCH_CONFIG') or {}
+    data = request.get_json(silent=True)
+    try:
+        ids, refs, parameters = parse_batch_items(data, int(batch_config.get('max_items', 50)))
+        deadline = float(batch_config.get('deadline', 30))
+        if data.get('deadline') is not None:
+            deadline = min(deadline, float(data['deadline']))
+        if deadline <= 0:
+            raise ValueError("'deadline' must be positive")
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    # Nor may it outlast the request's own deadline. Queries inherit it, so Pinot
+    # and the HTTP client give up on a query when the batch stops waiting for it
+    limit_deadline(deadline)
+    deadline = max(remaining(), 0)
 
-        pinot_response = response.json()
+    started = time.monotonic()
+    metrics = current_app.extensions['metrics']
+    with metrics.stage(REGISTRY_LOOKUP):
+        templates = current_app.extensions['template_cache'].get_many(refs)
+    single_flight = current_app.extensions['single_flight']
+    result_cache = current_app.extensions['result_cache']
+    executor = current_app.extensions['batch_executor']
+    query_stats = current_app.extensions['query_stats']
 
-        # Return the Pinot response to the client
-        return jsonify({"success": True, "data": pinot_response}), 200
+    results = {}
+    futures = {}
+    for item_id, template, item_parameters in zip(ids, templates, parameters):
+        if isinstance(template, Exception):
+            results[item_id] = {"success": False, "status": 404, "error": str(template)}
+            continue
+        set_api_labels(template.name, template.version)
+        try:
+            with metrics.stage(TEMPLATE_BINDING):
+                bounds = bind_template(template, item_parameters)
+        except ValueError as e:
+            results[item_id] = {"success": False, "status": 400, "error": str(e)}
+            continue
+        if len(bounds) > 1:
+            # Split queries run one after another on the item's worker, so they never wait on the pool
+            futures[executor.submit(bind_context(with_api_timeout(template, query_split)), pinot_client, single_flight, result_cache,
+                                    token, template, bounds, map, query_stats)] = item_id
+            continue
+        futures[executor.submit(bind_context(with_api_timeout(template, query_template)), pinot_client, single_flight, result_cache,
+                                token, template, bounds[0].sql, bounds[0].fingerprint, query_stats)] = item_id
 
-    except requests.RequestException as e:
-        return jsonify({"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}), 500
+    # The batch response itself belongs to no single API
+    clear_api_labels()
+    done, not_done = wait(futures, timeout=max(deadline - (time.monotonic() - started), 0))
+    for future in done:
+        try:
+            body, status_code, cache_status = future.result()
+        except Exception as e:
+            body, status_code, cache_status = {"success": False, "error": str(e)}, 500, None
+        body["status"] = status_code
+        if cache_status is not None:
+            body["cache"] = cache_status
+        results[futures[future]] = body
+    for future in not_done:
+        # Queued queries are dropped; running ones hit the same deadline and free their workers
+        future.cancel()
+        results[futures[future]] = {"success": False, "status": 504, "error": "Batch deadline exceeded"}
+
+    return jsonify({"success": True, "results": {item_id: results[item_id] for item_id in ids}}), 200
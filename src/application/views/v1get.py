@@ -1,6 +1,6 @@
-from flask import Blueprint, current_app, jsonify
+from flask import Blueprint, current_app, request, jsonify
 from application.modules.utils import verify_bearer_token, normalize_name
-import json
+from application.modules.registry import RegistryError
 
 mod = Blueprint('v1get', __name__, url_prefix='/v1/get')
 
@@ -8,26 +8,26 @@ mod = Blueprint('v1get', __name__, url_prefix='/v1/get')
 @verify_bearer_token()
 def list_apis(token):
     """
-    List all API names stored in Redis.
+    List API names from the registry's name index.
+    Query parameters:
+    - limit: page size (default 100, max 1000).
+    - cursor: the next_cursor value from the previous page.
+    - prefix: only list names starting with this prefix.
     """
-    redis_client = current_app.get_redis_client()
+    registry = current_app.extensions['registry']
+
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"success": False, "error": "limit must be an integer"}), 400
+    cursor = request.args.get('cursor') or None
+    prefix = request.args.get('prefix')
+    if prefix:
+        prefix = normalize_name(prefix)
 
     try:
-        # Use SCAN to fetch keys with a specific pattern
-        cursor = 0
-        keys = []
-        pattern = "*"
-        while True:
-            cursor, partial_keys = redis_client.scan(cursor, match=pattern, count=100)
-            keys.extend(partial_keys)
-            if cursor == 0:
-                break
-
-        # Filter the keys to include only API names (e.g., exclude UUIDs)
-        # Assuming API names are stored as lists (e.g., LPUSH "api_name" "uuid")
-        api_names = [key for key in keys if redis_client.type(key) == "list"]
-
-        return jsonify({"success": True, "apis": api_names}), 200
+        api_names, next_cursor = registry.list_names(limit=limit, cursor=cursor, prefix=prefix)
+        return jsonify({"success": True, "apis": api_names, "next_cursor": next_cursor}), 200
 
     except Exception as e:
         return jsonify({"success": False, "error": f"An error occurred: {str(e)}"}), 500
@@ -40,6 +40,7 @@ def get_by_name(token, name):
     Fetch the latest version and the list of versions for the given API name.
     """
     redis_client = current_app.get_redis_client()
+    registry = current_app.extensions['registry']
 
     name = normalize_name(name)
     try:
@@ -53,13 +54,11 @@ def get_by_name(token, name):
             return jsonify({"success": False, "error": f"No versions found for API name '{name}'"}), 404
 
         # Fetch the latest version (first in the list)
-        latest_version = redis_client.get(versions[0])
-        if not latest_version:
+        try:
+            latest_version_data = registry.get_version(versions[0])
+        except RegistryError:
             return jsonify({"success": False, "error": f"Failed to fetch latest version for API name '{name}'"}), 500
 
-        # Deserialize the latest version's data
-        latest_version_data = json.loads(latest_version)
-
         return jsonify({
             "success": True,
             "latest_version": latest_version_data,
@@ -76,21 +75,14 @@ def get_by_version(token, version):
     """
     Fetch the specific record for the given UUID.
     """
-    redis_client = current_app.get_redis_client()
+    registry = current_app.extensions['registry']
     try:
-        # Check if the version (UUID) exists in Redis
-        if not redis_client.exists(version):
-            return jsonify({"success": False, "error": f"Version '{version}' not found"}), 404
-
-        # Fetch the record for the UUID
-        record = redis_client.get(version)
-        if not record:
-            return jsonify({"success": False, "error": f"Failed to fetch version '{version}'"}), 500
-
-        # Deserialize the record's data
-        record_data = json.loads(record)
+        # Fetch and decode the record for the UUID in one round trip
+        record_data = registry.get_version(version)
 
         return jsonify({"success": True, "record": record_data}), 200
 
+    except RegistryError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
     except Exception as e:
         return jsonify({"success": False, "error": f"An error occurred: {str(e)}"}), 500
@@ -0,0 +1,11 @@
+from flask import Blueprint, current_app, Response
+
+mod = Blueprint('v1metrics', __name__)
+
+@mod.route('/metrics', methods=['GET'])
+def metrics():
+    """Report this worker's metrics in the Prometheus text format."""
+    registry = current_app.extensions['metrics']
+    if not registry.enabled:
+        return 'Page Not Found', 404
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
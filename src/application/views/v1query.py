@@ -1,5 +1,10 @@
 from flask import Blueprint, current_app, request, jsonify
-from application.modules.utils import verify_bearer_token
+from application.modules.utils import verify_bearer_token, admission_control, fetch_coalesced
+from application.modules.pinot import PinotQueryError
+from application.modules.streaming import stream_query
+from application.modules.deadlines import DeadlineExceeded
+from application.modules.formats import FormatUnavailable, format_response, requested_output
+from application.modules.metrics import SERIALIZATION
 import requests
 import json
 
@@ -7,13 +12,17 @@ mod = Blueprint('v1query', __name__, url_prefix='/v1/query')
 
 @mod.route('/', methods=['POST'])
 @verify_bearer_token()
+@admission_control()
 def passthrough_query(token):
     """
     Passes the query directly to Pinot and returns the response.
+    With ?stream=json|ndjson (or Accept: application/x-ndjson) the broker
+    response is streamed back without being parsed; with ?format=arrow|csv|msgpack
+    (or the matching Accept header) the resultTable is converted to that format.
     """
-    # Retrieve the Pinot configuration from the app config
-    pinot_broker_url = "{}".format(current_app.config.get("PINOT_CONFIG")['broker'])
-    if not pinot_broker_url:
+    # Retrieve the pooled Pinot broker client
+    pinot_client = current_app.get_pinot_client()
+    if not pinot_client.broker_url:
         return jsonify({"success": False, "error": "Pinot broker URL is not configured"}), 500
 
     # Retrieve the query from the request body
@@ -22,22 +31,33 @@ def passthrough_query(token):
         return jsonify({"success": False, "error": "Query must include an 'sql' field"}), 400
 
     try:
-        # Send the query to the Pinot broker
-        response = requests.post(
-            f"{pinot_broker_url}/query/sql",
-            json={"sql": query["sql"]},
-            headers={"Content-Type": "application/json", 
-                     "Authorization": f"Bearer {token}"}
-        )
+        streamed, fmt = requested_output(request.args.get('stream'), request.args.get('format'),
+                                         request.headers.get('Accept'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-        # Handle Pinot's response
-        if response.status_code != 200:
-            return jsonify({"success": False, "error": "Failed to query Pinot", "details": response.text}), 500
+    try:
+        if streamed:
+            # Stream large results straight through; bypasses query coalescing
+            return stream_query(pinot_client, token, query["sql"], streamed)
 
-        pinot_response = response.json()
+        # Send the query to the Pinot broker, sharing identical in-flight queries
+        pinot_response, _ = fetch_coalesced(current_app.extensions['single_flight'], pinot_client, query["sql"], token)
 
-        # Return the Pinot response to the client
-        return jsonify({"success": True, "data": pinot_response}), 200
+        with current_app.extensions['metrics'].stage(SERIALIZATION):
+            # Convert the result table if another output format was requested
+            response = format_response(pinot_response, fmt) if fmt else None
+            if response is None:
+                response = jsonify({"success": True, "data": pinot_response})
 
+        # Return the Pinot response to the client
+        return response, 200
+
+    except FormatUnavailable as e:
+        return jsonify({"success": False, "error": str(e)}), 406
+    except PinotQueryError as e:
+        return jsonify({"success": False, "error": "Failed to query Pinot", "details": e.details}), 500
+    except DeadlineExceeded as e:
+        return jsonify({"success": False, "error": str(e)}), 504
     except requests.RequestException as e:
         return jsonify({"success": False, "error": "An error occurred while querying Pinot", "details": str(e)}), 500
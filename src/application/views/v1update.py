@@ -1,6 +1,8 @@
 from flask import Blueprint, current_app, request, jsonify
-from application.modules.utils import verify_bearer_token, normalize_name, validate_sql_and_parameters
-import json
+from application.modules.utils import verify_bearer_token, normalize_name, validate_sql_and_parameters, validate_cache_config
+from application.modules.utils import max_api_timeout, validate_timeout
+from application.modules.registry import RegistryError
+from application.modules.serialization import dumps
 import uuid
 
 mod = Blueprint('v1update', __name__, url_prefix='/v1/update')
@@ -12,7 +14,6 @@ def update_by_name(token, name):
     Update the name's version list, mark the old record inactive,
     and create a new active version.
     """
-    redis_client = current_app.get_redis_client()
     name = normalize_name(name)
 
     # Validate the input payload
@@ -20,45 +21,30 @@ def update_by_name(token, name):
     try:
         sql = data['sql']
         parameters = data['parameters']
+        cache = data.get('cache')
+        timeout = data.get('timeout')
         # Validate SQL and parameters
         validate_sql_and_parameters(sql, parameters)
+        validate_cache_config(cache)
+        validate_timeout(timeout, max_api_timeout())
     except ValueError as e:
-        return json.dumps({'success': False, "error": str(e)}), 400, {'Content-Type': 'application/json'}
+        return dumps({'success': False, "error": str(e)}), 400, {'Content-Type': 'application/json'}
     except KeyError as e:
         return jsonify({"success": False, "error": f"Missing key: {str(e)}"}), 400
 
+    registry = current_app.extensions['registry']
     try:
-        # Check if the name exists in Redis
-        if not redis_client.exists(name):
-            return jsonify({"success": False, "error": f"API name '{name}' not found"}), 404
-
-        # Get the latest version's UUID
-        latest_uuid = redis_client.lindex(name, 0)
-        if not latest_uuid:
-            return jsonify({"success": False, "error": f"No versions found for API name '{name}'"}), 404
-
-        # Create a new record with a new UUID
+        # Add the new active version and mark the previous one inactive in one atomic call
         new_uuid = str(uuid.uuid4())
-        new_record = {
-            "name": name,
-            "sql": sql,
-            "parameters": parameters,
-            "active": True
-        }
-        redis_client.set(new_uuid, json.dumps(new_record))
-        
-        # Mark the old record as inactive
-        old_record = redis_client.get(latest_uuid)
-        if old_record:
-            old_record_data = json.loads(old_record)
-            old_record_data['active'] = False
-            redis_client.set(latest_uuid, json.dumps(old_record_data))
+        registry.update(name, new_uuid, sql, parameters, options={'cache': cache, 'timeout': timeout})
 
-        # Update the name list with the new UUID as the latest version
-        redis_client.lpush(name, new_uuid)
+        # Invalidate cached name -> latest version lookups in every worker
+        current_app.extensions['template_cache'].publish_change(name)
 
         # Return success response
         return jsonify({"success": True, "id": new_uuid}), 200
 
+    except RegistryError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
     except Exception as e:
         return jsonify({"success": False, "error": f"An error occurred: {str(e)}"}), 500
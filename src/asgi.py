@@ -0,0 +1,4 @@
+from application.asgi import create_asgi_app
+
+# Asyncio serving mode, e.g. `uvicorn asgi:application`
+application = create_asgi_app()
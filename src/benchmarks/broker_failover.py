@@ -0,0 +1,96 @@
+"""
+Broker load balancing and failover against several local stub brokers.
+
+Starts a fast broker, a slow one and a flaky one (503 for a fraction of
+queries), then drives the Pinot client with each balancer from a pool of
+threads. Halfway through, the fast broker is taken down and brought back
+after a few seconds, so the circuit breaker has to eject and restore it.
+Reports client-visible errors, p50/p99 latency, failovers and how the
+queries were spread over the brokers.
+
+    cd src && python -m benchmarks.broker_failover --queries 2000 --threads 16
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks import harness
+from application.modules.brokers import BALANCERS, BrokerPool
+from application.modules.metrics import Metrics, PINOT_FAILOVERS_TOTAL
+from application.modules.pinot import PinotClient
+
+def set_broker(url, **settings):
+    httpx.post(f"{url}/_stub/config", json=settings, timeout=5).raise_for_status()
+
+def run(balancer, urls, queries, threads, outage):
+    """Run the queries with one balancer; return (latencies in ms, errors, failovers, broker states)."""
+    pool = BrokerPool(urls, balancer=balancer, failure_threshold=3, open_seconds=2, probe_interval=0.5)
+    metrics = Metrics()
+    client = PinotClient({"broker": ",".join(urls)}, {"pool_size": threads, "read_timeout": 10}, metrics, pool)
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def query(i):
+        started = time.perf_counter()
+        try:
+            client.fetch(f"SELECT * FROM events WHERE id = {i} LIMIT 10", "bench")
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        with lock:
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    def outage_window():
+        # Wait until about half of the queries are done, then fail the fast broker for a while
+        while len(latencies) + errors[0] < queries // 2:
+            time.sleep(0.01)
+        set_broker(urls[0], down=True)
+        time.sleep(outage)
+        set_broker(urls[0], down=False)
+
+    watcher = threading.Thread(target=outage_window, daemon=True)
+    watcher.start()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(query, range(queries)))
+    watcher.join()
+    client.close()
+    failovers = sum(value for (name, _), value in metrics.collect().items() if name == PINOT_FAILOVERS_TOTAL)
+    return latencies, errors[0], failovers, pool.describe()["brokers"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--fast-ms", type=float, default=10)
+    parser.add_argument("--slow-ms", type=float, default=100)
+    parser.add_argument("--fail-rate", type=float, default=0.3, help="Failure rate of the flaky broker")
+    parser.add_argument("--outage", type=float, default=3, help="Seconds the fast broker is down")
+    args = parser.parse_args()
+
+    processes, urls = [], []
+    try:
+        brokers = [(args.fast_ms, []),
+                   (args.slow_ms, ["--jitter-ms", str(args.slow_ms / 2)]),
+                   (args.fast_ms, ["--fail-rate", str(args.fail_rate)])]
+        for latency, extra in brokers:
+            process, url = harness.start_stub_broker(latency, 10, extra)
+            processes.append(process)
+            urls.append(url)
+        labels = {urls[0]: "fast", urls[1]: "slow", urls[2]: "flaky"}
+
+        print(f"{'balancer':<18} {'errors':>6} {'failovers':>9} {'p50 ms':>8} {'p99 ms':>8}  requests per broker")
+        for balancer in BALANCERS:
+            latencies, errors, failovers, brokers = run(balancer, urls, args.queries, args.threads, args.outage)
+            spread = ", ".join(f"{labels[broker['url']]}={broker['requests']}" for broker in brokers)
+            print(f"{balancer:<18} {errors:>6} {failovers:>9} {harness.percentile(latencies, 0.5):>8.1f} "
+                  f"{harness.percentile(latencies, 0.99):>8.1f}  {spread}")
+    finally:
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Helpers shared by the load-test scripts: a Redis stand-in, the stub broker
+and the wrapper itself, each started on a free local port.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def start_redis(redis_url=None):
+    """Return (host, port) of a Redis to use: the given URL, or an in-process fakeredis TCP server."""
+    if redis_url:
+        parsed = httpx.URL(redis_url)
+        return parsed.host, parsed.port or 6379
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "127.0.0.1", port
+
+def start_process(args, env=None, cwd=None):
+    return subprocess.Popen([sys.executable] + args, cwd=cwd or SRC_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def start_stub_broker(latency_ms, rows, extra_args=()):
+    """Start benchmarks.stub_broker in a subprocess; return (process, url)."""
+    port = free_port()
+    process = start_process(["-m", "benchmarks.stub_broker", "--port", str(port),
+                             "--latency-ms", str(latency_ms), "--rows", str(rows)] + list(extra_args))
+    url = f"http://127.0.0.1:{port}"
+    wait_for(f"{url}/health")
+    return process, url
+
+def app_environment(redis_host, redis_port, broker_url, extra=None):
+    """Environment and working directory for running the wrapper (which logs to ../logs)."""
+    workdir = tempfile.mkdtemp(prefix="query_wrapper_bench_")
+    os.makedirs(os.path.join(workdir, "logs"))
+    os.makedirs(os.path.join(workdir, "run"))
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": SRC_DIR,
+        "REDIS_HOST": redis_host,
+        "REDIS_PORT": str(redis_port),
+        "PINOT_BROKER": broker_url,
+        # Load tests send far more than one token's rate limit
+        "ADMISSION_ENABLED": "false"
+    })
+    env.update(extra or {})
+    return env, os.path.join(workdir, "run")
+
+def start_wrapper(mode, env, cwd):
+    """
+    Start the wrapper in a subprocess and return (process, url).
+    mode "wsgi" runs the Flask app on werkzeug's threaded server (one thread
+    per request); mode "asgi" runs the asyncio gateway on uvicorn.
+    """
+    port = free_port()
+    if mode == "asgi":
+        args = ["-m", "uvicorn", "asgi:application", "--host", "127.0.0.1", "--port", str(port),
+                "--log-level", "warning", "--no-access-log"]
+    else:
+        args = ["-c", "from werkzeug.serving import run_simple; from application import create_app; "
+                      f"run_simple('127.0.0.1', {port}, create_app(), threaded=True)"]
+    process = start_process(args, env=env, cwd=cwd)
+    url = f"http://127.0.0.1:{port}"
+    wait_for(f"{url}/v1/")
+    return process, url
+
+def rss_mb(pid):
+    """Resident set size of a process in MB (Linux /proc), or None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
@@ -0,0 +1,116 @@
+"""
+Load test comparing the synchronous Flask app with the asyncio gateway
+against a local stub broker with a fixed latency.
+
+For each serving mode and concurrency level it reports throughput, p50/p99
+latency, errors and peak RSS of the single server process, and how much
+throughput fits into a fixed memory budget.
+
+    cd src && python -m benchmarks.loadtest_asgi --latency-ms 100 --concurrency 16 64 256 --duration 10
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+import httpx
+
+from benchmarks import harness
+
+TOKEN = "loadtest"
+API = {
+    "name": "loadtest",
+    "sql": "SELECT * FROM events WHERE device_id = %device% LIMIT 100",
+    "parameters": {"device": {"default": "d0", "type": "string"}}
+}
+
+async def run_load(url, concurrency, duration):
+    """Drive POST /v1/execute/api/loadtest at a fixed concurrency; return latencies (ms) and errors."""
+    latencies, errors = [], 0
+    counter = 0
+    deadline = time.monotonic() + duration
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal counter, errors
+            while time.monotonic() < deadline:
+                counter += 1
+                # Distinct parameters so identical-query coalescing does not kick in
+                body = {"parameters": {"device": f"d{counter}"}}
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"/v1/execute/api/{API['name']}", json=body, headers=headers)
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000.0)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors
+
+def sample_rss(pid, stop, peak):
+    while not stop.is_set():
+        value = harness.rss_mb(pid)
+        if value is not None:
+            peak[0] = max(peak[0], value)
+        time.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=None, help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Stub broker latency")
+    parser.add_argument("--rows", type=int, default=100, help="Rows per stub broker response")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per concurrency level")
+    parser.add_argument("--modes", nargs="+", default=["wsgi", "asgi"], choices=["wsgi", "asgi"])
+    parser.add_argument("--memory-budget-mb", type=float, default=1024)
+    args = parser.parse_args()
+
+    redis_host, redis_port = harness.start_redis(args.redis_url)
+    broker, broker_url = harness.start_stub_broker(args.latency_ms, args.rows)
+    env, cwd = harness.app_environment(redis_host, redis_port, broker_url)
+    results = []
+    try:
+        for mode in args.modes:
+            process, url = harness.start_wrapper(mode, env, cwd)
+            try:
+                httpx.delete(f"{url}/v1/delete/api/{API['name']}", headers={"Authorization": f"Bearer {TOKEN}"})
+                httpx.post(f"{url}/v1/create/", json=API, headers={"Authorization": f"Bearer {TOKEN}"}).raise_for_status()
+                for concurrency in args.concurrency:
+                    stop, peak = threading.Event(), [0.0]
+                    sampler = threading.Thread(target=sample_rss, args=(process.pid, stop, peak), daemon=True)
+                    sampler.start()
+                    latencies, errors = asyncio.run(run_load(url, concurrency, args.duration))
+                    stop.set()
+                    sampler.join()
+                    results.append({
+                        "mode": mode,
+                        "concurrency": concurrency,
+                        "rps": len(latencies) / args.duration,
+                        "p50": harness.percentile(latencies, 0.50),
+                        "p99": harness.percentile(latencies, 0.99),
+                        "errors": errors,
+                        "rss": peak[0]
+                    })
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        broker.terminate()
+        broker.wait()
+
+    print(f"stub broker latency {args.latency_ms} ms, {args.rows} rows, memory budget {args.memory_budget_mb} MB")
+    print(f"{'mode':<6}{'conc':>6}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'RSS MB':>9}"
+          f"{'procs':>7}{'req/s in budget':>17}")
+    for row in results:
+        processes = int(args.memory_budget_mb // row["rss"]) if row["rss"] else 0
+        print(f"{row['mode']:<6}{row['concurrency']:>6}{row['rps']:>10.1f}{row['p50']:>10.1f}{row['p99']:>10.1f}"
+              f"{row['errors']:>8}{row['rss']:>9.1f}{processes:>7}{processes * row['rps']:>17.1f}")
+
+if __name__ == "__main__":
+    main()
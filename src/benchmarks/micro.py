@@ -0,0 +1,125 @@
+"""
+Microbenchmarks of the request hot paths that need no network:
+
+- template_compile: compiling a saved SQL string and its parameters.
+- template_bind / template_bind_in_list: binding request parameters into a
+  compiled template (scalar parameters; a 1000-value list split in chunks).
+- sql_fingerprint: the SQL fingerprint written with query logs.
+- token_key / token_cache_hit: hashing a bearer token; a token cache hit.
+- json_loads / json_dumps: decoding a broker response and encoding the
+  wrapper's response, both of --rows rows, with the stdlib json module.
+- serializer_loads / serializer_dumps: the same with the configured
+  serializer (orjson when installed).
+- passthrough_envelope: wrapping the undecoded broker response (RawJSON).
+
+Each benchmark runs in batches of about a millisecond; reported are the
+throughput and the p50/p99 time per call across batches.
+
+    cd src && python -m benchmarks.micro --rows 1000 --seconds 1
+"""
+import argparse
+import json
+import time
+
+from benchmarks import harness
+from benchmarks.stub_broker import StubBroker
+from application.modules.logs import sql_fields
+from application.modules.serialization import RawJSON, dumps, get_serializer
+from application.modules.sqltemplate import compile_template
+from application.modules.tokens import TokenCache
+
+TEMPLATE_SQL = """
+    SELECT device_id, COUNT(*) AS events, AVG(value) AS avg_value -- per device
+    FROM events
+    WHERE tenant = %tenant% AND ts >= %start% AND ts < %end% AND kind IN (%kinds%)
+    GROUP BY device_id ORDER BY %order% DESC LIMIT %limit%
+"""
+TEMPLATE_PARAMETERS = {
+    "tenant": {"default": "acme", "type": "string"},
+    "start": {"default": "2024-01-01T00:00:00Z", "type": "timestamp"},
+    "end": {"default": "2024-02-01T00:00:00Z", "type": "timestamp"},
+    "kinds": {"default": ["click"], "type": "string_list"},
+    "order": {"default": "events", "type": "column", "allowed": ["events", "avg_value"]},
+    "limit": {"default": 100, "type": "integer"},
+}
+IN_LIST_SQL = "SELECT * FROM events WHERE device_id IN (%ids%) LIMIT 100000"
+IN_LIST_PARAMETERS = {"ids": {"default": [1], "type": "integer_list"}}
+
+def measure(func, seconds=1.0):
+    """
+    Call func repeatedly for about `seconds`, in batches sized to take about
+    a millisecond. Returns {"ops_per_s", "p50_us", "p99_us"}.
+    """
+    batch = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(batch):
+            func()
+        if time.perf_counter() - started >= 0.001 or batch >= 1 << 20:
+            break
+        batch *= 2
+
+    per_call, calls = [], 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        batch_started = time.perf_counter()
+        for _ in range(batch):
+            func()
+        per_call.append((time.perf_counter() - batch_started) / batch * 1e6)
+        calls += batch
+    elapsed = time.perf_counter() - started
+    return {"ops_per_s": calls / elapsed, "p50_us": harness.percentile(per_call, 0.50),
+            "p99_us": harness.percentile(per_call, 0.99)}
+
+def benchmarks(rows=1000, columns=4):
+    """Return [(name, function)] of the microbenchmarks."""
+    template = compile_template(TEMPLATE_SQL, TEMPLATE_PARAMETERS, version="bench", name="bench")
+    params = {"tenant": "o'reilly", "start": "2024-03-01T00:00:00Z", "end": 1711929600000,
+              "kinds": ["click", "view", "purchase"], "order": "avg_value", "limit": 50}
+    in_list = compile_template(IN_LIST_SQL, IN_LIST_PARAMETERS, version="bench-in", name="bench_in")
+    ids = {"ids": list(range(1000))}
+    sql = template.bind(params).sql
+
+    token_cache = TokenCache(max_size=1000)
+    token = "bench-token-0123456789abcdef"
+    token_cache.set_local(token, True)
+
+    payload = StubBroker(latency_ms=0, rows=rows, columns=columns).payload
+    decoded = json.loads(payload)
+    serializer = get_serializer()
+
+    return [
+        ("template_compile", lambda: compile_template(TEMPLATE_SQL, TEMPLATE_PARAMETERS)),
+        ("template_bind", lambda: template.bind(params)),
+        ("template_bind_in_list", lambda: in_list.bind_chunks(ids, 250)),
+        ("sql_fingerprint", lambda: sql_fields(sql)),
+        ("token_key", lambda: TokenCache.token_key(token)),
+        ("token_cache_hit", lambda: token_cache.get_local(token)),
+        ("json_loads", lambda: json.loads(payload)),
+        ("json_dumps", lambda: json.dumps({"success": True, "data": decoded})),
+        ("serializer_loads", lambda: serializer.loads(payload)),
+        ("serializer_dumps", lambda: dumps({"success": True, "data": decoded})),
+        ("passthrough_envelope", lambda: dumps({"success": True, "data": RawJSON(payload)})),
+    ]
+
+def run(rows=1000, columns=4, seconds=1.0, names=None):
+    """Run the microbenchmarks (or those in names); return {name: measurement}."""
+    return {name: measure(func, seconds) for name, func in benchmarks(rows, columns)
+            if names is None or name in names}
+
+def report(results):
+    print(f"{'benchmark':<24}{'ops/s':>14}{'p50 us':>10}{'p99 us':>10}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['ops_per_s']:>14.0f}{result['p50_us']:>10.2f}{result['p99_us']:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="Rows of the JSON payloads")
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=1.0, help="Time spent on each benchmark")
+    parser.add_argument("names", nargs="*", help="Only run these benchmarks")
+    args = parser.parse_args()
+    report(run(args.rows, args.columns, args.seconds, args.names or None))
+
+if __name__ == "__main__":
+    main()
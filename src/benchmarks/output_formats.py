@@ -0,0 +1,137 @@
+"""
+Output format benchmark: today's JSON envelope versus the CSV, Arrow IPC and
+MessagePack encodings in application.modules.formats.
+
+For a synthetic Pinot resultTable it reports the payload size, the server-side
+encode time and the client-side decode time. Decoding goes into pandas when it
+is installed, otherwise into the format's native structures: parsed JSON,
+csv rows, an Arrow table or MessagePack columns.
+
+    cd src && python -m benchmarks.output_formats --rows 200000 --repeat 3
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import time
+
+from application.modules import formats
+
+COLUMNS = [
+    ("event_id", "LONG"),
+    ("device_id", "STRING"),
+    ("country", "STRING"),
+    ("value", "DOUBLE"),
+    ("count", "INT"),
+    ("flag", "BOOLEAN"),
+]
+COUNTRIES = ["US", "DE", "FR", "IN", "BR", "JP"]
+
+def make_response(rows, seed=0):
+    """Return a Pinot broker response with `rows` synthetic rows."""
+    rng = random.Random(seed)
+    return {
+        "resultTable": {
+            "dataSchema": {"columnNames": [name for name, _ in COLUMNS],
+                           "columnDataTypes": [column_type for _, column_type in COLUMNS]},
+            "rows": [[index, f"device-{rng.randrange(10000)}", rng.choice(COUNTRIES),
+                      rng.random() * 1000, rng.randrange(1000), rng.random() < 0.5]
+                     for index in range(rows)]
+        },
+        "exceptions": [],
+        "numDocsScanned": rows,
+        "timeUsedMs": 12
+    }
+
+def encode_json(pinot_response):
+    return json.dumps({"success": True, "data": pinot_response}).encode("utf-8")
+
+def decoders():
+    """Return format -> client decode function, using pandas when available."""
+    try:
+        import pandas
+    except ImportError:
+        pandas = None
+
+    def decode_json(payload):
+        table = json.loads(payload)["data"]["resultTable"]
+        if pandas is not None:
+            return pandas.DataFrame(table["rows"], columns=table["dataSchema"]["columnNames"])
+        return table
+
+    def decode_csv(payload):
+        if pandas is not None:
+            return pandas.read_csv(io.BytesIO(payload))
+        return list(csv.reader(io.StringIO(payload.decode("utf-8"))))
+
+    def decode_arrow(payload):
+        import pyarrow as pa
+        table = pa.ipc.open_stream(payload).read_all()
+        return table.to_pandas() if pandas is not None else table
+
+    def decode_msgpack(payload):
+        import msgpack
+        data = msgpack.unpackb(payload)
+        if pandas is not None:
+            return pandas.DataFrame(dict(zip(data["columnNames"], data["columns"])))
+        return data
+
+    return {
+        formats.JSON: decode_json,
+        formats.CSV: decode_csv,
+        formats.ARROW: decode_arrow,
+        formats.MSGPACK: decode_msgpack,
+    }, pandas is not None
+
+def best_of(func, repeat):
+    """Return (result, best wall time in ms) over `repeat` runs."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return result, round(best, 1)
+
+def run(rows, repeat):
+    """Return format -> {bytes, encode_ms, decode_ms}; formats missing an optional package are skipped."""
+    pinot_response = make_response(rows)
+    decode, _ = decoders()
+    encoders = {formats.JSON: lambda: encode_json(pinot_response)}
+    for fmt in (formats.CSV, formats.ARROW, formats.MSGPACK):
+        encoders[fmt] = lambda fmt=fmt: formats.render_result(pinot_response, fmt)[0]
+
+    results = {}
+    for fmt, encode in encoders.items():
+        try:
+            payload, encode_ms = best_of(encode, repeat)
+            _, decode_ms = best_of(lambda: decode[fmt](payload), repeat)
+        except (formats.FormatUnavailable, ImportError) as e:
+            results[fmt] = {"skipped": str(e)}
+            continue
+        results[fmt] = {"bytes": len(payload), "encode_ms": encode_ms, "decode_ms": decode_ms}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the best is reported")
+    args = parser.parse_args()
+
+    _, with_pandas = decoders()
+    results = run(args.rows, args.repeat)
+
+    print(f"{args.rows} rows, client decodes into {'pandas' if with_pandas else 'native structures'}")
+    print(f"{'format':<10}{'bytes':>14}{'vs json':>10}{'encode ms':>12}{'decode ms':>12}")
+    json_bytes = results[formats.JSON]["bytes"]
+    for fmt, stats in results.items():
+        if "skipped" in stats:
+            print(f"{fmt:<10}skipped: {stats['skipped']}")
+            continue
+        ratio = f"{stats['bytes'] / json_bytes:.2f}x"
+        print(f"{fmt:<10}{stats['bytes']:>14}{ratio:>10}{stats['encode_ms']:>12}{stats['decode_ms']:>12}")
+
+if __name__ == "__main__":
+    main()
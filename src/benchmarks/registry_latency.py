@@ -0,0 +1,176 @@
+"""
+Registry latency benchmark: the original multi-call Redis sequences versus
+the single round-trip Lua scripts in application.modules.registry.
+
+Runs against fakeredis with a simulated network round trip per command
+(default), or against a real server with --redis-url.
+
+    cd src && python -m benchmarks.registry_latency --rtt-ms 0.5 --iterations 200
+"""
+import argparse
+import json
+import statistics
+import time
+import uuid
+
+import redis
+
+from application.modules.registry import Registry
+
+def create_client(redis_url, rtt_ms):
+    """Return a Redis client; fakeredis with rtt_ms of latency per round trip unless redis_url is set."""
+    if redis_url:
+        return redis.StrictRedis.from_url(redis_url, decode_responses=True)
+
+    import fakeredis
+    from fakeredis._clients._sync import FakeRedisConnection
+
+    delay = rtt_ms / 1000.0
+
+    class SlowConnection(FakeRedisConnection):
+        """A fake connection that pays one network round trip per packed command (or pipeline)."""
+
+        def send_packed_command(self, command, check_health=True):
+            time.sleep(delay)
+            return super(SlowConnection, self).send_packed_command(command, check_health)
+
+    return fakeredis.FakeStrictRedis(decode_responses=True, connection_class=SlowConnection)
+
+# The original view logic, kept here as the baseline
+
+def legacy_resolve_latest(redis_client, name):
+    if not redis_client.exists(name):
+        raise ValueError(f"API name '{name}' not found")
+    latest_uuid = redis_client.lindex(name, 0)
+    record = redis_client.get(latest_uuid)
+    return latest_uuid, json.loads(record)
+
+def legacy_create(redis_client, name, request_id, sql, parameters):
+    if redis_client.exists(name):
+        raise ValueError(f"Key '{name}' already exists")
+    redis_client.set(request_id, json.dumps({"name": name, "sql": sql, "parameters": parameters, "active": True}))
+    redis_client.lpush(name, request_id)
+
+def legacy_update(redis_client, name, new_uuid, sql, parameters):
+    if not redis_client.exists(name):
+        raise ValueError(f"API name '{name}' not found")
+    latest_uuid = redis_client.lindex(name, 0)
+    redis_client.set(new_uuid, json.dumps({"name": name, "sql": sql, "parameters": parameters, "active": True}))
+    old_record = redis_client.get(latest_uuid)
+    if old_record:
+        old_record_data = json.loads(old_record)
+        old_record_data['active'] = False
+        redis_client.set(latest_uuid, json.dumps(old_record_data))
+    redis_client.lpush(name, new_uuid)
+
+def legacy_delete_by_name(redis_client, name):
+    if not redis_client.exists(name):
+        raise ValueError(f"API name '{name}' not found")
+    versions = redis_client.lrange(name, 0, -1)
+    for version in versions:
+        redis_client.delete(version)
+    redis_client.delete(name)
+
+def legacy_delete_by_version(redis_client, version):
+    if not redis_client.exists(version):
+        raise ValueError(f"UUID '{version}' not found")
+    record_data = json.loads(redis_client.get(version))
+    name = record_data.get('name')
+    versions = redis_client.lrange(name, 0, -1)
+    if len(versions) == 1 and versions[0] == version:
+        raise ValueError("Cannot delete the last UUID")
+    redis_client.lrem(name, 0, version)
+    if record_data.get('active', False):
+        next_uuid = redis_client.lindex(name, 0)
+        if next_uuid:
+            next_record_data = json.loads(redis_client.get(next_uuid))
+            next_record_data['active'] = True
+            redis_client.set(next_uuid, json.dumps(next_record_data))
+    redis_client.delete(version)
+
+SQL = "SELECT * FROM events WHERE %column% = %value% LIMIT %limit%"
+PARAMETERS = {
+    "column": {"default": "device_id", "type": "column"},
+    "value": {"default": "abc", "type": "string"},
+    "limit": {"default": 100, "type": "integer"}
+}
+
+def timed(func, iterations):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1000.0)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+        "mean_ms": round(statistics.fmean(samples), 3)
+    }
+
+def run(redis_client, iterations, versions):
+    registry = Registry(redis_client)
+    results = {}
+
+    def scenario(label, legacy, scripted, setup=None):
+        for impl, func in (("legacy", legacy), ("registry", scripted)):
+            redis_client.flushdb()
+            if setup:
+                setup(impl)
+            results.setdefault(label, {})[impl] = timed(func, iterations)
+
+    def seed(prefix, count):
+        # Each implementation is seeded in its own storage format
+        def setup(impl):
+            for i in range(iterations):
+                name = f"{prefix}{i}"
+                if impl == "legacy":
+                    legacy_create(redis_client, name, str(uuid.uuid4()), SQL, PARAMETERS)
+                else:
+                    registry.create(name, str(uuid.uuid4()), SQL, PARAMETERS)
+                for _ in range(count - 1):
+                    if impl == "legacy":
+                        legacy_update(redis_client, name, str(uuid.uuid4()), SQL, PARAMETERS)
+                    else:
+                        registry.update(name, str(uuid.uuid4()), SQL, PARAMETERS)
+        return setup
+
+    scenario("resolve_latest",
+             lambda i: legacy_resolve_latest(redis_client, "api0"),
+             lambda i: registry.resolve_latest("api0"),
+             seed("api", 1))
+    scenario("create",
+             lambda i: legacy_create(redis_client, f"api{i}", str(uuid.uuid4()), SQL, PARAMETERS),
+             lambda i: registry.create(f"api{i}", str(uuid.uuid4()), SQL, PARAMETERS))
+    scenario("update",
+             lambda i: legacy_update(redis_client, "api0", str(uuid.uuid4()), SQL, PARAMETERS),
+             lambda i: registry.update("api0", str(uuid.uuid4()), SQL, PARAMETERS),
+             seed("api", 1))
+    scenario(f"delete_by_name ({versions} versions)",
+             lambda i: legacy_delete_by_name(redis_client, f"api{i}"),
+             lambda i: registry.delete_by_name(f"api{i}"),
+             seed("api", versions))
+    scenario("delete_by_version (active)",
+             lambda i: legacy_delete_by_version(redis_client, redis_client.lindex(f"api{i}", 0)),
+             lambda i: registry.delete_by_version(redis_client.lindex(f"api{i}", 0)),
+             seed("api", 2))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=None, help="Benchmark a real Redis server instead of fakeredis")
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="Simulated round-trip time for fakeredis")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=10, help="Versions per name for delete_by_name")
+    args = parser.parse_args()
+
+    redis_client = create_client(args.redis_url, args.rtt_ms)
+    results = run(redis_client, args.iterations, args.versions)
+
+    print(f"{'operation':<32}{'impl':<10}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for label, impls in results.items():
+        for impl, stats in impls.items():
+            print(f"{label:<32}{impl:<10}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['mean_ms']:>10}")
+
+if __name__ == "__main__":
+    main()
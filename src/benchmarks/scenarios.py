@@ -0,0 +1,181 @@
+"""
+End-to-end load scenarios against the wrapper, a local stub broker and a
+fakeredis TCP server (or a real Redis with --redis-url); nothing leaves the
+machine.
+
+- execute_heavy: mostly saved API executions, with some lookups.
+- list_heavy: mostly name listing and API lookups.
+- crud_mixed: creates, updates, lookups, deletes and executions.
+
+Each scenario runs for --duration seconds at --concurrency requests in
+flight, against --apis saved APIs created beforehand. Reported per scenario
+and per operation: throughput, p50/p99 latency and errors.
+
+    cd src && python -m benchmarks.scenarios --latency-ms 20 --rows 100 --duration 10 --concurrency 32
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+import httpx
+
+from benchmarks import harness
+
+TOKEN = "benchmark"
+HEADERS = {"Authorization": f"Bearer {TOKEN}"}
+SQL = "SELECT * FROM events WHERE device_id = %device% AND value > %threshold% LIMIT 100"
+PARAMETERS = {"device": {"default": "d0", "type": "string"}, "threshold": {"default": 0, "type": "integer"}}
+
+# Scenario -> [(operation, weight)]
+SCENARIOS = {
+    "execute_heavy": [("execute", 90), ("get", 5), ("list", 5)],
+    "list_heavy": [("list", 60), ("get", 30), ("execute", 10)],
+    "crud_mixed": [("create", 20), ("update", 20), ("get", 20), ("delete", 10), ("execute", 30)],
+}
+
+def seed_name(index):
+    return f"bench_seed_{index:05d}"
+
+class Operations(object):
+    """The requests a scenario is made of. Seeded APIs are never deleted; created ones are."""
+
+    def __init__(self, client, apis):
+        self.client = client
+        self.apis = apis
+        self.created = []
+        self.counter = itertools.count()
+
+    async def execute(self):
+        body = {"parameters": {"device": f"d{next(self.counter)}", "threshold": random.randint(0, 100)}}
+        return await self.client.post(f"/v1/execute/api/{seed_name(random.randrange(self.apis))}", json=body,
+                                      headers=HEADERS)
+
+    async def list(self):
+        return await self.client.get("/v1/get/list", params={"limit": 100, "prefix": "bench_seed_0"}, headers=HEADERS)
+
+    async def get(self):
+        return await self.client.get(f"/v1/get/api/{seed_name(random.randrange(self.apis))}", headers=HEADERS)
+
+    async def create(self):
+        name = f"bench_new_{next(self.counter)}_{random.getrandbits(32):08x}"
+        response = await self.client.post("/v1/create/", json={"name": name, "sql": SQL, "parameters": PARAMETERS},
+                                          headers=HEADERS)
+        if response.status_code == 200:
+            self.created.append(name)
+        return response
+
+    async def update(self):
+        return await self.client.post(f"/v1/update/{seed_name(random.randrange(self.apis))}",
+                                      json={"sql": SQL, "parameters": PARAMETERS}, headers=HEADERS)
+
+    async def delete(self):
+        if not self.created:
+            return await self.create()
+        return await self.client.delete(f"/v1/delete/api/{self.created.pop()}", headers=HEADERS)
+
+async def seed(url, apis, concurrency=16):
+    """Create the seeded APIs, if missing."""
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        slots = asyncio.Semaphore(concurrency)
+
+        async def create(index):
+            async with slots:
+                response = await client.post("/v1/create/", json={"name": seed_name(index), "sql": SQL,
+                                                                  "parameters": PARAMETERS}, headers=HEADERS)
+                # An existing name is fine: the seed survives from an earlier scenario
+                if response.status_code not in (200, 400, 409):
+                    response.raise_for_status()
+
+        await asyncio.gather(*[create(index) for index in range(apis)])
+
+async def run_scenario(url, scenario, concurrency, duration, apis):
+    """Run one scenario; return {"overall": latencies, operation: latencies, ...} (ms) and {operation: errors}."""
+    operations, weights = zip(*SCENARIOS[scenario])
+    latencies = {operation: [] for operation in operations}
+    errors = {operation: 0 for operation in operations}
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        ops = Operations(client, apis)
+
+        async def worker():
+            while time.monotonic() < deadline:
+                operation = random.choices(operations, weights)[0]
+                started = time.perf_counter()
+                try:
+                    response = await getattr(ops, operation)()
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if not ok:
+                    errors[operation] += 1
+                    continue
+                latencies[operation].append((time.perf_counter() - started) * 1000.0)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors
+
+def summarize(latencies, errors, duration):
+    """Throughput, p50/p99 (ms), errors and error rate of a list of latencies."""
+    count = len(latencies)
+    return {"rps": count / duration, "p50_ms": harness.percentile(latencies, 0.50),
+            "p99_ms": harness.percentile(latencies, 0.99), "errors": errors,
+            "error_rate": errors / float(count + errors) if count + errors else 0.0}
+
+def run(scenarios=None, mode="wsgi", latency_ms=20, rows=100, duration=10, concurrency=32, apis=200,
+        redis_url=None):
+    """
+    Start the stub broker, Redis stand-in and wrapper, and run the scenarios.
+    Returns {scenario: {"overall": summary, "operations": {operation: summary}}}.
+    """
+    redis_host, redis_port = harness.start_redis(redis_url)
+    broker, broker_url = harness.start_stub_broker(latency_ms, rows)
+    env, cwd = harness.app_environment(redis_host, redis_port, broker_url)
+    process, url = harness.start_wrapper(mode, env, cwd)
+    results = {}
+    try:
+        asyncio.run(seed(url, apis))
+        for scenario in scenarios or SCENARIOS:
+            latencies, errors = asyncio.run(run_scenario(url, scenario, concurrency, duration, apis))
+            results[scenario] = {
+                "overall": summarize(list(itertools.chain(*latencies.values())), sum(errors.values()), duration),
+                "operations": {operation: summarize(latencies[operation], errors[operation], duration)
+                               for operation in latencies},
+            }
+    finally:
+        process.terminate()
+        process.wait()
+        broker.terminate()
+        broker.wait()
+    return results
+
+def report(results):
+    print(f"{'scenario':<16}{'operation':<12}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for scenario, result in results.items():
+        rows = [("all", result["overall"])] + list(result["operations"].items())
+        for operation, summary in rows:
+            print(f"{scenario:<16}{operation:<12}{summary['rps']:>10.1f}{summary['p50_ms']:>10.1f}"
+                  f"{summary['p99_ms']:>10.1f}{summary['errors']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=None, help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--mode", default="wsgi", choices=["wsgi", "asgi"])
+    parser.add_argument("--latency-ms", type=float, default=20, help="Stub broker latency")
+    parser.add_argument("--rows", type=int, default=100, help="Rows per stub broker response")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--apis", type=int, default=200, help="Saved APIs created before the scenarios")
+    parser.add_argument("scenarios", nargs="*", help=f"Any of {', '.join(SCENARIOS)} (default: all)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    report(run(args.scenarios or None, args.mode, args.latency_ms, args.rows, args.duration, args.concurrency,
+               args.apis, args.redis_url))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Startup benchmark: the cost of booting a worker in each app profile
+(APP_PROFILE), against a fakeredis TCP server (or --redis-url) holding
+--apis saved APIs for the warm start to preload.
+
+Each run is a fresh interpreter that imports the application and calls
+create_app(). Reported per profile, as the median of --runs runs:
+
+- import_ms: importing the application package and its dependencies.
+- create_app_ms: create_app(), the warm start included.
+- process_ms: the whole process, interpreter startup and exit included.
+- rss_mb: resident memory once booted (Linux).
+- modules: modules loaded once booted.
+
+One more run per profile under `python -X importtime` lists the --top
+packages that took longest to import (cumulative, so a package includes
+the packages it imported first).
+
+    cd src && python -m benchmarks.startup --runs 5 --apis 200
+    cd src && python -m benchmarks.startup execute-only admin
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import redis
+
+from benchmarks import harness
+from benchmarks.scenarios import PARAMETERS, SQL, seed_name
+
+PROFILES = ("full", "execute-only", "admin")
+
+# Runs in each worker process; prints its measurements as JSON on the last line
+BOOT = """
+import json, os, sys, time
+started = time.perf_counter()
+import application
+imported = time.perf_counter()
+app = application.create_app()
+booted = time.perf_counter()
+rss_mb = None
+if os.path.exists("/proc/self/status"):
+    with open("/proc/self/status") as status:
+        rss_mb = next((int(line.split()[1]) / 1024.0 for line in status if line.startswith("VmRSS:")), None)
+print(json.dumps({"import_ms": (imported - started) * 1000.0, "create_app_ms": (booted - imported) * 1000.0,
+                  "rss_mb": rss_mb, "modules": len(sys.modules)}))
+"""
+
+# Imported by the interpreter itself, before the worker code runs
+STARTUP_PACKAGES = ("site", "encodings")
+
+def seed(redis_host, redis_port, apis):
+    """Create the saved APIs to preload, if missing."""
+    from application.modules.registry import Registry, RegistryError
+    registry = Registry(redis.StrictRedis(host=redis_host, port=redis_port, decode_responses=True))
+    for index in range(apis):
+        try:
+            registry.create(seed_name(index), f"startup-{index:05d}", SQL, PARAMETERS)
+        except RegistryError:
+            pass
+
+def boot(env, cwd, importtime=False):
+    """Boot one worker; return its measurements, and its -X importtime report when asked for."""
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", BOOT]
+    started = time.perf_counter()
+    process = subprocess.run(args, cwd=cwd, env=env, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - started) * 1000.0
+    if process.returncode != 0:
+        raise RuntimeError(f"Worker failed to boot: {process.stderr.strip().splitlines()[-1:]}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["process_ms"] = elapsed
+    return result, process.stderr
+
+def top_imports(report, top):
+    """Return [(package, cumulative ms)] of the slowest packages to import in a -X importtime report."""
+    packages = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        package = module.strip().split(".")[0]
+        if cumulative.strip().isdigit() and package not in STARTUP_PACKAGES:
+            # The outermost import of a package has the largest cumulative time
+            packages[package] = max(packages.get(package, 0.0), int(cumulative) / 1000.0)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+
+def run(profiles=PROFILES, runs=5, apis=200, top=8, redis_url=None):
+    """Boot workers in each profile; return {profile: {"runs": medians, "imports": slowest packages}}."""
+    redis_host, redis_port = harness.start_redis(redis_url)
+    seed(redis_host, redis_port, apis)
+    results = {}
+    for profile in profiles:
+        env, cwd = harness.app_environment(redis_host, redis_port, "http://127.0.0.1:9",
+                                           {"APP_PROFILE": profile})
+        samples = [boot(env, cwd)[0] for _ in range(runs)]
+        _, report = boot(env, cwd, importtime=True)
+        results[profile] = {
+            "runs": {metric: statistics.median(sample[metric] for sample in samples) for metric in samples[0]
+                     if samples[0][metric] is not None},
+            "imports": top_imports(report, top),
+        }
+    return results
+
+def report(results):
+    print(f"{'profile':<14}{'import ms':>11}{'create_app ms':>15}{'process ms':>12}{'RSS MB':>9}{'modules':>9}")
+    for profile, result in results.items():
+        runs = result["runs"]
+        print(f"{profile:<14}{runs['import_ms']:>11.1f}{runs['create_app_ms']:>15.1f}{runs['process_ms']:>12.1f}"
+              f"{runs.get('rss_mb', 0.0):>9.1f}{runs['modules']:>9.0f}")
+    for profile, result in results.items():
+        print(f"\n{profile}: slowest packages to import (cumulative ms)")
+        for module, ms in result["imports"]:
+            print(f"  {module:<40}{ms:>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=None, help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--runs", type=int, default=5, help="Boots per profile")
+    parser.add_argument("--apis", type=int, default=200, help="Saved APIs created for the warm start")
+    parser.add_argument("--top", type=int, default=8, help="Slowest packages to import listed per profile")
+    parser.add_argument("profiles", nargs="*", help=f"Any of {', '.join(PROFILES)} (default: all)")
+    args = parser.parse_args()
+    unknown = set(args.profiles) - set(PROFILES)
+    if unknown:
+        parser.error(f"unknown profiles: {', '.join(sorted(unknown))}")
+    report(run(args.profiles or PROFILES, args.runs, args.apis, args.top, args.redis_url))
+
+if __name__ == "__main__":
+    main()
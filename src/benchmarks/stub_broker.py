@@ -0,0 +1,168 @@
+"""
+Stub Pinot broker for benchmarks and load tests.
+
+Answers GET /health (401 for the token "invalid") and POST /query/sql with
+a synthetic resultTable after a configurable delay.
+
+Failures can be injected to exercise broker failover: --jitter-ms adds a
+random delay, --fail-rate answers that fraction of queries with 503, and
+POST /_stub/config changes latency_ms, jitter_ms, fail_rate and down (503
+for every request, health checks included) while the broker runs.
+
+Like Pinot, queries give up after the timeoutMs query option (answering
+with a timeout exception), and DELETE /clientQuery/<id> cancels the query
+sent with that clientQueryId.
+
+    cd src && python -m benchmarks.stub_broker --port 18099 --latency-ms 50 --rows 100
+    cd src && python -m benchmarks.stub_broker --port 18100 --latency-ms 50 --fail-rate 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+
+class StubBroker(object):
+    """Minimal ASGI app imitating the Pinot broker endpoints used by the wrapper."""
+
+    def __init__(self, latency_ms=50, rows=100, columns=4, jitter_ms=0, fail_rate=0.0):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.fail_rate = fail_rate
+        self.down = False
+        self.rows = rows
+        self.columns = columns
+        self.queries = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        # clientQueryId -> task sleeping through the query
+        self.running = {}
+        # Encoded once: the stub should spend as little CPU as possible per query
+        self.payload = json.dumps(self.result()).encode('utf-8')
+
+    def result(self):
+        column_names = [f"col{i}" for i in range(self.columns)]
+        column_types = ["STRING" if i % 2 == 0 else "LONG" for i in range(self.columns)]
+        rows = [[f"value{r}" if i % 2 == 0 else r * i for i in range(self.columns)] for r in range(self.rows)]
+        return {
+            "resultTable": {
+                "dataSchema": {"columnNames": column_names, "columnDataTypes": column_types},
+                "rows": rows
+            },
+            "exceptions": [],
+            "numServersQueried": 1,
+            "numServersResponded": 1,
+            "numDocsScanned": self.rows,
+            "numEntriesScannedInFilter": 0,
+            "numEntriesScannedPostFilter": self.rows * self.columns,
+            "totalDocs": self.rows,
+            "timeUsedMs": int(self.latency * 1000)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                await send({'type': message['type'] + '.complete'})
+                if message['type'] == 'lifespan.shutdown':
+                    return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        if scope['path'] == '/_stub/config' and scope['method'] == 'POST':
+            return await self.send(send, 200, self.configure(json.loads(body or b'{}')))
+        if self.down:
+            return await self.send(send, 503, {"error": "Broker is down"})
+        headers = dict(scope.get('headers', []))
+        if headers.get(b'authorization') == b'Bearer invalid':
+            return await self.send(send, 401, {"error": "Unauthorized"})
+        if scope['path'] == '/health':
+            return await self.send(send, 200, {"status": "OK"})
+        if scope['path'].startswith('/clientQuery/') and scope['method'] == 'DELETE':
+            task = self.running.get(scope['path'][len('/clientQuery/'):])
+            if task is None:
+                return await self.send(send, 404, {"error": "Query not found"})
+            task.cancel()
+            return await self.send(send, 200, {"status": "Cancelled"})
+        if scope['path'] == '/query/sql' and scope['method'] == 'POST':
+            self.queries += 1
+            options = self.query_options(body)
+            delay = self.latency + random.uniform(0, self.jitter)
+            timeout = float(options['timeoutMs']) / 1000.0 if 'timeoutMs' in options else None
+            task = asyncio.ensure_future(asyncio.sleep(delay if timeout is None else min(delay, timeout)))
+            client_query_id = options.get('clientQueryId')
+            if client_query_id:
+                self.running[client_query_id] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                return await self.send(send, 200, dict(self.result(), resultTable=None, exceptions=[
+                    {"errorCode": 503, "message": "QueryCancelledError: cancelled by the client"}]))
+            finally:
+                self.running.pop(client_query_id, None)
+            if timeout is not None and delay > timeout:
+                self.timeouts += 1
+                return await self.send(send, 200, dict(self.result(), resultTable=None, exceptions=[
+                    {"errorCode": 250, "message": "QueryExecutionError: query timed out"}]))
+            if self.fail_rate and random.random() < self.fail_rate:
+                self.failures += 1
+                return await self.send(send, 503, {"error": "Injected failure"})
+            return await self.send_raw(send, 200, self.payload)
+        return await self.send(send, 404, {"error": "Not found"})
+
+    @staticmethod
+    def query_options(body):
+        """Return the "key=value;..." queryOptions of a query request as a dict."""
+        try:
+            options = json.loads(body or b'{}').get('queryOptions') or ""
+        except ValueError:
+            return {}
+        return dict(option.split("=", 1) for option in options.split(";") if "=" in option)
+
+    def configure(self, settings):
+        """Apply runtime settings from POST /_stub/config and return the current ones with the counters."""
+        if 'latency_ms' in settings:
+            self.latency = float(settings['latency_ms']) / 1000.0
+        if 'jitter_ms' in settings:
+            self.jitter = float(settings['jitter_ms']) / 1000.0
+        if 'fail_rate' in settings:
+            self.fail_rate = float(settings['fail_rate'])
+        if 'down' in settings:
+            self.down = bool(settings['down'])
+        return {"latency_ms": self.latency * 1000, "jitter_ms": self.jitter * 1000, "fail_rate": self.fail_rate,
+                "down": self.down, "queries": self.queries, "failures": self.failures, "timeouts": self.timeouts,
+                "cancelled": self.cancelled}
+
+    @classmethod
+    async def send(cls, send, status, body):
+        await cls.send_raw(send, status, json.dumps(body).encode('utf-8'))
+
+    @staticmethod
+    async def send_raw(send, status, payload):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(payload)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': payload})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18099)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency, up to this much")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of queries answered with 503")
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(StubBroker(args.latency_ms, args.rows, args.columns, args.jitter_ms, args.fail_rate),
+                host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
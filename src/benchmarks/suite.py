@@ -0,0 +1,119 @@
+"""
+Regression suite: runs the microbenchmarks and load scenarios with fixed
+settings, offline, and fails (exit status 1) when a result crosses a
+threshold.
+
+- Absolute thresholds come from --thresholds (benchmarks/thresholds.json):
+  per microbenchmark or scenario, min_<metric> and max_<metric> bounds,
+  e.g. min_ops_per_s, min_rps, max_p99_ms, max_error_rate. Scenario
+  thresholds apply to the scenario's overall results.
+- With --baseline (results saved by an earlier --save), throughput may not
+  drop, nor scenario p50 latency grow, by more than --tolerance. Compare
+  runs from the same machine and settings; --quick runs are noisier.
+
+    cd src && python -m benchmarks.suite --quick
+    cd src && python -m benchmarks.suite --save baseline.json
+    cd src && python -m benchmarks.suite --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import micro, scenarios
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+# The absolute thresholds assume these settings; --quick only shortens the runs
+SETTINGS = {"rows": 1000, "columns": 4, "seconds": 1.0, "latency_ms": 20, "stub_rows": 100, "duration": 10,
+            "concurrency": 16, "apis": 100}
+QUICK = {"seconds": 0.2, "duration": 3}
+
+# Metric -> whether a higher value is better, for baseline comparisons
+BASELINE_METRICS = {"ops_per_s": True, "rps": True, "p50_ms": False}
+
+def run(settings, mode="wsgi", redis_url=None):
+    """Run the microbenchmarks and scenarios; return {"settings", "micro", "scenarios"}."""
+    return {
+        "settings": dict(settings, mode=mode),
+        "micro": micro.run(settings["rows"], settings["columns"], settings["seconds"]),
+        "scenarios": {scenario: result["overall"] for scenario, result in scenarios.run(
+            None, mode, settings["latency_ms"], settings["stub_rows"], settings["duration"],
+            settings["concurrency"], settings["apis"], redis_url).items()},
+    }
+
+def check_thresholds(results, thresholds):
+    """Return a failure message for every result outside its min_*/max_* thresholds."""
+    failures = []
+    for group in ("micro", "scenarios"):
+        for name, limits in thresholds.get(group, {}).items():
+            result = results[group].get(name)
+            if result is None:
+                failures.append(f"{group}.{name}: no result")
+                continue
+            for key, limit in limits.items():
+                bound, metric = key.split("_", 1)
+                value = result[metric]
+                if (bound == "min" and value < limit) or (bound == "max" and value > limit):
+                    failures.append(f"{group}.{name}: {metric} {value:.2f} is {'below' if bound == 'min' else 'above'}"
+                                    f" the threshold {limit}")
+    return failures
+
+def compare_baseline(results, baseline, tolerance):
+    """Return a failure message for every metric that regressed by more than tolerance against the baseline."""
+    failures = []
+    for group in ("micro", "scenarios"):
+        for name, previous in baseline.get(group, {}).items():
+            result = results[group].get(name)
+            if result is None:
+                continue
+            for metric, higher_is_better in BASELINE_METRICS.items():
+                if metric not in previous or not previous[metric]:
+                    continue
+                change = (result[metric] - previous[metric]) / previous[metric]
+                if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                    failures.append(f"{group}.{name}: {metric} {result[metric]:.2f} vs {previous[metric]:.2f} "
+                                    f"in the baseline ({change:+.0%})")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Shorter runs, e.g. for CI")
+    parser.add_argument("--mode", default="wsgi", choices=["wsgi", "asgi"])
+    parser.add_argument("--redis-url", default=None, help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--thresholds", default=THRESHOLDS, help="Absolute thresholds (JSON); '' for none")
+    parser.add_argument("--baseline", default=None, help="Results saved by an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline")
+    parser.add_argument("--save", default=None, help="Write the results to this file")
+    args = parser.parse_args()
+
+    settings = dict(SETTINGS, **QUICK) if args.quick else SETTINGS
+    results = run(settings, args.mode, args.redis_url)
+    micro.report(results["micro"])
+    print()
+    scenarios.report({scenario: {"overall": summary, "operations": {}}
+                      for scenario, summary in results["scenarios"].items()})
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            failures += check_thresholds(results, json.load(f))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings", {}).get("mode") != args.mode:
+            print(f"warning: the baseline was run in {baseline.get('settings', {}).get('mode')} mode")
+        failures += compare_baseline(results, baseline, args.tolerance)
+
+    print()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"{len(failures)} regression(s)" if failures else "OK")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -9,16 +10,109 @@ class BaseConfig(object):
     LOGGING_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     LOGGING_LOCATION = '../logs/messaging.log'
     LOGGING_LEVEL = logging.INFO
+    LOGGING_CONFIG = {"json": os.environ.get("LOGGING_JSON", "true").lower() == "true",
+                      "queue_size": int(os.environ.get("LOGGING_QUEUE_SIZE", 10000)),
+                      "default_sample_rate": float(os.environ.get("LOGGING_SAMPLE_RATE", 1.0)),
+                      # "route=rate,..." e.g. "/v1/execute/api/<name>=0.1"
+                      "sample_rates": {route: float(rate) for route, rate in (
+                          item.rsplit("=", 1) for item in os.environ.get("LOGGING_SAMPLE_RATES", "").split(",") if item)},
+                      "sql_max_length": int(os.environ.get("LOGGING_SQL_MAX_LENGTH", 200)),
+                      }
     ENV_VARIABLE = os.environ.get("ENV_VARIABLE", "default")
     SESSION_PERMANENT = False
     SESSION_TYPE = 'filesystem'
+    # Routes a worker serves: "full", "execute-only" (execute, pass-through query, stats) or "admin" (CRUD and UI)
+    APP_PROFILE = os.environ.get("APP_PROFILE", "full")
     REDIS_CONFIG = {"host": os.environ.get("REDIS_HOST", "localhost"),
                     "username": os.environ.get("REDIS_USERNAME", ""),
                     "password": os.environ.get("REDIS_PASSWORD", ""),
                     "db": int(os.environ.get("REDIS_DB", 0)),
                     "port": int(os.environ.get("REDIS_PORT", 6379)),
                     }
-    PINOT_CONFIG = {"broker": "https://broker.pinot.flrg1s.s7e.startree.cloud", "controller": "https://pinot.flrg1s.s7e.startree.cloud"}
+    TOKEN_CACHE_CONFIG = {"max_size": int(os.environ.get("TOKEN_CACHE_MAX_SIZE", 10000)),
+                          "valid_ttl": float(os.environ.get("TOKEN_CACHE_VALID_TTL", 300)),
+                          "invalid_ttl": float(os.environ.get("TOKEN_CACHE_INVALID_TTL", 30)),
+                          "use_redis": os.environ.get("TOKEN_CACHE_USE_REDIS", "false").lower() == "true",
+                          }
+    TEMPLATE_CACHE_CONFIG = {"max_size": int(os.environ.get("TEMPLATE_CACHE_MAX_SIZE", 1000)),
+                             "channel": os.environ.get("TEMPLATE_CACHE_CHANNEL", "query_wrapper:registry"),
+                             }
+    # Preload saved API templates at boot: every API (top_n 0) or the top_n run most in the last `window` seconds
+    WARMUP_CONFIG = {"enabled": os.environ.get("WARMUP_ENABLED", "true").lower() == "true",
+                     "top_n": int(os.environ.get("WARMUP_TOP_N", 0)),
+                     "window": float(os.environ.get("WARMUP_WINDOW", 86400)),
+                     "batch_size": int(os.environ.get("WARMUP_BATCH_SIZE", 500)),
+                     "gc_freeze": os.environ.get("WARMUP_GC_FREEZE", "false").lower() == "true",
+                     }
+    RESULT_CACHE_CONFIG = {"max_entries": int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 1000)),
+                           "max_bytes": int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+                           "use_redis": os.environ.get("RESULT_CACHE_USE_REDIS", "true").lower() == "true",
+                           "refresh_workers": int(os.environ.get("RESULT_CACHE_REFRESH_WORKERS", 2)),
+                           }
+    SINGLE_FLIGHT_CONFIG = {"enabled": os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true",
+                            "use_redis": os.environ.get("SINGLE_FLIGHT_USE_REDIS", "true").lower() == "true",
+                            "lock_ttl": float(os.environ.get("SINGLE_FLIGHT_LOCK_TTL", 30)),
+                            "result_ttl": float(os.environ.get("SINGLE_FLIGHT_RESULT_TTL", 5)),
+                            "wait_timeout": float(os.environ.get("SINGLE_FLIGHT_WAIT_TIMEOUT", 30)),
+                            }
+    BATCH_CONFIG = {"max_items": int(os.environ.get("BATCH_MAX_ITEMS", 50)),
+                    "max_workers": int(os.environ.get("BATCH_MAX_WORKERS", 16)),
+                    "deadline": float(os.environ.get("BATCH_DEADLINE", 30)),
+                    }
+    PAGINATION_CONFIG = {"max_page_size": int(os.environ.get("PAGINATION_MAX_PAGE_SIZE", 10000)),
+                         "store_enabled": os.environ.get("PAGINATION_STORE_ENABLED", "true").lower() == "true",
+                         "store_ttl": float(os.environ.get("PAGINATION_STORE_TTL", 300)),
+                         "store_max_rows": int(os.environ.get("PAGINATION_STORE_MAX_ROWS", 100000)),
+                         }
+    IN_LIST_CONFIG = {"chunk_size": int(os.environ.get("IN_LIST_CHUNK_SIZE", 1000)),
+                      "max_values": int(os.environ.get("IN_LIST_MAX_VALUES", 100000)),
+                      }
+    QUERY_STATS_CONFIG = {"enabled": os.environ.get("QUERY_STATS_ENABLED", "true").lower() == "true",
+                          "slow_query_ms": float(os.environ.get("QUERY_STATS_SLOW_QUERY_MS", 1000)),
+                          "slow_log_size": int(os.environ.get("QUERY_STATS_SLOW_LOG_SIZE", 1000)),
+                          "flush_interval": float(os.environ.get("QUERY_STATS_FLUSH_INTERVAL", 5)),
+                          "minute_retention": int(os.environ.get("QUERY_STATS_MINUTE_RETENTION", 86400)),
+                          "hour_retention": int(os.environ.get("QUERY_STATS_HOUR_RETENTION", 30 * 86400)),
+                          # Keep the bound SQL, with caller values, in the slow-query log
+                          "log_raw_sql": os.environ.get("QUERY_STATS_LOG_RAW_SQL", "false").lower() == "true",
+                          }
+    ADMISSION_CONFIG = {"enabled": os.environ.get("ADMISSION_ENABLED", "true").lower() == "true",
+                        "token_rate": float(os.environ.get("RATE_LIMIT_TOKEN_RATE", 50)),
+                        "token_burst": float(os.environ.get("RATE_LIMIT_TOKEN_BURST", 100)),
+                        "api_rate": float(os.environ.get("RATE_LIMIT_API_RATE", 0)),
+                        "api_burst": float(os.environ.get("RATE_LIMIT_API_BURST", 0)),
+                        # {"api name": [rate, burst]}
+                        "api_limits": json.loads(os.environ.get("RATE_LIMIT_API_LIMITS", "{}")),
+                        "max_concurrent": int(os.environ.get("ADMISSION_MAX_CONCURRENT", 32)),
+                        "max_queue": int(os.environ.get("ADMISSION_MAX_QUEUE", 64)),
+                        "queue_timeout": float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 2)),
+                        }
+    DEADLINE_CONFIG = {"default_timeout": float(os.environ.get("REQUEST_DEFAULT_TIMEOUT", 30)),
+                       "max_timeout": float(os.environ.get("REQUEST_MAX_TIMEOUT", 300)),
+                       }
+    # backend: "auto" (orjson when installed), "orjson" or "json"
+    JSON_CONFIG = {"backend": os.environ.get("JSON_BACKEND", "auto"),
+                   "passthrough": os.environ.get("JSON_PASSTHROUGH", "true").lower() == "true",
+                   }
+    METRICS_CONFIG = {"enabled": os.environ.get("METRICS_ENABLED", "true").lower() == "true",
+                      }
+    # PINOT_BROKER may list several comma-separated brokers
+    PINOT_CONFIG = {"broker": os.environ.get("PINOT_BROKER", "https://broker.pinot.flrg1s.s7e.startree.cloud"),
+                    "controller": os.environ.get("PINOT_CONTROLLER", "https://pinot.flrg1s.s7e.startree.cloud")}
+    PINOT_CLIENT_CONFIG = {"pool_size": int(os.environ.get("PINOT_POOL_SIZE", 10)),
+                           "async_pool_size": int(os.environ.get("PINOT_ASYNC_POOL_SIZE", 100)),
+                           "connect_timeout": float(os.environ.get("PINOT_CONNECT_TIMEOUT", 3.05)),
+                           "read_timeout": float(os.environ.get("PINOT_READ_TIMEOUT", 60)),
+                           "max_retries": int(os.environ.get("PINOT_MAX_RETRIES", 3)),
+                           "backoff_factor": float(os.environ.get("PINOT_BACKOFF_FACTOR", 0.3)),
+                           "balancer": os.environ.get("PINOT_BALANCER", "least_outstanding"),
+                           "max_failovers": int(os.environ.get("PINOT_MAX_FAILOVERS", 2)),
+                           "failure_threshold": int(os.environ.get("PINOT_FAILURE_THRESHOLD", 5)),
+                           "open_seconds": float(os.environ.get("PINOT_BREAKER_OPEN_SECONDS", 30)),
+                           "probe_interval": float(os.environ.get("PINOT_PROBE_INTERVAL", 10)),
+                           "timeout_margin_ms": float(os.environ.get("PINOT_TIMEOUT_MARGIN_MS", 100)),
+                           "cancel_queries": os.environ.get("PINOT_CANCEL_QUERIES", "false").lower() == "true",
+                           }
 
 config = {
     "default": "config.BaseConfig"
@@ -28,12 +122,3 @@ def configure_app(application):
     config_name = os.getenv('FLASK_CONFIGURATION', 'default')
     application.config.from_object(config[config_name])
     application.config.from_pyfile('config.py', silent=True)
-    
-    # Configure logging
-    logger = logging.getLogger()
-    handler = logging.FileHandler(application.config['LOGGING_LOCATION'])
-    handler.setLevel(application.config['LOGGING_LEVEL'])
-    formatter = logging.Formatter(application.config['LOGGING_FORMAT'])
-    handler.setFormatter(formatter)
-    application.logger.addHandler(handler)
-    application.logger.setLevel(application.config['LOGGING_LEVEL'])
\ No newline at end of file
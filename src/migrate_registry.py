@@ -0,0 +1,38 @@
+"""
+Convert saved-API version records from JSON strings (schema 1) to Redis
+hashes (schema 2, see application.modules.registry). The service reads both
+formats, so this can run while it serves traffic, and more than once.
+
+Connects to the Redis in REDIS_CONFIG (or --redis-url).
+
+    cd src && python migrate_registry.py --dry-run
+    cd src && python migrate_registry.py --redis-url redis://localhost:6379/0
+"""
+import argparse
+import os
+
+import redis
+from werkzeug.utils import import_string
+
+from config import config
+from application.modules.registry import Registry
+from application.modules.utils import create_redis_client
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=None, help="Redis to migrate instead of REDIS_CONFIG")
+    parser.add_argument("--batch-size", type=int, default=500, help="Keys per SCAN batch")
+    parser.add_argument("--dry-run", action="store_true", help="Count the records to convert; write nothing")
+    args = parser.parse_args()
+
+    if args.redis_url:
+        redis_client = redis.StrictRedis.from_url(args.redis_url, decode_responses=True)
+    else:
+        redis_client = create_redis_client(
+            import_string(config[os.getenv('FLASK_CONFIGURATION', 'default')]).REDIS_CONFIG)
+    counts = Registry(redis_client).migrate_records(batch_size=args.batch_size, dry_run=args.dry_run)
+    print(f"{'would migrate' if args.dry_run else 'migrated'} {counts['migrated']} record(s), "
+          f"skipped {counts['skipped']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+
+import pytest
+
+# Tests import the application the way the app and benchmarks do, from src
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+AUTH = {"Authorization": "Bearer good"}
+
+def wait_until(predicate, timeout=5.0, interval=0.01):
+    """Poll predicate() until it is true; fail the test after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            pytest.fail("condition not met in time")
+        time.sleep(interval)
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def redis_client(redis_server):
+    return fakeredis.FakeStrictRedis(server=redis_server, decode_responses=True)
+
+@pytest.fixture(scope="session")
+def stub_broker():
+    """URL of a stub Pinot broker (benchmarks.stub_broker) shared by the session."""
+    from benchmarks import harness
+    process, url = harness.start_stub_broker(5, 3)
+    yield url
+    process.terminate()
+    process.wait()
+
+@pytest.fixture
+def broker(stub_broker):
+    """The stub broker, with the settings a test changed restored afterwards."""
+    yield stub_broker
+    import httpx
+    httpx.post(f"{stub_broker}/_stub/config", json={"latency_ms": 5, "jitter_ms": 0, "fail_rate": 0, "down": False})
+
+def broker_stats(url):
+    """Settings and counters of the stub broker."""
+    import httpx
+    return httpx.post(f"{url}/_stub/config", json={}).json()
+
+@pytest.fixture
+def app_config(monkeypatch, tmp_path, broker):
+    """Patch the app configuration for create_app(); returns a setter for more settings."""
+    import config
+    # The app logs to ../logs relative to its working directory
+    (tmp_path / "logs").mkdir()
+    (tmp_path / "run").mkdir()
+    monkeypatch.chdir(tmp_path / "run")
+    monkeypatch.setattr(config.BaseConfig, "PINOT_CONFIG", {"broker": broker})
+    monkeypatch.setattr(config.BaseConfig, "PINOT_CLIENT_CONFIG",
+                        dict(config.BaseConfig.PINOT_CLIENT_CONFIG, probe_interval=0))
+
+    def update(name, **settings):
+        monkeypatch.setattr(config.BaseConfig, name, dict(getattr(config.BaseConfig, name), **settings))
+    return update
+
+@pytest.fixture
+def create_app(app_config, monkeypatch, redis_server):
+    """Factory for apps on the fake Redis, for tests that change the configuration first."""
+    import application
+    monkeypatch.setattr(application, "create_redis_client",
+                        lambda config: fakeredis.FakeStrictRedis(server=redis_server, decode_responses=True))
+    apps = []
+
+    def create():
+        apps.append(application.create_app())
+        return apps[-1]
+    yield create
+    for flask_app in apps:
+        flask_app.extensions['batch_executor'].shutdown(wait=False)
+
+@pytest.fixture
+def app(create_app):
+    return create_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
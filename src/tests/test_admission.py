@@ -0,0 +1,147 @@
+import asyncio
+import threading
+
+import pytest
+
+from application.modules.admission import API_RATE, TOKEN_RATE, ConcurrencyLimiter, RateLimiter
+from application.modules.aio import AsyncConcurrencyLimiter, AsyncRateLimiter
+from conftest import AUTH
+
+SQL = "SELECT * FROM t WHERE id = %id%"
+PARAMETERS = {"id": {"type": "long", "default": 1}}
+
+# Rate limits
+
+def test_token_bucket_admits_its_burst(redis_client):
+    limiter = RateLimiter(redis_client, token_rate=1, token_burst=3)
+    assert [limiter.check("token") for _ in range(3)] == [None, None, None]
+    assert limiter.check("token") == (TOKEN_RATE, 1)
+    # Tokens have buckets of their own
+    assert limiter.check("other") is None
+
+def test_api_bucket_is_shared_by_tokens(redis_client):
+    limiter = RateLimiter(redis_client, token_rate=100, token_burst=100, api_rate=1, api_burst=2)
+    assert limiter.check("a", ["orders"]) is None
+    assert limiter.check("b", ["orders"]) is None
+    assert limiter.check("c", ["orders"]) == (API_RATE, 1)
+    assert limiter.check("c", ["customers"]) is None
+    # Queries of no saved API only count against the token
+    assert limiter.check("c", [None]) is None
+
+def test_api_limits_override_the_default(redis_client):
+    limiter = RateLimiter(redis_client, token_rate=0, api_rate=1, api_burst=1, api_limits={"orders": (1, 3)})
+    assert [limiter.check("a", ["orders"]) for _ in range(4)] == [None, None, None, (API_RATE, 1)]
+
+def test_rejected_request_takes_nothing(redis_client):
+    limiter = RateLimiter(redis_client, token_rate=1, token_burst=2, api_rate=1, api_burst=1)
+    assert limiter.check("token", ["orders"]) is None
+    # The API bucket is empty, so the token keeps its remaining request
+    assert limiter.check("token", ["orders"]) == (API_RATE, 1)
+    assert limiter.check("token", ["customers"]) is None
+
+def test_batch_costs_one_request_per_query(redis_client):
+    limiter = RateLimiter(redis_client, token_rate=1, token_burst=5, api_rate=1, api_burst=3)
+    buckets = limiter.buckets("token", ["orders", "orders", "customers", None])
+    assert [(bucket[3], bucket[4]) for bucket in buckets] == [(4, TOKEN_RATE), (1, API_RATE), (2, API_RATE)]
+    assert limiter.check("token", ["orders", "orders", "orders"]) is None
+    assert limiter.check("token", ["orders"]) == (API_RATE, 1)
+    # A batch larger than a bucket's burst can still be admitted once the bucket is full
+    assert limiter.check("other", ["customers"] * 4) is None
+
+def test_unreachable_redis_admits(redis_client, monkeypatch):
+    limiter = RateLimiter(redis_client, token_rate=1, token_burst=1)
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("Redis is down")
+    monkeypatch.setattr(limiter, "_check", fail)
+    assert limiter.check("token") is None
+
+def test_async_rate_limiter_shares_the_buckets(redis_server, redis_client):
+    import fakeredis
+    limiter = RateLimiter(redis_client, token_rate=1, token_burst=2)
+    assert limiter.check("token") is None
+
+    async def check():
+        async_client = fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
+        async_limiter = AsyncRateLimiter(limiter, async_client)
+        return [await async_limiter.check("token"), await async_limiter.check("token")]
+    assert asyncio.run(check()) == [None, (TOKEN_RATE, 1)]
+
+def test_rate_limited_batch_is_rejected(app_config, create_app):
+    app_config("ADMISSION_CONFIG", token_rate=1, token_burst=100, api_rate=1, api_burst=2)
+    client = create_app().test_client()
+    assert client.post("/v1/create/", headers=AUTH, json={"name": "orders", "sql": SQL,
+                                                          "parameters": PARAMETERS}).status_code == 200
+    batch = {"queries": [{"name": "orders"}, {"name": "orders"}]}
+    assert client.post("/v1/execute/batch", headers=AUTH, json=batch).status_code == 200
+    response = client.post("/v1/execute/batch", headers=AUTH, json=batch)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert response.get_json()["success"] is False
+
+# Concurrency
+
+def test_concurrency_limiter_rejects_when_the_queue_is_full():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=0, queue_timeout=1)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+
+def test_concurrency_limiter_waits_for_a_slot():
+    limiter = ConcurrencyLimiter(max_concurrent=2, max_queue=1, queue_timeout=5)
+    assert limiter.acquire(2)
+    threading.Timer(0.05, limiter.release, args=(2,)).start()
+    assert limiter.acquire()
+    assert limiter.active == 1
+
+def test_concurrency_limiter_times_out():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.waiting == 0
+
+def test_batch_slots_are_capped():
+    limiter = ConcurrencyLimiter(max_concurrent=4, max_queue=0)
+    assert limiter.acquire(10)
+    assert limiter.active == 4
+    limiter.release(10)
+    assert limiter.active == 0
+
+def test_async_concurrency_limiter():
+    async def run():
+        limiter = AsyncConcurrencyLimiter(max_concurrent=2, max_queue=2, queue_timeout=5)
+        assert await limiter.acquire(2)
+        # Waiters are served in arrival order
+        first = asyncio.ensure_future(limiter.acquire(2))
+        second = asyncio.ensure_future(limiter.acquire(1))
+        await asyncio.sleep(0)
+        assert limiter.waiting == 2
+        assert not await limiter.acquire(1)
+        limiter.release(2)
+        assert await first
+        assert not second.done()
+        limiter.release(2)
+        assert await second
+        assert limiter.active == 1
+
+        limiter.queue_timeout = 0.05
+        assert await limiter.acquire(1)
+        assert not await limiter.acquire(1)
+        assert limiter.waiting == 0 and limiter.active == 2
+    asyncio.run(run())
+
+@pytest.mark.parametrize("slots", [1, 3])
+def test_async_concurrency_limiter_cancelled_waiter(slots):
+    async def run():
+        limiter = AsyncConcurrencyLimiter(max_concurrent=3, max_queue=2, queue_timeout=5)
+        assert await limiter.acquire(3)
+        waiter = asyncio.ensure_future(limiter.acquire(slots))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.waiting == 0
+        limiter.release(3)
+        assert limiter.active == 0
+    asyncio.run(run())
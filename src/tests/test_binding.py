@@ -0,0 +1,128 @@
+import pytest
+
+from application.modules.binding import BindingError, canonicalize_sql, get_binder, split_placeholders
+from application.modules.sqltemplate import compile_template
+from application.modules.utils import validate_sql_and_parameters
+
+def bind(param_type, value, **spec):
+    return get_binder(param_type)("p", value, dict(spec, type=param_type))
+
+def test_string_quotes_are_doubled():
+    assert bind("string", "o'brien") == "'o''brien'"
+    assert bind("string", "'; DROP TABLE t; --") == "'''; DROP TABLE t; --'"
+
+def test_string_rejects_nul_and_non_scalars():
+    with pytest.raises(BindingError):
+        bind("string", "a\x00b")
+    with pytest.raises(BindingError):
+        bind("string", {"a": 1})
+
+def test_column_is_quoted_identifier():
+    assert bind("column", "fname") == '"fname"'
+    assert bind("column", 'we"ird', allowed=['we"ird']) == '"we""ird"'
+
+@pytest.mark.parametrize("value", ["fname; DROP TABLE t", "a b", "1col", "x'--", ""])
+def test_identifiers_without_allowlist_must_be_plain(value):
+    with pytest.raises(BindingError):
+        bind("column", value)
+    with pytest.raises(BindingError):
+        bind("table", value)
+
+def test_identifier_allowlist():
+    assert bind("table", "db.events", allowed=["db.events"]) == "db.events"
+    with pytest.raises(BindingError):
+        bind("column", "lname", allowed=["fname"])
+
+def test_string_allowlist():
+    assert bind("string", "US", allowed=["US", "CA"]) == "'US'"
+    with pytest.raises(BindingError):
+        bind("string", "FR", allowed=["US", "CA"])
+
+def test_integer_accepts_64_bit_values():
+    # Saved APIs bind epoch milliseconds as integer
+    assert bind("integer", 1700000000000) == "1700000000000"
+    assert bind("integer", "-42") == "-42"
+    assert bind("integer", 2 ** 63 - 1) == str(2 ** 63 - 1)
+    with pytest.raises(BindingError):
+        bind("integer", 2 ** 63)
+
+@pytest.mark.parametrize("value", [True, 1.5, "1 OR 1=1", None, [1]])
+def test_integer_rejects_non_integers(value):
+    with pytest.raises(BindingError):
+        bind("integer", value)
+
+def test_double_bool_and_timestamp():
+    assert bind("double", "2.5") == "2.5"
+    with pytest.raises(BindingError):
+        bind("double", float("nan"))
+    assert bind("bool", "true") == "TRUE"
+    assert bind("bool", 0) == "FALSE"
+    assert bind("timestamp", "2024-01-01T00:00:00") == "1704067200000"
+    assert bind("timestamp", "2024-01-01T01:00:00+01:00") == "1704067200000"
+
+def test_lists_are_deduplicated_and_sorted():
+    assert bind("integer_list", [3, 1, 3, 2]) == "1, 2, 3"
+    assert bind("string_list", ["b", "a", "b", "o'k"]) == "'a', 'b', 'o''k'"
+    # Mixed values go through the element binder one by one
+    assert bind("integer_list", [2, "1", 2.0]) == "1, 2"
+
+def test_lists_report_invalid_values():
+    with pytest.raises(BindingError):
+        bind("integer_list", [1, 2 ** 64])
+    with pytest.raises(BindingError):
+        bind("string_list", [])
+    with pytest.raises(BindingError):
+        bind("string_list", "a")
+
+def test_canonicalize_keeps_literals():
+    assert canonicalize_sql("SELECT  a -- c\nFROM t /* x */ WHERE b = 'a  --b';") == "SELECT a FROM t WHERE b = 'a  --b'"
+
+def template(version="v1"):
+    parameters = {"ids": {"type": "integer_list", "default": [1]}, "c": {"type": "column", "default": "fname"}}
+    return compile_template("SELECT %c% FROM t WHERE id IN (%ids%)", parameters, version=version, name="api")
+
+def test_fingerprint_is_stable():
+    bound = template().bind({"ids": [3, 1, 2, 1]})
+    assert bound.sql == 'SELECT "fname" FROM t WHERE id IN (1, 2, 3)'
+    # Equal values in another order, or spelled as defaults, share a fingerprint
+    assert template().bind({"ids": [1, 2, 3], "c": "fname"}).fingerprint == bound.fingerprint
+    assert template().bind({"ids": [1, 2]}).fingerprint != bound.fingerprint
+    assert template("v2").bind({"ids": [3, 1, 2]}).fingerprint != bound.fingerprint
+
+def test_fingerprint_separates_parameters():
+    parameters = {"a": {"type": "string", "default": "x"}, "b": {"type": "string", "default": "y"}}
+    compiled = compile_template("SELECT %a%, %b%", parameters, version="v1")
+    assert compiled.bind({"a": "x", "b": "y"}).fingerprint != compiled.bind({"a": "y", "b": "x"}).fingerprint
+
+def test_bind_chunks_splits_one_list():
+    chunks = template().bind_chunks({"ids": list(range(5))}, chunk_size=2)
+    assert [chunk.sql.split("IN ")[1] for chunk in chunks] == ["(0, 1)", "(2, 3)", "(4)"]
+    assert len({chunk.fingerprint for chunk in chunks}) == 3
+
+HOSTILE = "' OR 1=1 --"
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM t WHERE a = 'x%p%' AND b = 1",
+    'SELECT "%p%" FROM t',
+])
+def test_placeholder_inside_quotes_is_rejected(sql):
+    parameters = {"p": {"type": "string", "default": "x"}}
+    with pytest.raises(ValueError, match="inside quotes"):
+        validate_sql_and_parameters(sql, parameters)
+    with pytest.raises(ValueError, match="inside quotes"):
+        compile_template(sql, parameters).render({"p": HOSTILE})
+
+def test_quoted_percent_text_is_not_a_placeholder():
+    parameters = {"p": {"type": "string", "default": "x"}}
+    sql = "SELECT * FROM t WHERE a LIKE '%abc%' AND b = %p%"
+    validate_sql_and_parameters(sql, parameters)
+    assert compile_template(sql, parameters).render({"p": HOSTILE}) == \
+        "SELECT * FROM t WHERE a LIKE '%abc%' AND b = ''' OR 1=1 --'"
+
+def test_unterminated_quote_is_rejected():
+    with pytest.raises(ValueError, match="unterminated"):
+        validate_sql_and_parameters("SELECT * FROM t WHERE a = 'x AND b = %p%", {"p": {"type": "string", "default": "x"}})
+
+def test_split_placeholders():
+    assert split_placeholders("a = %p% AND b = 'it''s %q%' AND c IN (%p%)") == \
+        (("a = ", " AND b = 'it''s %q%' AND c IN (", ")"), ("p", "p"))
@@ -0,0 +1,171 @@
+import asyncio
+import time
+
+import pytest
+
+from application.modules.registry import Registry
+from application.modules.resultcache import HIT, MISS, STALE, ResultCache
+from application.modules.serialization import dumps
+from application.modules.sqltemplate import TemplateCache
+from conftest import AUTH, broker_stats, wait_until
+
+SQL = "SELECT * FROM t WHERE id = %id%"
+PARAMETERS = {"id": {"type": "long", "default": 1}}
+
+@pytest.fixture
+def registry(redis_client):
+    return Registry(redis_client)
+
+def listening_cache(registry):
+    template_cache = TemplateCache(registry)
+    template_cache.ensure_listener()
+    wait_until(lambda: template_cache._listening)
+    return template_cache
+
+def loader(data):
+    return lambda: (data, dumps(data))
+
+# Template cache
+
+def test_name_lookups_are_cached_only_while_listening(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    template_cache = TemplateCache(registry)
+    version, record = registry.resolve_latest("orders")
+    # Not subscribed yet, so an update could be missed
+    template_cache.add(version, record, name="orders", generation=template_cache.generation)
+    assert template_cache._latest == {}
+    template_cache.ensure_listener()
+    wait_until(lambda: template_cache._listening)
+    template_cache.add(version, record, name="orders", generation=template_cache.generation)
+    assert template_cache.lookup_by_name("orders").version == "v1"
+
+def test_update_in_another_worker_invalidates_name(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    worker, other = listening_cache(registry), listening_cache(registry)
+    assert worker.get_by_name("orders").version == "v1"
+    assert worker.lookup_by_name("orders").version == "v1"
+
+    registry.update("orders", "v2", "SELECT 2", {})
+    other.publish_change("orders")
+    wait_until(lambda: worker.lookup_by_name("orders") is None)
+    assert worker.get_by_name("orders").version == "v2"
+
+def test_deleted_versions_are_dropped(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    registry.update("orders", "v2", SQL, PARAMETERS)
+    worker, other = listening_cache(registry), listening_cache(registry)
+    worker.get_by_version("v2")
+    assert worker.lookup_by_version("v2") is not None
+
+    registry.delete_by_version("v2")
+    other.publish_change("orders", ["v2"])
+    wait_until(lambda: worker.lookup_by_version("v2") is None)
+    assert worker.get_by_name("orders").version == "v1"
+
+def test_invalidation_during_lookup_is_not_cached(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    template_cache = listening_cache(registry)
+    generation = template_cache.generation
+    version, record = registry.resolve_latest("orders")
+    template_cache.invalidate("orders")
+    template_cache.add(version, record, name="orders", generation=generation)
+    assert template_cache.lookup_by_name("orders") is None
+
+def test_get_many(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    template_cache = listening_cache(registry)
+    templates = template_cache.get_many([("name", "orders"), ("version", "v1"), ("name", "missing")])
+    assert templates[0].version == templates[1].version == "v1"
+    assert isinstance(templates[2], ValueError)
+
+# Result cache
+
+def test_result_cache_miss_then_hit():
+    cache = ResultCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return {"rows": [1]}, dumps({"rows": [1]})
+    assert cache.get_or_load("key", load, ttl=60) == ({"rows": [1]}, MISS)
+    assert cache.get_or_load("key", load, ttl=60) == ({"rows": [1]}, HIT)
+    assert len(calls) == 1
+
+def test_uncacheable_results_are_not_stored():
+    cache = ResultCache()
+    cache.get_or_load("key", lambda: ({"exceptions": [1]}, None), ttl=60)
+    assert cache.get("key") == (None, MISS)
+
+def test_shared_tier_is_read_by_other_workers(redis_client):
+    worker, other = ResultCache(redis_client), ResultCache(redis_client)
+    worker.get_or_load("key", loader({"rows": [1]}), ttl=60)
+    assert other.get_local("key") == (None, MISS)
+    assert other.get_or_load("key", loader({"rows": [2]}), ttl=60) == ({"rows": [1]}, HIT)
+    # Copied into the reader's local tier
+    assert other.get_local("key") == ({"rows": [1]}, HIT)
+
+def test_stale_entries_are_served_while_refreshed():
+    cache = ResultCache()
+    cache.set("key", {"rows": [1]}, ttl=0, stale_ttl=60)
+    assert cache.get_or_load("key", loader({"rows": [2]}), ttl=60, stale_ttl=60) == ({"rows": [1]}, STALE)
+    wait_until(lambda: cache.get_local("key") == ({"rows": [2]}, HIT))
+
+def test_expired_entries_are_dropped():
+    cache = ResultCache()
+    cache.set("key", {"rows": [1]}, ttl=0)
+    time.sleep(0.01)
+    assert cache.get("key") == (None, MISS)
+
+def test_local_tier_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2)
+    for key in ("a", "b"):
+        cache.set(key, {"key": key}, ttl=60)
+    cache.get("a")
+    cache.set("c", {"key": "c"}, ttl=60)
+    assert cache.get("b") == (None, MISS)
+    assert cache.get("a")[1] == cache.get("c")[1] == HIT
+
+def test_make_key_separates_scopes():
+    assert ResultCache.make_key("v1", "SELECT 1", "a") != ResultCache.make_key("v1", "SELECT 1", "b")
+    assert ResultCache.make_key("v1", "SELECT 1 ", "a") == ResultCache.make_key("v1", "SELECT 1", "a")
+
+# Saved APIs
+
+def test_update_bypasses_cached_results(client, broker):
+    response = client.post("/v1/create/", headers=AUTH, json={
+        "name": "cached", "sql": SQL, "parameters": PARAMETERS, "cache": {"ttl": 60}})
+    assert response.status_code == 200
+    queries = broker_stats(broker)["queries"]
+
+    assert client.post("/v1/execute/api/cached", headers=AUTH, json={}).headers["X-Cache"] == MISS
+    assert client.post("/v1/execute/api/cached", headers=AUTH, json={}).headers["X-Cache"] == HIT
+    assert broker_stats(broker)["queries"] == queries + 1
+
+    response = client.post("/v1/update/cached", headers=AUTH, json={
+        "sql": "SELECT * FROM t WHERE id = %id% LIMIT 5", "parameters": PARAMETERS, "cache": {"ttl": 60}})
+    assert response.status_code == 200
+    assert client.post("/v1/execute/api/cached", headers=AUTH, json={}).headers["X-Cache"] == MISS
+    assert broker_stats(broker)["queries"] == queries + 2
+
+def test_asgi_cache_falls_back_when_redis_fails(app, client, redis_server, monkeypatch):
+    import fakeredis
+    import httpx
+    from application import asgi
+    assert client.post("/v1/create/", headers=AUTH, json={
+        "name": "cached", "sql": SQL, "parameters": PARAMETERS, "cache": {"ttl": 60}}).status_code == 200
+    monkeypatch.setattr(asgi.aioredis, "StrictRedis",
+                        lambda **config: fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True))
+    gateway = asgi.AsyncGateway(app)
+
+    async def fail(*args, **kwargs):
+        raise ConnectionError("Redis is down")
+    monkeypatch.setattr(gateway.redis_client, "get", fail)
+    monkeypatch.setattr(gateway.redis_client, "set", fail)
+
+    async def execute():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway), base_url="http://test") as http:
+            return [await http.post("/v1/execute/api/cached", headers=AUTH, json={}) for _ in range(2)]
+    first, second = asyncio.run(execute())
+    assert (first.status_code, first.headers["X-Cache"]) == (200, MISS)
+    # Still cached in the worker
+    assert (second.status_code, second.headers["X-Cache"]) == (200, HIT)
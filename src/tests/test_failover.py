@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import socket
+
+import httpx
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from application.modules.aio import AsyncPinotClient
+from application.modules.brokers import OPEN, BrokerPool, BrokerUnavailable
+from application.modules.deadlines import DeadlineExceeded, start_deadline
+from application.modules.pinot import PinotClient
+from conftest import broker_stats
+
+DOWN = "http://down.invalid"
+
+class FakeBroker(BaseAdapter):
+    """requests adapter for a broker that times out connecting, or answers every request with one status."""
+
+    def __init__(self, status=None):
+        super(FakeBroker, self).__init__()
+        self.status = status
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(kwargs.get("timeout"))
+        if self.status is None:
+            raise requests.ConnectTimeout("connect timed out", request=request)
+        response = requests.Response()
+        response.status_code, response._content, response.request = self.status, b"{}", request
+        return response
+
+    def close(self):
+        pass
+
+def refused_url():
+    """URL of a local port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def pinot_client(urls, fake=None, **client_config):
+    """A client whose first pick is urls[0]: the other brokers look busy."""
+    client = PinotClient({"brokers": urls}, dict({"max_failovers": 2}, **client_config),
+                         broker_pool=BrokerPool(urls, failure_threshold=2, probe_interval=0))
+    for broker in client.broker_pool.brokers[1:]:
+        broker.outstanding = 1
+    if fake is not None:
+        client.session.mount(DOWN, fake)
+    return client
+
+def describe(client, url):
+    return next(broker for broker in client.broker_pool.describe()["brokers"] if broker["url"] == url)
+
+def query(client):
+    return client.query("SELECT 1", "good")
+
+def with_deadline(seconds, func, *args):
+    """Call func under a request deadline of seconds, leaving the caller's context alone."""
+    def run():
+        start_deadline(default_timeout=seconds)
+        return func(*args)
+    return contextvars.copy_context().run(run)
+
+# Sync client
+
+def test_refused_connection_fails_over(broker):
+    down = refused_url()
+    client = pinot_client([down, broker])
+    queries = broker_stats(broker)["queries"]
+    assert query(client).status_code == 200
+    assert broker_stats(broker)["queries"] == queries + 1
+    assert describe(client, down)["errors"] == 1
+
+def test_connect_timeout_fails_over(broker):
+    fake = FakeBroker()
+    client = pinot_client([DOWN, broker], fake)
+    assert query(client).status_code == 200
+    assert len(fake.requests) == 1
+    assert describe(client, DOWN)["consecutive_failures"] == 1
+
+def test_connect_timeout_on_every_broker_is_raised():
+    fake = FakeBroker()
+    client = pinot_client([DOWN], fake, max_failovers=0)
+    with pytest.raises(requests.ConnectTimeout):
+        query(client)
+
+def test_connect_timeout_cut_by_the_deadline_is_not_a_broker_failure(broker):
+    fake = FakeBroker()
+    client = pinot_client([DOWN, broker], fake)
+    with pytest.raises(DeadlineExceeded):
+        with_deadline(0.5, query, client)
+    # The connect timeout was cut to the time left
+    assert fake.requests[0][0] <= 0.5
+    assert describe(client, DOWN)["consecutive_failures"] == 0
+
+def test_unavailable_status_fails_over_and_opens_the_breaker(broker):
+    fake = FakeBroker(503)
+    client = pinot_client([DOWN, broker], fake)
+    for _ in range(2):
+        client.broker_pool.brokers[1].outstanding = 1
+        assert query(client).status_code == 200
+    assert describe(client, DOWN)["state"] == OPEN
+    assert len(fake.requests) == 2
+    # An open breaker ejects the broker
+    client.broker_pool.brokers[1].outstanding = 1
+    assert query(client).status_code == 200
+    assert len(fake.requests) == 2
+
+def test_server_error_is_returned_without_failover(broker):
+    fake = FakeBroker(500)
+    client = pinot_client([DOWN, broker], fake)
+    queries = broker_stats(broker)["queries"]
+    assert query(client).status_code == 500
+    assert broker_stats(broker)["queries"] == queries
+    # A query Pinot could not run says nothing about the broker
+    assert describe(client, DOWN)["consecutive_failures"] == 0
+
+def test_last_failed_response_is_returned():
+    client = pinot_client([DOWN], FakeBroker(503), max_failovers=1)
+    assert query(client).status_code == 503
+
+def test_every_broker_ejected(broker):
+    client = pinot_client([DOWN], FakeBroker())
+    client.broker_pool.brokers[0].state = OPEN
+    client.broker_pool.brokers[0].opened_at = float("inf")
+    with pytest.raises(requests.ConnectionError):
+        query(client)
+    with pytest.raises(BrokerUnavailable):
+        client.broker_pool.acquire()
+
+def test_health_probe_marks_brokers(broker):
+    down = refused_url()
+    pool = BrokerPool([down, broker], probe_interval=0, probe_timeout=1)
+    pool.probe()
+    assert [entry["healthy"] for entry in pool.describe()["brokers"]] == [False, True]
+    # Unhealthy brokers are skipped while another one is up
+    assert all(pool.acquire().url == broker for _ in range(3))
+
+# Async client
+
+def async_client(urls, handler):
+    client = AsyncPinotClient({"brokers": urls}, {"max_failovers": 2},
+                              broker_pool=BrokerPool(urls, failure_threshold=2, probe_interval=0))
+    for broker in client.broker_pool.brokers[1:]:
+        broker.outstanding = 1
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+def async_query(client, timeout=None):
+    async def run():
+        if timeout is not None:
+            start_deadline(default_timeout=timeout)
+        try:
+            return await client.send("POST", "/query/sql", json={"sql": "SELECT 1"})
+        finally:
+            await client.client.aclose()
+    return asyncio.run(run())
+
+def fake_brokers(requested):
+    def handler(request):
+        requested.append((request.url.host, request.extensions["timeout"]["connect"]))
+        if request.url.host == "down.invalid":
+            raise httpx.ConnectTimeout("connect timed out", request=request)
+        return httpx.Response(200, json={})
+    return handler
+
+def test_async_connect_timeout_fails_over():
+    requested = []
+    client = async_client([DOWN, "http://up.invalid"], fake_brokers(requested))
+    assert async_query(client).status_code == 200
+    assert [host for host, _ in requested] == ["down.invalid", "up.invalid"]
+    assert describe(client, DOWN)["consecutive_failures"] == 1
+
+def test_async_connect_timeout_cut_by_the_deadline():
+    requested = []
+    client = async_client([DOWN, "http://up.invalid"], fake_brokers(requested))
+    with pytest.raises(DeadlineExceeded):
+        async_query(client, timeout=0.5)
+    assert requested[0][1] <= 0.5
+    assert describe(client, DOWN)["consecutive_failures"] == 0
@@ -0,0 +1,18 @@
+import logging
+
+from application.modules.logs import DroppingQueueHandler
+
+def queue_handlers():
+    return [handler for handler in logging.getLogger().handlers if isinstance(handler, DroppingQueueHandler)]
+
+def test_new_app_replaces_the_logging_handler(create_app):
+    first = create_app().extensions['logging']
+    second = create_app().extensions['logging']
+    assert queue_handlers() == [second.handler]
+    assert first.closed and first.listener._thread is None
+    assert second.listener._thread.is_alive()
+
+    logging.getLogger("tests").warning("written once")
+    second.stop()
+    with open(second.target.baseFilename) as log_file:
+        assert log_file.read().count("written once") == 1
@@ -0,0 +1,23 @@
+import threading
+
+from application.modules.metrics import REQUEST_SECONDS, REQUESTS_TOTAL, Metrics
+
+LABELS = ("query", "POST", "200")
+
+def record(metrics):
+    metrics.inc(REQUESTS_TOTAL, LABELS)
+    metrics.observe(REQUEST_SECONDS, 0.01, LABELS[:2])
+
+def test_finished_threads_are_folded_into_the_totals():
+    metrics = Metrics()
+    for _ in range(20):
+        thread = threading.Thread(target=record, args=(metrics,))
+        thread.start()
+        thread.join()
+    record(metrics)
+    # Only this thread still has a shard
+    assert len(metrics._shards) == 1
+    totals = metrics.collect()
+    assert totals[(REQUESTS_TOTAL, LABELS)] == 21
+    assert totals[(REQUEST_SECONDS, LABELS[:2])][-1] == 21
+    assert 'query_wrapper_requests_total{endpoint="query",method="POST",status="200"} 21' in metrics.render()
@@ -0,0 +1,67 @@
+import pytest
+
+from application.modules.pagination import CursorCodec, PageCursor, ResultStore, parse_page_request, window_sql
+
+CURSOR = PageCursor(1, "abc", 20, 10, None, False, True)
+
+def test_cursor_round_trip():
+    codec = CursorCodec("secret")
+    assert codec.decode(codec.encode(CURSOR)) == CURSOR
+
+@pytest.mark.parametrize("token", ["", "nodot", "!!!.!!!", "e30.AAAA"])
+def test_malformed_cursors_are_rejected(token):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        CursorCodec("secret").decode(token)
+
+def test_tampered_cursor_is_rejected():
+    codec = CursorCodec("secret")
+    forged = CursorCodec("secret").encode(CURSOR._replace(offset=1000))
+    payload, signature = codec.encode(CURSOR).split(".")
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        codec.decode(f"{forged.split('.')[0]}.{signature}")
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        codec.decode(f"{payload}x.{signature}")
+
+def test_cursor_signed_with_another_secret_is_rejected():
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        CursorCodec("secret").decode(CursorCodec("other").encode(CURSOR))
+
+def test_parse_page_request():
+    codec = CursorCodec("secret")
+    assert parse_page_request({}, codec, 100) is None
+    assert parse_page_request({"page_size": "5", "store": "true"}, codec, 100) == (5, None, True)
+    # The page size defaults to the cursor's
+    assert parse_page_request({"cursor": codec.encode(CURSOR)}, codec, 100) == (10, CURSOR, False)
+
+@pytest.mark.parametrize("args, error", [
+    ({"store": "1"}, "'store' requires 'page_size'"),
+    ({"page_size": "x"}, "must be an integer"),
+    ({"page_size": "0"}, "between 1 and 100"),
+    ({"page_size": "101"}, "between 1 and 100"),
+    ({"cursor": "bad"}, "Invalid cursor"),
+])
+def test_parse_page_request_errors(args, error):
+    with pytest.raises(ValueError, match=error):
+        parse_page_request(args, CursorCodec("secret"), 100)
+
+@pytest.mark.parametrize("sql, offset, count, expected", [
+    ("SELECT a FROM t", 20, 10, ("SELECT a FROM t\nLIMIT 10 OFFSET 20", 10)),
+    ("SELECT a FROM t;", 0, 10, ("SELECT a FROM t\nLIMIT 10 OFFSET 0", 10)),
+    ("SELECT a FROM t LIMIT 25", 20, 10, ("SELECT a FROM t\nLIMIT 5 OFFSET 20", 5)),
+    ("SELECT a FROM t LIMIT 5, 25", 20, 10, ("SELECT a FROM t\nLIMIT 5 OFFSET 25", 5)),
+    ("SELECT a FROM t LIMIT 10 OFFSET 3", 30, 10, ("SELECT a FROM t\nLIMIT 0 OFFSET 33", 0)),
+    ("SELECT a FROM t -- note", 0, 10, ("SELECT a FROM t -- note\nLIMIT 10 OFFSET 0", 10)),
+])
+def test_window_sql(sql, offset, count, expected):
+    assert window_sql(sql, offset, count) == expected
+
+def test_result_store_pages(redis_client):
+    store = ResultStore(redis_client, batch_size=3)
+    response = {"resultTable": {"dataSchema": {"columnNames": ["a"]}, "rows": [[i] for i in range(10)]},
+                "numDocsScanned": 10}
+    store_id = store.save("scope", response, response["resultTable"]["rows"])
+    metadata, rows = store.read("scope", store_id, 4, 3)
+    assert rows == [[4], [5], [6]]
+    assert metadata == {"resultTable": {"dataSchema": {"columnNames": ["a"]}}, "numDocsScanned": 10}
+    # Results are scoped by caller
+    assert store.read("other", store_id, 0, 3) is None
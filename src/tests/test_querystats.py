@@ -0,0 +1,30 @@
+from application.modules.querystats import QueryStats
+
+SQL = "SELECT * FROM orders WHERE customer = 'alice@example.com' AND id IN (1, 2, 3) LIMIT 10"
+RESPONSE = {"timeUsedMs": 1500, "numDocsScanned": 10, "exceptions": []}
+
+def slow_entry(redis_client, **options):
+    stats = QueryStats(redis_client, slow_query_ms=1000, flush_interval=3600, **options)
+    stats.record("orders", "v1", RESPONSE, SQL, "fingerprint")
+    stats.flush()
+    return stats.slow_queries()[0]
+
+def test_slow_log_holds_no_caller_values(redis_client):
+    entry = slow_entry(redis_client)
+    assert (entry["api"], entry["version"], entry["fingerprint"]) == ("orders", "v1", "fingerprint")
+    assert entry["sql"] == "SELECT * FROM orders WHERE customer = ? AND id IN (?, ...) LIMIT ?"
+    assert len(entry["sql_hash"]) == 16
+    assert "raw_sql" not in entry
+    assert "alice" not in str(redis_client.lrange("qstats:slow", 0, -1))
+
+def test_raw_sql_is_opt_in(redis_client):
+    entry = slow_entry(redis_client, log_raw_sql=True)
+    assert entry["raw_sql"] == SQL
+    assert entry["sql_hash"] == slow_entry(redis_client)["sql_hash"]
+
+def test_fast_queries_are_not_logged(redis_client):
+    stats = QueryStats(redis_client, slow_query_ms=1000, flush_interval=3600)
+    stats.record("orders", "v1", dict(RESPONSE, timeUsedMs=10), SQL)
+    stats.flush()
+    assert stats.slow_queries() == []
+    assert stats.summary(api="orders")[0]["count"] == 1
@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+from application.modules.registry import Registry, RegistryError, SCHEMA_VERSION
+
+SQL = "SELECT * FROM t WHERE id = %id%"
+PARAMETERS = {"id": {"type": "long", "default": 1}}
+
+@pytest.fixture
+def registry(redis_client):
+    return Registry(redis_client)
+
+def write_legacy(redis_client, name, versions):
+    """Store a name the way schema 1 did: JSON string records with "active" as their last key."""
+    for index, version in enumerate(versions):
+        record = {"name": name, "sql": SQL, "parameters": PARAMETERS, "active": index == 0}
+        redis_client.set(version, json.dumps(record))
+    redis_client.rpush(name, *versions)
+
+def test_create_and_resolve(registry, redis_client):
+    registry.create("orders", "v1", SQL, PARAMETERS, {"cache": {"ttl": 10}, "timeout": 5})
+    version, record = registry.resolve_latest("orders")
+    assert version == "v1"
+    assert record == {"name": "orders", "sql": SQL, "parameters": PARAMETERS, "cache": {"ttl": 10}, "timeout": 5,
+                      "active": True}
+    assert redis_client.type("v1") == "hash"
+    assert redis_client.hget("v1", "schema") == str(SCHEMA_VERSION)
+    assert registry.get_version("v1") == record
+
+def test_create_existing_name(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    with pytest.raises(RegistryError) as error:
+        registry.create("orders", "v2", SQL, PARAMETERS)
+    assert error.value.status_code == 409
+    with pytest.raises(RegistryError):
+        registry.get_version("v2")
+
+def test_update_deactivates_previous(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    assert registry.update("orders", "v2", "SELECT 2", {}) == "v1"
+    assert registry.resolve_latest("orders")[0] == "v2"
+    assert registry.get_version("v1")["active"] is False
+    assert registry.get_version("v2")["active"] is True
+
+def test_update_unknown_name(registry):
+    with pytest.raises(RegistryError) as error:
+        registry.update("missing", "v1", SQL, PARAMETERS)
+    assert error.value.status_code == 404
+
+def test_delete_active_version_activates_next(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    registry.update("orders", "v2", SQL, PARAMETERS)
+    assert registry.delete_by_version("v2") == "orders"
+    assert registry.resolve_latest("orders")[0] == "v1"
+    assert registry.get_version("v1")["active"] is True
+    with pytest.raises(RegistryError) as error:
+        registry.delete_by_version("v1")
+    assert error.value.status_code == 400
+
+def test_delete_by_name(registry, redis_client):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    registry.update("orders", "v2", SQL, PARAMETERS)
+    assert sorted(registry.delete_by_name("orders")) == ["v1", "v2"]
+    assert not redis_client.exists("orders", "v1", "v2")
+    assert registry.list_names() == ([], None)
+    with pytest.raises(RegistryError) as error:
+        registry.resolve_latest("orders")
+    assert error.value.status_code == 404
+    with pytest.raises(RegistryError):
+        registry.delete_by_name("orders")
+
+def test_resolve_many(registry):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    results = registry.resolve_many([("name", "orders"), ("version", "v1"), ("name", "missing"),
+                                     ("version", "missing")])
+    assert results[0][0] == "v1" and results[1][0] == "v1"
+    assert isinstance(results[2], RegistryError) and isinstance(results[3], RegistryError)
+
+def test_list_names_pages_and_prefix(registry):
+    for index, name in enumerate(["a1", "a2", "a3", "b1"]):
+        registry.create(name, f"v{index}", SQL, PARAMETERS)
+    names, cursor = registry.list_names(limit=2)
+    assert names == ["a1", "a2"]
+    assert registry.list_names(limit=2, cursor=cursor) == (["a3", "b1"], None)
+    assert registry.list_names(prefix="a", limit=10) == (["a1", "a2", "a3"], None)
+    assert registry.recent_names(limit=1) == ["b1"]
+
+def test_legacy_records_are_read_and_updated(registry, redis_client):
+    write_legacy(redis_client, "orders", ["v1"])
+    version, record = registry.resolve_latest("orders")
+    assert (version, record["sql"], record["active"]) == ("v1", SQL, True)
+    registry.update("orders", "v2", SQL, PARAMETERS)
+    # The legacy record keeps its format, with its flag flipped in place
+    assert redis_client.type("v1") == "string"
+    assert json.loads(redis_client.get("v1"))["active"] is False
+    assert registry.get_version("v2")["active"] is True
+
+def test_migrate_records(registry, redis_client):
+    write_legacy(redis_client, "orders", ["v2", "v1"])
+    redis_client.set("unrelated", "not json")
+    assert registry.migrate_records(dry_run=True) == {"migrated": 2, "skipped": 0}
+    assert redis_client.type("v1") == "string"
+
+    assert registry.migrate_records() == {"migrated": 2, "skipped": 0}
+    assert redis_client.type("v1") == "hash" and redis_client.type("v2") == "hash"
+    assert registry.resolve_latest("orders") == ("v2", {"name": "orders", "sql": SQL, "parameters": PARAMETERS,
+                                                        "active": True})
+    assert registry.get_version("v1")["active"] is False
+    assert redis_client.get("unrelated") == "not json"
+    # Nothing is left to convert
+    assert registry.migrate_records() == {"migrated": 0, "skipped": 0}
+
+def test_unknown_schema_is_rejected(registry, redis_client):
+    registry.create("orders", "v1", SQL, PARAMETERS)
+    redis_client.hset("v1", "schema", "99")
+    with pytest.raises(RegistryError) as error:
+        registry.get_version("v1")
+    assert error.value.status_code == 500
@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+
+from application.modules.aio import AsyncSingleFlight
+from application.modules.deadlines import DeadlineExceeded, start_deadline
+from application.modules.metrics import SINGLEFLIGHT_CALLS_TOTAL, Metrics
+from application.modules.serialization import dumps
+from application.modules.singleflight import SingleFlight
+from conftest import wait_until
+
+def run_concurrently(functions):
+    """Run the functions in threads; return their results (or exceptions) in order."""
+    results = [None] * len(functions)
+
+    def run(index):
+        try:
+            results[index] = functions[index]()
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(functions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+def blocking_query(release, data, calls):
+    """A query that counts its calls and runs until `release` is set."""
+    def query():
+        calls.append(1)
+        release.wait(5)
+        return data, dumps(data)
+    return query
+
+def with_deadline(seconds, func, *args):
+    """Call func under a request deadline of seconds, leaving the caller's context alone."""
+    def run():
+        start_deadline(default_timeout=seconds)
+        return func(*args)
+    return contextvars.copy_context().run(run)
+
+def counted(flight, role):
+    return flight.metrics.collect().get((SINGLEFLIGHT_CALLS_TOTAL, (role,)), 0)
+
+def test_local_callers_share_one_call():
+    flight = SingleFlight(metrics=Metrics())
+    release, queries = threading.Event(), []
+    query = blocking_query(release, {"rows": [1]}, queries)
+    threading.Timer(0.1, release.set).start()
+    results = run_concurrently([lambda: flight.do("key", query)] * 5)
+    assert len(queries) == 1
+    assert all(result[0] == {"rows": [1]} for result in results)
+    assert counted(flight, "leader") == 1 and counted(flight, "local") == 4
+
+def test_local_waiters_get_the_leaders_error():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def query():
+        release.wait(5)
+        raise RuntimeError("broker failed")
+    threading.Timer(0.1, release.set).start()
+    results = run_concurrently([lambda: flight.do("key", query)] * 3)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_keys_are_scoped():
+    assert SingleFlight.make_key("SELECT 1", "a") != SingleFlight.make_key("SELECT 1", "b")
+    assert SingleFlight.make_key("SELECT 1", "a") == SingleFlight.make_key("SELECT 1", "a")
+
+def test_workers_share_the_leaders_result(redis_client):
+    leader = SingleFlight(redis_client, poll_interval=0.01)
+    follower = SingleFlight(redis_client, poll_interval=0.01, metrics=Metrics())
+    release, queries = threading.Event(), []
+    leader_query = blocking_query(release, {"rows": [1]}, queries)
+
+    thread = threading.Thread(target=leader.do, args=("key", leader_query))
+    thread.start()
+    wait_until(lambda: queries)
+    threading.Timer(0.1, release.set).start()
+    data, payload = follower.do("key", lambda: pytest.fail("the follower must not query Pinot"))
+    thread.join(5)
+    assert data == {"rows": [1]}
+    assert counted(follower, "remote") == 1
+    # The lock is released once the result is published
+    assert redis_client.keys("singleflight:lock:key") == []
+
+def test_follower_runs_the_query_when_the_leader_fails(redis_client):
+    leader = SingleFlight(redis_client, poll_interval=0.01)
+    follower = SingleFlight(redis_client, poll_interval=0.01, metrics=Metrics())
+    release, started = threading.Event(), threading.Event()
+
+    def failing_query():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("broker failed")
+    thread = threading.Thread(target=lambda: pytest.raises(RuntimeError, leader.do, "key", failing_query))
+    thread.start()
+    started.wait(5)
+    threading.Timer(0.1, release.set).start()
+    assert follower.do("key", lambda: ({"rows": [2]}, dumps({"rows": [2]})))[0] == {"rows": [2]}
+    thread.join(5)
+    assert counted(follower, "leader") == 1 and counted(follower, "remote") == 0
+
+def test_unshared_results_are_not_published(redis_client):
+    flight = SingleFlight(redis_client)
+    assert flight.do("key", lambda: ({"exceptions": [1]}, None)) == ({"exceptions": [1]}, None)
+    assert redis_client.keys("singleflight:*") == []
+
+# Deadlines
+
+def test_local_waiter_stops_at_its_deadline():
+    flight = SingleFlight(wait_timeout=30)
+    release, calls = threading.Event(), []
+    thread = threading.Thread(target=flight.do, args=("key", blocking_query(release, {"rows": [1]}, calls)))
+    thread.start()
+    wait_until(lambda: calls)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        with_deadline(0.2, flight.do, "key", lambda: pytest.fail("no time is left to query Pinot"))
+    assert time.monotonic() - started < 1
+    release.set()
+    thread.join(5)
+
+def test_remote_waiter_stops_at_its_deadline(redis_client):
+    leader, follower = SingleFlight(redis_client, poll_interval=0.01), SingleFlight(redis_client, wait_timeout=30)
+    release, calls = threading.Event(), []
+    thread = threading.Thread(target=leader.do, args=("key", blocking_query(release, {"rows": [1]}, calls)))
+    thread.start()
+    wait_until(lambda: calls)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        with_deadline(0.2, follower.do, "key", lambda: pytest.fail("no time is left to query Pinot"))
+    assert time.monotonic() - started < 1
+    release.set()
+    thread.join(5)
+
+def test_local_waiter_reruns_after_the_leaders_deadline():
+    flight = SingleFlight()
+    started, calls = threading.Event(), []
+
+    def leader_query():
+        started.set()
+        time.sleep(0.2)
+        raise DeadlineExceeded("Query deadline exceeded")
+    thread = threading.Thread(target=lambda: pytest.raises(DeadlineExceeded, flight.do, "key", leader_query))
+    thread.start()
+    started.wait(5)
+
+    def query():
+        calls.append(1)
+        return {"rows": [2]}, dumps({"rows": [2]})
+    assert with_deadline(10, flight.do, "key", query)[0] == {"rows": [2]}
+    assert len(calls) == 1
+    thread.join(5)
+
+def test_async_waiter_stops_at_its_deadline():
+    flight = AsyncSingleFlight()
+
+    async def slow_query():
+        await asyncio.sleep(0.5)
+        return {"rows": [1]}
+
+    async def waiter():
+        start_deadline(default_timeout=0.1)
+        return await flight.do("key", slow_query)
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do("key", slow_query))
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            await asyncio.ensure_future(waiter())
+        elapsed = time.monotonic() - started
+        # The leader's call carries on without the waiter
+        return elapsed, await leader
+    elapsed, result = asyncio.run(run())
+    assert elapsed < 0.4
+    assert result == {"rows": [1]}
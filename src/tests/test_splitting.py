@@ -0,0 +1,66 @@
+import pytest
+
+from application.modules.resultcache import HIT, MISS, STALE
+from application.modules.splitting import DEFAULT_SELECTION_LIMIT, SplitPlan, merge_cache_status, merge_responses
+from application.modules.splitting import split_plan
+
+def response(rows, **stats):
+    return dict({"resultTable": {"dataSchema": {"columnNames": ["id", "ts"]}, "rows": rows}, "exceptions": []},
+                **stats)
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT id FROM t WHERE id IN (1, 2)", SplitPlan((), DEFAULT_SELECTION_LIMIT)),
+    ("SELECT id FROM t WHERE id IN (1) LIMIT 50", SplitPlan((), 50)),
+    ("SELECT id FROM t WHERE id IN (1) LIMIT 0, 50", SplitPlan((), 50)),
+    ("SELECT id, ts FROM t WHERE id IN (1) ORDER BY ts DESC, id LIMIT 5", SplitPlan((("ts", True), ("id", False)), 5)),
+    ('SELECT id FROM t WHERE id IN (1) ORDER BY "odd ""col""" ASC', SplitPlan((('odd "col"', False),), 10)),
+    # Keywords inside string literals do not count
+    ("SELECT id FROM t WHERE name IN ('GROUP BY', 'COUNT(')", SplitPlan((), DEFAULT_SELECTION_LIMIT)),
+])
+def test_split_plan(sql, expected):
+    assert split_plan(sql) == expected
+
+@pytest.mark.parametrize("sql", [
+    "SELECT COUNT(*) FROM t WHERE id IN (1)",
+    "SELECT id, SUM(x) FROM t WHERE id IN (1) GROUP BY id",
+    "SELECT DISTINCT id FROM t WHERE id IN (1)",
+    "SELECT DISTINCTCOUNTHLL(id) FROM t WHERE id IN (1)",
+    "SELECT id FROM t WHERE id IN (1) LIMIT 10 OFFSET 5",
+    "SELECT id FROM t WHERE id IN (1) ORDER BY id + 1",
+])
+def test_unmergeable_queries(sql):
+    with pytest.raises(ValueError):
+        split_plan(sql)
+
+def test_merge_orders_and_limits_rows():
+    plan = SplitPlan((("ts", True), ("id", False)), 3)
+    merged = merge_responses([
+        response([[1, 10], [3, 5]], numDocsScanned=2, timeUsedMs=4, totalDocs=100),
+        response([[2, 10], [4, 7]], numDocsScanned=3, timeUsedMs=9, totalDocs=100),
+    ], plan)
+    assert merged["resultTable"]["rows"] == [[1, 10], [2, 10], [4, 7]]
+    assert merged["numDocsScanned"] == 5
+    assert merged["timeUsedMs"] == 9 and merged["totalDocs"] == 100
+
+def test_merge_concatenates_exceptions():
+    merged = merge_responses([dict(response([]), exceptions=[{"message": "a"}]),
+                              dict(response([]), exceptions=[{"message": "b"}])], SplitPlan((), 10))
+    assert merged["exceptions"] == [{"message": "a"}, {"message": "b"}]
+
+def test_merge_by_missing_column_fails():
+    with pytest.raises(ValueError):
+        merge_responses([response([[1, 2]]), response([[3, 4]])], SplitPlan((("other", False),), 10))
+
+def test_merge_by_unorderable_values_fails():
+    with pytest.raises(ValueError):
+        merge_responses([response([[1, None]]), response([[3, 4]])], SplitPlan((("ts", False),), 10))
+
+@pytest.mark.parametrize("statuses, expected", [
+    ([HIT, HIT], HIT),
+    ([HIT, MISS], MISS),
+    ([HIT, STALE, MISS], STALE),
+    ([None, HIT], HIT),
+    ([None], None),
+])
+def test_merge_cache_status(statuses, expected):
+    assert merge_cache_status(statuses) == expected